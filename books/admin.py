@@ -15,6 +15,11 @@ class CommentAdmin(MPTTModelAdmin):
     list_display = ('content', 'book', 'user', 'created_at')
     list_filter = ('book',)
 
+    def get_ordering(self, request):
+        if Comment.tree_storage() == Comment.PATH_STORAGE:
+            return ('path',)
+        return super().get_ordering(request)
+
 
 admin.site.register(Rating)
 
@@ -0,0 +1,485 @@
+import heapq
+import json
+import logging
+import os
+import re
+import socket
+import sys
+import threading
+import time
+import unicodedata
+from array import array
+from bisect import bisect_left
+
+import redis
+from django.conf import settings
+from django.db.models import Count, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+from .models import Book, ReadList
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'ENABLED': False,
+    'URL': 'redis://redis:6379/0',
+    'OPTIONS': {},
+    'STREAM_KEY': 'autocomplete:changes',
+    'STREAM_MAXLEN': 100000,
+    'WORKERS_KEY': 'autocomplete:workers',
+    # Как часто воркер дочитывает ленту изменений
+    'REFRESH_INTERVAL': 5,
+    'SIZE': 5,
+    'MEMO_SIZE': 10000,
+    # Для префиксов, под которыми больше TOP_SPAN книг, TOP_DEPTH лучших
+    # считаются заранее, остальные префиксы просматриваются целиком
+    'TOP_SPAN': 1000,
+    'TOP_DEPTH': 50,
+    # Сколько изменений копится поверх основы снимка до слияния
+    'COMPACT_SIZE': 50000,
+}
+
+# Параметры suggest, на которые отвечает локальный индекс
+QUERY_PARAMS = ('title__completion',)
+
+_clients = {}
+
+
+def get_config():
+    return {**DEFAULTS, **getattr(settings, 'AUTOCOMPLETE', {})}
+
+
+def is_enabled():
+    return get_config()['ENABLED']
+
+
+def get_client():
+    config = get_config()
+    client = _clients.get(config['URL'])
+    if client is None:
+        client = _clients[config['URL']] = redis.Redis.from_url(config['URL'], **config['OPTIONS'])
+    return client
+
+
+def normalize(text):
+    """
+    Ключ поиска: без регистра и диакритики, слова через один пробел
+    """
+    text = unicodedata.normalize('NFKD', text.casefold()).replace('ё', 'е')
+    text = ''.join(char for char in text if not unicodedata.combining(char))
+    return ' '.join(re.findall(r'\w+', text))
+
+
+def publish(book_ids):
+    """
+    Пишет изменившиеся книги в ленту, которую дочитывают воркеры
+    """
+    if not book_ids or not is_enabled():
+        return
+    config = get_config()
+    get_client().xadd(
+        config['STREAM_KEY'],
+        {'ids': ','.join(map(str, sorted(book_ids)))},
+        maxlen=config['STREAM_MAXLEN'],
+        approximate=False,
+    )
+
+
+def load_rows(book_ids=None):
+    """
+    (id, название, вес) книг; вес - число оценок и читателей
+    """
+    readers = (
+        ReadList.objects.filter(book=OuterRef('pk')).order_by().values('book')
+        .annotate(value=Count('*')).values('value')
+    )
+    queryset = Book.objects.annotate(readers_count=Coalesce(Subquery(readers), Value(0)))
+    if book_ids is not None:
+        queryset = queryset.filter(pk__in=book_ids)
+    for pk, title, rating_count, readers_count in queryset.values_list(
+        'id', 'title', 'rating_count', 'readers_count'
+    ).iterator(chunk_size=10000):
+        yield pk, title, rating_count + readers_count
+
+
+def _rank(entry):
+    """
+    Порядок подсказок: популярные первыми, при равенстве - по ключу
+    """
+    key, title, pk, weight = entry
+    return -weight, key, title, pk
+
+
+class _Base:
+    """
+    Неизменяемая основа снимка: записи (ключ, название, id, вес),
+    отсортированные по ключу, в параллельных массивах и индекс id -> позиция
+    (отсортированные id с позициями, двоичный поиск вместо словаря на
+    миллион элементов)
+    """
+
+    def __init__(self, entries):
+        self.keys = [entry[0] for entry in entries]
+        self.titles = [entry[1] for entry in entries]
+        self.ids = array('q', (entry[2] for entry in entries))
+        self.weights = array('q', (entry[3] for entry in entries))
+        order = sorted(range(len(entries)), key=self.ids.__getitem__)
+        self.sorted_ids = array('q', (self.ids[i] for i in order))
+        self.positions = array('q', order)
+        containers = sum(map(sys.getsizeof, (
+            self.keys, self.titles, self.ids, self.weights, self.sorted_ids, self.positions,
+        )))
+        self.size = containers + sum(map(sys.getsizeof, self.keys)) + sum(map(sys.getsizeof, self.titles))
+
+    def __len__(self):
+        return len(self.keys)
+
+    def entry(self, i):
+        return self.keys[i], self.titles[i], self.ids[i], self.weights[i]
+
+    def position(self, pk):
+        i = bisect_left(self.sorted_ids, pk)
+        if i < len(self.sorted_ids) and self.sorted_ids[i] == pk:
+            return self.positions[i]
+        return None
+
+    def span(self, prefix):
+        lo = bisect_left(self.keys, prefix)
+        return lo, bisect_left(self.keys, prefix + '\U0010ffff', lo)
+
+    def wide_prefixes(self, limit):
+        """
+        Префиксы, под которыми больше limit ключей. Обход сверху вниз:
+        у узкого префикса широких продолжений нет, поэтому просматриваются
+        только дети широких, каждый двоичным поиском конца своего диапазона.
+        """
+        keys = self.keys
+        wide = []
+        stack = [('', 0, len(keys))]
+        while stack:
+            prefix, lo, hi = stack.pop()
+            i = lo
+            while i < hi:
+                if len(keys[i]) <= len(prefix):
+                    i += 1
+                    continue
+                child = keys[i][:len(prefix) + 1]
+                end = bisect_left(keys, child + '\U0010ffff', i, hi)
+                if end - i > limit:
+                    wide.append(child)
+                    stack.append((child, i, end))
+                i = end
+        return wide
+
+
+class Snapshot:
+    """
+    Неизменяемый префиксный индекс. Обновление не копирует основу:
+    удаленные позиции и новые записи лежат в небольшом наложении, которое
+    сливается с основой, когда дорастает до COMPACT_SIZE. Для широких
+    префиксов (больше TOP_SPAN книг в основе) TOP_DEPTH самых популярных
+    книг посчитаны заранее, поэтому ни один запрос не просматривает больше
+    TOP_SPAN записей основы. Обновление пересчитывает только затронутые
+    префиксы и сохраняет памятку остальных. Каждое обновление строит новый снимок, поэтому
+    потоки читают без блокировок.
+    """
+
+    def __init__(self, base, removed=frozenset(), extra=None, top=None, memo=None):
+        self.base = base
+        self.removed = removed
+        self.extra = extra or {}
+        self.extra_sorted = sorted(self.extra.values())
+        self.top = self._build_top() if top is None else top
+        self.size = base.size + sum(
+            sys.getsizeof(key) + sys.getsizeof(title) for key, title, _, _ in self.extra.values()
+        )
+        self._memo = memo or {}
+
+    @classmethod
+    def build(cls, rows):
+        return cls(_Base(sorted((normalize(title), title, pk, weight) for pk, title, weight in rows)))
+
+    def __len__(self):
+        return len(self.base) - len(self.removed) + len(self.extra)
+
+    def _build_top(self):
+        """
+        Лучшие TOP_DEPTH записей каждого широкого префикса за один проход
+        по позициям в порядке убывания веса (сортировка устойчивая, при
+        равенстве остается порядок ключей)
+        """
+        config = get_config()
+        depth = config['TOP_DEPTH']
+        keys = self.base.keys
+        best = {prefix: [] for prefix in self.base.wide_prefixes(config['TOP_SPAN'])}
+        if not best:
+            return {}
+        for i in sorted(range(len(keys)), key=self.base.weights.__getitem__, reverse=True):
+            key = keys[i]
+            for length in range(1, len(key) + 1):
+                # Продолжение узкого префикса тоже узкое
+                positions = best.get(key[:length])
+                if positions is None:
+                    break
+                if len(positions) <= depth:
+                    positions.append(i)
+        return {
+            prefix: ([self.base.entry(i) for i in positions[:depth]], len(positions) > depth)
+            for prefix, positions in best.items()
+        }
+
+    def _scan(self, prefix, limit):
+        """
+        limit лучших записей префикса по основе без удаленных и по наложению
+        """
+        lo, hi = self.base.span(prefix)
+        weights, removed = self.base.weights, self.removed
+        positions = heapq.nsmallest(
+            limit, (i for i in range(lo, hi) if i not in removed), key=lambda i: (-weights[i], i)
+        )
+        candidates = [self.base.entry(i) for i in positions]
+        i = bisect_left(self.extra_sorted, (prefix,))
+        while i < len(self.extra_sorted) and self.extra_sorted[i][0].startswith(prefix):
+            candidates.append(self.extra_sorted[i])
+            i += 1
+        return heapq.nsmallest(limit, candidates, key=_rank)
+
+    def lookup(self, prefix, size):
+        """
+        size самых популярных книг, чей ключ начинается с prefix:
+        для широких префиксов - из заранее посчитанных (в них всегда не меньше
+        SIZE записей, больше нужно только запросам крупнее SIZE), для
+        остальных - двоичный поиск диапазона, частые запросы - из памятки
+        """
+        entries, truncated = self.top.get(prefix, ((), False))
+        if size <= len(entries) or (prefix in self.top and not truncated):
+            return [(pk, title, weight) for _, title, pk, weight in entries[:size]]
+
+        memo_key = (prefix, size)
+        found = self._memo.get(memo_key)
+        if found is not None:
+            return found
+
+        found = [(pk, title, weight) for _, title, pk, weight in self._scan(prefix, size)]
+        if len(self._memo) >= get_config()['MEMO_SIZE']:
+            self._memo.clear()
+        self._memo[memo_key] = found
+        return found
+
+    def replace(self, book_ids, rows):
+        """
+        Новый снимок, где книги book_ids заменены на rows (удаленных книг в rows нет)
+        """
+        config = get_config()
+        book_ids = set(book_ids)
+        removed, extra = set(self.removed), dict(self.extra)
+        changed = []
+        for pk in book_ids:
+            i = self.base.position(pk)
+            if i is not None and i not in removed:
+                removed.add(i)
+                changed.append(self.base.keys[i])
+            old = extra.pop(pk, None)
+            if old is not None:
+                changed.append(old[0])
+        added = []
+        for pk, title, weight in rows:
+            entry = extra[pk] = (normalize(title), title, pk, weight)
+            added.append(entry)
+            changed.append(entry[0])
+
+        if len(removed) + len(extra) > config['COMPACT_SIZE']:
+            kept = (self.base.entry(i) for i in range(len(self.base)) if i not in removed)
+            return Snapshot(_Base(sorted([*kept, *extra.values()])))
+
+        affected = {key[:n] for key in changed for n in range(1, len(key) + 1)}
+        memo = {memo_key: found for memo_key, found in self._memo.items() if memo_key[0] not in affected}
+        snapshot = Snapshot(self.base, frozenset(removed), extra, top=dict(self.top), memo=memo)
+        for prefix in affected & self.top.keys():
+            snapshot._update_top(prefix, book_ids, added)
+        return snapshot
+
+    def _update_top(self, prefix, book_ids, added):
+        """
+        Пересчет лучших записей префикса по изменениям. У неполного списка
+        последняя запись - граница: книги ниже нее могли уступать неизвестным,
+        поэтому в список попадают только новые выше границы. Если удаления
+        съели список меньше SIZE, префикс считается заново по диапазону.
+        Широкий префикс остается в top и пустым, чтобы не просматривать его.
+        """
+        config = get_config()
+        depth = config['TOP_DEPTH']
+        entries, truncated = self.top[prefix]
+        new = [entry for entry in added if entry[0].startswith(prefix)]
+        if truncated:
+            bound = _rank(entries[-1])
+            new = [entry for entry in new if _rank(entry) < bound]
+        entries = sorted([entry for entry in entries if entry[2] not in book_ids] + new, key=_rank)
+        if len(entries) > depth:
+            entries, truncated = entries[:depth], True
+        if truncated and len(entries) < config['SIZE']:
+            entries = self._scan(prefix, depth + 1)
+            entries, truncated = entries[:depth], len(entries) > depth
+        self.top[prefix] = (entries, truncated)
+
+
+class TitleIndex:
+    """
+    Индекс названий в памяти воркера. Загружается целиком при первом
+    обращении, затем раз в REFRESH_INTERVAL дочитывает ленту изменений,
+    которую пишет разбор outbox, и отчитывается о своем размере.
+    Если лента успела обрезаться дальше прочитанного места, индекс
+    загружается заново.
+    """
+
+    def __init__(self):
+        self.snapshot = None
+        self.last_id = '0-0'
+        self.checked_at = 0
+        self._lock = threading.Lock()
+
+    def suggest(self, prefix, size=None):
+        prefix = normalize(prefix)
+        if not prefix:
+            return []
+        self._ensure_fresh()
+        if self.snapshot is None:
+            return []
+        return self.snapshot.lookup(prefix, size or get_config()['SIZE'])
+
+    def _is_fresh(self):
+        return bool(self.checked_at) and time.monotonic() - self.checked_at < get_config()['REFRESH_INTERVAL']
+
+    def _ensure_fresh(self):
+        if self._is_fresh():
+            return
+        # Обновляет один поток, остальные пока читают прежний снимок
+        if not self._lock.acquire(blocking=self.snapshot is None):
+            return
+        try:
+            if self._is_fresh():
+                return
+            if self.snapshot is None:
+                self.load()
+            else:
+                self.refresh()
+        except redis.RedisError as exc:
+            # Без ленты изменений подсказки дает прежний снимок, а без
+            # снимка - ES; следующая попытка через REFRESH_INTERVAL
+            self.checked_at = time.monotonic()
+            logger.warning('autocomplete: Redis недоступен, индекс не обновлен: %s', exc)
+        finally:
+            self._lock.release()
+
+    def load(self):
+        config = get_config()
+        latest = get_client().xrevrange(config['STREAM_KEY'], count=1)
+        self.last_id = latest[0][0].decode() if latest else '0-0'
+        self.snapshot = Snapshot.build(load_rows())
+        self.checked_at = time.monotonic()
+        self._report()
+
+    def refresh(self):
+        config = get_config()
+        client = get_client()
+        self.checked_at = time.monotonic()
+        entries = client.xrange(config['STREAM_KEY'], min=_next_id(self.last_id))
+        if not entries:
+            self._report()
+            return
+
+        oldest = client.xrange(config['STREAM_KEY'], count=1)[0][0].decode()
+        if _stream_id(oldest) > _stream_id(self.last_id) and \
+                client.xlen(config['STREAM_KEY']) >= config['STREAM_MAXLEN']:
+            # Часть изменений после last_id могла быть обрезана
+            self.load()
+            return
+
+        book_ids = {int(pk) for _, fields in entries for pk in fields[b'ids'].split(b',')}
+        self.snapshot = self.snapshot.replace(book_ids, load_rows(book_ids))
+        self.last_id = entries[-1][0].decode()
+        self._report()
+
+    def stats(self):
+        return {
+            'entries': len(self.snapshot) if self.snapshot else 0,
+            'bytes': self.snapshot.size if self.snapshot else 0,
+            'last_id': self.last_id,
+            'updated_at': time.time(),
+        }
+
+    def _report(self):
+        stats = self.stats()
+        worker = f'{socket.gethostname()}:{os.getpid()}'
+        logger.info('autocomplete %s: %s книг, %s байт', worker, stats['entries'], stats['bytes'])
+        get_client().hset(get_config()['WORKERS_KEY'], worker, json.dumps(stats))
+
+
+def _stream_id(value):
+    ms, seq = value.split('-')
+    return int(ms), int(seq)
+
+
+def _next_id(value):
+    ms, seq = _stream_id(value)
+    return f'{ms}-{seq + 1}'
+
+
+def worker_stats():
+    """
+    Последние отчеты воркеров о размере их индексов
+    """
+    raw = get_client().hgetall(get_config()['WORKERS_KEY'])
+    return {worker.decode(): json.loads(value) for worker, value in sorted(raw.items())}
+
+
+index = TitleIndex()
+
+
+def warm():
+    """
+    Загрузка индекса при старте воркера, чтобы ее не ждал первый запрос
+    """
+    if not is_enabled():
+        return
+    try:
+        index.suggest('a')
+    except Exception:
+        logger.exception('autocomplete: индекс не загружен, подсказки пойдут в ES')
+
+
+def suggest_response(query_params):
+    """
+    Ответ suggest в формате completion-подсказок ES или None, если
+    запрос нужно отдать в ES: индекс выключен, запрос не на подсказку
+    по началу названия или локально ничего не найдено
+    """
+    if not is_enabled() or len(query_params) != 1:
+        return None
+    param = next(iter(query_params))
+    values = query_params.getlist(param)
+    if param not in QUERY_PARAMS or len(values) != 1 or not values[0].strip():
+        return None
+
+    text = values[0].strip()
+    found = index.suggest(text)
+    if not found:
+        return None
+    return completion_response(param, text, found)
+
+
+def completion_response(param, text, found):
+    """
+    Подсказки (id, название, вес) в формате completion-подсказок ES
+    """
+    return {
+        param: [{
+            'text': text,
+            'offset': 0,
+            'length': len(text),
+            'options': [
+                {'text': title, '_id': str(pk), '_score': float(weight), '_source': {'title': title}}
+                for pk, title, weight in found
+            ],
+        }],
+    }
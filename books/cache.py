@@ -0,0 +1,268 @@
+import hashlib
+import time
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+from rest_framework.response import Response
+
+DEFAULTS = {
+    'ENABLED': True,
+    'ALIAS': 'default',
+    'TIMEOUT': 300,
+    'STALE_TIMEOUT': 600,
+    'LOCK_TIMEOUT': 30,
+    'TAG_TIMEOUT': 60 * 60 * 24,
+}
+
+STATS_EVENTS = ('hit', 'stale', 'not_modified', 'miss', 'revalidate')
+
+BOOKS_TAG = 'books'
+AUTHORS_TAG = 'authors'
+
+
+def get_config():
+    return {**DEFAULTS, **getattr(settings, 'RESPONSE_CACHE', {})}
+
+
+def get_cache():
+    return caches[get_config()['ALIAS']]
+
+
+def book_tag(pk):
+    return f'book:{pk}'
+
+
+def author_tag(pk):
+    return f'author:{pk}'
+
+
+def genre_tag(pk):
+    return f'genre:{pk}'
+
+
+def book_tags(books):
+    """
+    Теги зависимостей для списка книг в форме BookSerializer
+    """
+    tags = set()
+    for book in books:
+        tags.add(book_tag(book['id']))
+        genre = book.get('genre')
+        if genre is not None:
+            tags.add(genre_tag(genre['id'] if isinstance(genre, dict) else genre))
+        for author in book.get('author', ()):
+            tags.add(author_tag(author['id'] if isinstance(author, dict) else author))
+    return tags
+
+
+def page_results(data):
+    return data['results'] if isinstance(data, dict) else data
+
+
+def _tag_key(tag):
+    return f'rc:tag:{tag}'
+
+
+def get_tag_versions(tags, initial=None):
+    """
+    Текущие версии тегов. Версия - момент последней инвалидации в нс;
+    для тегов без версии она заводится со значением initial (по умолчанию сейчас).
+    """
+    cache = get_cache()
+    keys = {_tag_key(tag): tag for tag in tags}
+    found = cache.get_many(keys)
+
+    initial = initial or time.time_ns()
+    missing = {key: initial for key in keys if key not in found}
+    if missing:
+        cache.set_many(missing, timeout=get_config()['TAG_TIMEOUT'])
+        found.update(missing)
+
+    return {keys[key]: version for key, version in found.items()}
+
+
+def invalidate_tags(*tags):
+    """
+    Сдвигает версии тегов сразу и еще раз после коммита: ответ, собранный
+    конкурентным запросом до коммита, не должен остаться свежим.
+    """
+    def bump():
+        get_cache().set_many(
+            {_tag_key(tag): time.time_ns() for tag in tags},
+            timeout=get_config()['TAG_TIMEOUT'],
+        )
+
+    bump()
+    transaction.on_commit(bump)
+
+
+def record(event, namespace='rc'):
+    cache = get_cache()
+    key = f'{namespace}:stats:{event}'
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, 1, timeout=None)
+
+
+def get_stats(namespace='rc'):
+    values = get_cache().get_many([f'{namespace}:stats:{event}' for event in STATS_EVENTS])
+    return {event: values.get(f'{namespace}:stats:{event}', 0) for event in STATS_EVENTS}
+
+
+def reset_stats(namespace='rc'):
+    get_cache().delete_many([f'{namespace}:stats:{event}' for event in STATS_EVENTS])
+
+
+def cache_key(request):
+    params = sorted(
+        (key, value)
+        for key in request.query_params
+        for value in request.query_params.getlist(key)
+    )
+    normalized = f'{request.path}?{urlencode(params)}'
+    return 'rc:resp:' + hashlib.sha1(normalized.encode()).hexdigest()
+
+
+def make_validators(request, key, versions):
+    """
+    Сильный ETag и Last-Modified ответа по версиям его тегов
+    """
+    stamp = ','.join(f'{tag}={version}' for tag, version in sorted(versions.items()))
+    digest = hashlib.sha1(f'{key}|{request.accepted_media_type}|{stamp}'.encode()).hexdigest()
+    last_modified = max(versions.values(), default=time.time_ns()) // 10 ** 9
+    return f'"{digest}"', last_modified
+
+
+class CachedResponseMixin:
+    """
+    Кэширование ответов list/retrieve с инвалидацией по тегам
+    и отдачей устаревшей версии, пока один воркер ее пересобирает.
+    Ответы получают ETag/Last-Modified; условный запрос с актуальным
+    валидатором получает 304 по одним только версиям тегов.
+    """
+    # Префикс счетчиков попаданий, см. get_stats
+    cache_stats_namespace = 'rc'
+
+    def list(self, request, *args, **kwargs):
+        return self.cached_response(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.cached_response(super().retrieve, request, *args, **kwargs)
+
+    def get_cache_tags(self, data):
+        return set()
+
+    def get_cache_key(self, request):
+        return cache_key(request)
+
+    def get_cache_timeout(self, request):
+        return get_config()['TIMEOUT']
+
+    def cached_response(self, handler, request, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD'):
+            return handler(request, *args, **kwargs)
+
+        config = get_config()
+        cache = get_cache()
+        key = self.get_cache_key(request)
+
+        not_modified = self._not_modified(request, key)
+        if not_modified is not None:
+            record('not_modified', self.cache_stats_namespace)
+            not_modified['X-Cache'] = 'NOT_MODIFIED'
+            return not_modified
+
+        if not config['ENABLED']:
+            response = handler(request, *args, **kwargs)
+            if response.status_code == 200:
+                versions = self._store_tags(key, response)
+                return self._with_validators(request, key, versions, response)
+            return response
+
+        entry = cache.get(key)
+        lock_key = f'{key}:lock'
+        locked = False
+
+        if entry is not None:
+            fresh = entry['expires'] > time.time() and get_tag_versions(entry['tags']) == entry['tags']
+            if fresh:
+                record('hit', self.cache_stats_namespace)
+                return self._cached(request, key, entry, 'HIT')
+
+            locked = cache.add(lock_key, 1, timeout=config['LOCK_TIMEOUT'])
+            if not locked:
+                record('stale', self.cache_stats_namespace)
+                return self._cached(request, key, entry, 'STALE')
+
+        record('miss' if entry is None else 'revalidate', self.cache_stats_namespace)
+        started = time.time_ns()
+        try:
+            response = handler(request, *args, **kwargs)
+            if response.status_code != 200:
+                return response
+
+            tags = self._store_tags(key, response, initial=started)
+            timeout = self.get_cache_timeout(request)
+            expires = time.time() + timeout
+            if any(version > started for version in tags.values()):
+                # Данные поменялись, пока собирался ответ: сохраняем его сразу устаревшим
+                expires = 0
+            cache.set(
+                key,
+                {'data': response.data, 'status': response.status_code, 'tags': tags, 'expires': expires},
+                timeout=timeout + config['STALE_TIMEOUT'],
+            )
+        finally:
+            if locked:
+                cache.delete(lock_key)
+
+        response['X-Cache'] = 'MISS' if entry is None else 'REVALIDATED'
+        return self._with_validators(request, key, tags, response)
+
+    def _store_tags(self, key, response, initial=None):
+        """
+        Запоминает набор тегов ключа отдельно от ответа и с TTL тегов,
+        чтобы условный запрос проверялся и после вытеснения самого ответа
+        """
+        tags = self.get_cache_tags(response.data)
+        get_cache().set(f'{key}:deps', list(tags), timeout=get_config()['TAG_TIMEOUT'])
+        return get_tag_versions(tags, initial=initial)
+
+    def _not_modified(self, request, key):
+        if not (request.META.get('HTTP_IF_NONE_MATCH') or request.META.get('HTTP_IF_MODIFIED_SINCE')):
+            return None
+
+        tags = get_cache().get(f'{key}:deps')
+        if tags is None:
+            return None
+
+        etag, last_modified = make_validators(request, key, get_tag_versions(tags))
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is not None:
+            response['ETag'] = etag
+            response['Last-Modified'] = http_date(last_modified)
+        return response
+
+    @staticmethod
+    def _with_validators(request, key, versions, response):
+        etag, last_modified = make_validators(request, key, versions)
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(last_modified)
+
+        not_modified = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if not_modified is not None:
+            for header in ('ETag', 'Last-Modified', 'X-Cache'):
+                if header in response:
+                    not_modified[header] = response[header]
+            return not_modified
+        return response
+
+    def _cached(self, request, key, entry, state):
+        response = Response(entry['data'], status=entry['status'])
+        response['X-Cache'] = state
+        return self._with_validators(request, key, entry['tags'], response)
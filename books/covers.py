@@ -0,0 +1,132 @@
+import posixpath
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.utils.module_loading import import_string
+from PIL import Image, ImageOps
+
+from . import search_sync
+from .cache import book_tag, invalidate_tags
+from .models import Book
+
+DEFAULTS = {
+    'STORAGE': 'drf_project.storages.CoverStorage',
+    'WIDTHS': [160, 320, 640],
+    'QUALITY': 80,
+}
+
+# Формат рендиции -> (формат Pillow, расширение файла)
+FORMATS = {
+    'webp': ('WEBP', 'webp'),
+    'jpeg': ('JPEG', 'jpg'),
+}
+
+_storages = {}
+
+
+def get_config():
+    return {**DEFAULTS, **getattr(settings, 'COVER_RENDITIONS', {})}
+
+
+def get_storage():
+    path = get_config()['STORAGE']
+    storage = _storages.get(path)
+    if storage is None:
+        storage = _storages[path] = import_string(path)()
+    return storage
+
+
+def needs_processing(book):
+    return bool(book.cover_image) and book.cover_renditions.get('source') != book.cover_image.name
+
+
+def rendition_name(source, width, extension):
+    """
+    Рендиции лежат рядом с оригиналом в том же хранилище (CoverStorage,
+    без префикса): book_covers/x.png -> book_covers/x/320w.webp
+    """
+    stem, _ = posixpath.splitext(source)
+    return f'{stem}/{width}w.{extension}'
+
+
+def render(image, width, pillow_format, quality):
+    height = round(image.height * width / image.width)
+    resized = image.resize((width, height), Image.LANCZOS)
+    buffer = BytesIO()
+    resized.save(buffer, format=pillow_format, quality=quality)
+    return buffer.getvalue()
+
+
+def process_cover(book_id, force=False):
+    """
+    Строит WebP/JPEG-рендиции обложки фиксированных ширин (не шире оригинала)
+    и сохраняет их карту в Book.cover_renditions. Если обложку успели
+    заменить, результат не записывается. Возвращает True, если карта обновлена.
+    """
+    book = Book.objects.only('cover_image', 'cover_renditions').get(pk=book_id)
+    if not book.cover_image or (not force and not needs_processing(book)):
+        return False
+
+    config = get_config()
+    storage = get_storage()
+    source = book.cover_image.name
+
+    with book.cover_image.open('rb') as original:
+        image = ImageOps.exif_transpose(Image.open(original))
+        image = image.convert('RGB')
+
+    widths = [width for width in sorted(config['WIDTHS']) if width < image.width] or [image.width]
+    renditions = {'source': source}
+    for name, (pillow_format, extension) in FORMATS.items():
+        renditions[name] = {}
+        for width in widths:
+            path = rendition_name(source, width, extension)
+            if storage.exists(path):
+                storage.delete(path)
+            content = render(image, width, pillow_format, config['QUALITY'])
+            renditions[name][str(width)] = storage.save(path, ContentFile(content))
+
+    updated = Book.objects.filter(pk=book_id, cover_image=source).update(cover_renditions=renditions)
+    if updated:
+        # update() не отправляет сигналы
+        invalidate_tags(book_tag(book_id))
+        search_sync.record([book_id])
+    return bool(updated)
+
+
+def srcset(renditions, storage=None):
+    """
+    srcset по форматам: {'webp': 'url 160w, url 320w', 'jpeg': ...}
+    """
+    if not renditions.get('source'):
+        return None
+
+    storage = storage or get_storage()
+    return {
+        name: ', '.join(
+            f'{storage.url(path)} {width}w'
+            for width, path in sorted(renditions[name].items(), key=lambda item: int(item[0]))
+        )
+        for name in FORMATS
+        if renditions.get(name)
+    }
+
+
+def prefetch_cover_urls(names, renditions):
+    """
+    Прогрев ссылок на обложки и их рендиции для страницы книг
+    """
+    names = [name for name in names if name]
+    cover_storage = Book._meta.get_field('cover_image').storage
+    if names and hasattr(cover_storage, 'prefetch_urls'):
+        cover_storage.prefetch_urls(names)
+
+    paths = [
+        path
+        for item in renditions if item.get('source')
+        for name in FORMATS
+        for path in item.get(name, {}).values()
+    ]
+    if paths and hasattr(get_storage(), 'prefetch_urls'):
+        get_storage().prefetch_urls(paths)
@@ -1,7 +1,32 @@
+from django.db.models import Count, Max, OuterRef, Prefetch, Subquery, Value
+from django.db.models.functions import Coalesce
 from django_elasticsearch_dsl import Document, fields
 from django_elasticsearch_dsl.registries import registry
 
-from .models import Book
+from .models import RATING_VALUES, Author, Book, Comment, Rating, ReadList
+
+# Поля популярности: обновляются частичными bulk-запросами, см. books.search_sync
+SIGNAL_FIELDS = ('rating_average', 'rating_count', 'rating_histogram', 'readers_count', 'last_activity')
+
+
+def _per_book(queryset, aggregate):
+    return Subquery(
+        queryset.filter(book=OuterRef('pk')).order_by().values('book')
+        .annotate(value=aggregate).values('value')
+    )
+
+
+def with_search_signals(queryset):
+    """
+    Добавляет к книгам число читателей и даты последних оценки,
+    добавления в список и комментария
+    """
+    return queryset.annotate(
+        readers_count=Coalesce(_per_book(ReadList.objects, Count('*')), Value(0)),
+        last_rated=_per_book(Rating.objects, Max('created_at')),
+        last_read=_per_book(ReadList.objects, Max('date_added')),
+        last_commented=_per_book(Comment.objects, Max('created_at')),
+    )
 
 
 @registry.register_document
@@ -23,8 +48,8 @@ class BookDocument(Document):
         attr='author',
         properties={
             'id': fields.IntegerField(),
-            'title': fields.TextField(
-                attr='title',
+            'name': fields.TextField(
+                attr='name',
                 fields={
                     'raw': fields.KeywordField(),
                 }
@@ -44,8 +69,52 @@ class BookDocument(Document):
         }
     )
 
+    # Только для выдачи карточки из _source, не индексируются
+    cover_image = fields.KeywordField(index=False)
+    cover_renditions = fields.ObjectField(enabled=False)
+    rating_histogram = fields.ObjectField(enabled=False)
+
+    rating_average = fields.FloatField()
+    rating_count = fields.IntegerField()
+    readers_count = fields.IntegerField()
+    last_activity = fields.DateField()
+
     class Index:
         name = 'books'
 
     class Django:
         model = Book
+        # Синхронизация идет через books.search_sync, а не из запроса
+        ignore_signals = True
+
+    def get_queryset(self):
+        queryset = super().get_queryset().select_related('genre').prefetch_related(
+            Prefetch('author', queryset=Author.objects.order_by('id'))
+        )
+        return with_search_signals(queryset)
+
+    def get_signals_queryset(self):
+        return with_search_signals(
+            self.django.model.objects.only(
+                'rating_average', 'rating_count', *(f'rating_{value}_count' for value in RATING_VALUES)
+            )
+        )
+
+    def prepare_cover_image(self, instance):
+        return instance.cover_image.name or None
+
+    def prepare_cover_renditions(self, instance):
+        return instance.cover_renditions
+
+    def prepare_rating_histogram(self, instance):
+        return instance.rating_histogram
+
+    def prepare_last_activity(self, instance):
+        dates = [instance.last_rated, instance.last_read, instance.last_commented]
+        return max((date for date in dates if date is not None), default=None)
+
+    def prepare_signals(self, instance):
+        return {
+            name: prepare(instance)
+            for name, _, prepare in self._prepared_fields if name in SIGNAL_FIELDS
+        }
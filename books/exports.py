@@ -0,0 +1,80 @@
+import csv
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+from .models import Rating, ReadList
+
+CHUNK_SIZE = 2000
+
+
+def read_list_rows(user, chunk_size=CHUNK_SIZE):
+    """
+    Строки списка прочитанных. Авторы подгружаются одним запросом
+    на каждую пачку из chunk_size строк серверного курсора.
+    """
+    queryset = (
+        ReadList.objects.filter(user=user)
+        .select_related('book__genre')
+        .prefetch_related('book__author')
+        .order_by('-date_added', '-id')
+    )
+    for entry in queryset.iterator(chunk_size=chunk_size):
+        book = entry.book
+        yield {
+            'book': book.pk,
+            'title': book.title,
+            'genre': book.genre.title,
+            'authors': [author.name for author in book.author.all()],
+            'date_added': entry.date_added,
+        }
+
+
+def rating_rows(user, chunk_size=CHUNK_SIZE):
+    queryset = (
+        Rating.objects.filter(user=user)
+        .order_by('-created_at', '-id')
+        .values('book', 'book__title', 'rating', 'created_at')
+    )
+    for row in queryset.iterator(chunk_size=chunk_size):
+        yield {
+            'book': row['book'],
+            'title': row['book__title'],
+            'rating': row['rating'],
+            'created_at': row['created_at'],
+        }
+
+
+DATASETS = {
+    'read-list': (read_list_rows, ['book', 'title', 'genre', 'authors', 'date_added']),
+    'ratings': (rating_rows, ['book', 'title', 'rating', 'created_at']),
+}
+
+
+def ndjson_stream(rows):
+    for row in rows:
+        yield json.dumps(row, cls=DjangoJSONEncoder, ensure_ascii=False) + '\n'
+
+
+class _Echo:
+    """
+    Псевдофайл для csv.writer: возвращает строку вместо записи
+    """
+
+    def write(self, value):
+        return value
+
+
+def csv_stream(rows, fields):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(fields)
+    for row in rows:
+        values = []
+        for field in fields:
+            value = row[field]
+            if isinstance(value, list):
+                value = '; '.join(value)
+            elif hasattr(value, 'isoformat'):
+                value = value.isoformat()
+            values.append(value)
+        yield writer.writerow(values)
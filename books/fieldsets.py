@@ -0,0 +1,94 @@
+from django.db.models import Prefetch
+from rest_framework.exceptions import ValidationError
+
+from .models import RATING_VALUES, Author
+
+
+class BookFieldset:
+    """
+    Разбор ?fields= и ?expand= для книг. fields оставляет в ответе только
+    перечисленные поля (id отдается всегда), expand перечисляет связи,
+    которые отдаются вложенными объектами, остальные отдаются id.
+    Без параметров отдается все и со всеми связями.
+    """
+    fields_query_param = 'fields'
+    expand_query_param = 'expand'
+
+    EXPANDABLE = ('author', 'genre')
+    # Поле ответа -> поля модели, которые нужны для него в only()
+    MODEL_FIELDS = {
+        'id': ['id'],
+        'title': ['title'],
+        'author': [],
+        'genre': ['genre'],
+        'description': ['description'],
+        'cover_image': ['cover_image'],
+        'cover_srcset': ['cover_renditions'],
+        'rating_average': ['rating_average'],
+        'rating_count': ['rating_count'],
+        'rating_histogram': [f'rating_{value}_count' for value in RATING_VALUES],
+        'comments': [],
+    }
+
+    def __init__(self, fields=None, expand=None):
+        self.fields = fields
+        self.expand = expand
+
+    @classmethod
+    def from_request(cls, request):
+        """
+        Набор полей запроса; разбирается один раз и запоминается на request
+        """
+        if not hasattr(request, 'query_params'):
+            return cls()
+
+        fieldset = getattr(request, '_book_fieldset', None)
+        if fieldset is None:
+            fieldset = cls(
+                fields=cls._parse(request, cls.fields_query_param, cls.MODEL_FIELDS),
+                expand=cls._parse(request, cls.expand_query_param, cls.EXPANDABLE),
+            )
+            request._book_fieldset = fieldset
+        return fieldset
+
+    @staticmethod
+    def _parse(request, param, allowed):
+        raw = request.query_params.get(param)
+        if raw is None:
+            return None
+
+        names = {name.strip() for name in raw.split(',') if name.strip()}
+        unknown = names.difference(allowed)
+        if unknown:
+            raise ValidationError({param: f'Неизвестные поля: {", ".join(sorted(unknown))}'})
+        return names
+
+    def includes(self, name):
+        return self.fields is None or name == 'id' or name in self.fields
+
+    def expands(self, name):
+        return self.includes(name) and (self.expand is None or name in self.expand)
+
+    def narrow(self, queryset, prefix='', keep=()):
+        """
+        Подгружает только нужное для ответа: колонки через only(),
+        жанр и авторов - только если они попадут в ответ. prefix - путь
+        до книги от модели queryset, keep - собственные поля этой модели.
+        """
+        if self.expands('genre'):
+            queryset = queryset.select_related(f'{prefix}genre')
+
+        if self.includes('author'):
+            authors = Author.objects.order_by('id')
+            if not self.expands('author'):
+                authors = authors.only('id')
+            queryset = queryset.prefetch_related(Prefetch(f'{prefix}author', queryset=authors))
+
+        if self.fields is not None:
+            columns = {column for name in self.fields for column in self.MODEL_FIELDS[name]}
+            columns.add('id')
+            if self.expands('genre'):
+                columns.update(['genre__id', 'genre__title'])
+            queryset = queryset.only(*keep, *(f'{prefix}{column}' for column in sorted(columns)))
+
+        return queryset
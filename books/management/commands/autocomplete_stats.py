@@ -0,0 +1,33 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from books.autocomplete import get_config, get_client, worker_stats
+
+
+class Command(BaseCommand):
+    help = 'Показывает размер индекса подсказок в памяти каждого воркера'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--prune', type=int, default=None, metavar='SECONDS',
+                            help='Удалить отчеты воркеров, не обновлявшиеся дольше SECONDS')
+
+    def handle(self, *args, prune, **options):
+        now = time.time()
+        stale = []
+        total = 0
+        for worker, stats in worker_stats().items():
+            age = now - stats['updated_at']
+            if prune is not None and age > prune:
+                stale.append(worker)
+                continue
+            total += stats['bytes']
+            self.stdout.write(
+                f'{worker}: {stats["entries"]} книг, {stats["bytes"] / 2 ** 20:.1f} МБ, '
+                f'обновлен {age:.0f} с назад'
+            )
+
+        if stale:
+            get_client().hdel(get_config()['WORKERS_KEY'], *stale)
+            self.stdout.write(f'Удалено отчетов: {len(stale)}')
+        self.stdout.write(self.style.SUCCESS(f'Всего: {total / 2 ** 20:.1f} МБ'))
@@ -0,0 +1,78 @@
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import override_settings
+
+from accounts.domain.models import User
+from books.models import Book, Comment
+
+
+class Command(BaseCommand):
+    help = (
+        'Сравнивает пропускную способность конкурентной вставки ответов '
+        'при хранении дерева комментариев в mptt и в материализованном пути. '
+        'Создает тестовые комментарии, запускать только на копии базы.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('book_id', type=int)
+        parser.add_argument('--threads', type=int, default=8)
+        parser.add_argument('--writes', type=int, default=200, help='Вставок на поток')
+        parser.add_argument('--roots', type=int, default=20)
+        parser.add_argument(
+            '--storage',
+            nargs='+',
+            choices=[Comment.MPTT_STORAGE, Comment.PATH_STORAGE],
+            default=[Comment.MPTT_STORAGE, Comment.PATH_STORAGE],
+        )
+
+    def handle(self, *args, book_id, threads, writes, roots, storage, **options):
+        book = Book.objects.get(pk=book_id)
+        user = User.objects.order_by('pk').first()
+
+        for mode in storage:
+            with override_settings(COMMENT_TREE_STORAGE=mode):
+                parents = [
+                    Comment.objects.create(book=book, user=user, content=f'bench {mode} {i}')
+                    for i in range(roots)
+                ]
+                parent_ids = [parent.pk for parent in parents]
+
+                started = time.perf_counter()
+                with ThreadPoolExecutor(max_workers=threads) as executor:
+                    errors = sum(executor.map(
+                        lambda worker: self.write(book, user, parent_ids, writes, worker),
+                        range(threads),
+                    ))
+                elapsed = time.perf_counter() - started
+
+                Comment.objects.filter(pk__in=parent_ids).delete()
+
+            total = threads * writes - errors
+            self.stdout.write(
+                f'{mode}: {total} вставок за {elapsed:.2f} с, '
+                f'{total / elapsed:.1f} в секунду, ошибок {errors}'
+            )
+
+    @staticmethod
+    def write(book, user, parent_ids, writes, worker):
+        errors = 0
+        created = list(parent_ids)
+        try:
+            for i in range(writes):
+                try:
+                    reply = Comment.objects.create(
+                        book=book,
+                        user=user,
+                        content=f'reply {worker}-{i}',
+                        parent_id=random.choice(created),
+                    )
+                    created.append(reply.pk)
+                except Exception:
+                    errors += 1
+        finally:
+            connection.close()
+        return errors
@@ -0,0 +1,46 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.renderers import JSONRenderer
+
+from books.fieldsets import BookFieldset
+from books.models import Book
+from books.serializers import BookWithCommentSerializer
+from drf_project.renderers import FastJSONRenderer, orjson
+
+
+class Command(BaseCommand):
+    help = (
+        'Сравнивает JSONRenderer и FastJSONRenderer на карточках книг '
+        'BookWithCommentSerializer: проверяет совпадение вывода и замеряет рендеринг'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--books', type=int, default=100)
+        parser.add_argument('--iterations', type=int, default=200)
+
+    def handle(self, *args, books, iterations, **options):
+        if orjson is None:
+            self.stdout.write(self.style.WARNING('orjson не установлен, FastJSONRenderer работает как JSONRenderer'))
+
+        queryset = BookFieldset().narrow(Book.objects.order_by('id'))[:books]
+        data = BookWithCommentSerializer(queryset, many=True).data
+        if not data:
+            raise CommandError('Нет книг для замера')
+
+        renderers = {'json': JSONRenderer(), 'orjson': FastJSONRenderer()}
+        rendered = {name: renderer.render(data) for name, renderer in renderers.items()}
+        if rendered['json'] != rendered['orjson']:
+            raise CommandError('Вывод рендереров различается')
+
+        results = {}
+        for name, renderer in renderers.items():
+            started = time.perf_counter()
+            for _ in range(iterations):
+                renderer.render(data)
+            results[name] = (time.perf_counter() - started) / iterations
+            self.stdout.write(f'{name}: {results[name] * 1000:.3f} мс на {len(data)} книг')
+
+        size = len(rendered['json']) / 1024
+        speedup = results['json'] / results['orjson']
+        self.stdout.write(self.style.SUCCESS(f'Ответ {size:.1f} КБ, ускорение {speedup:.1f}x'))
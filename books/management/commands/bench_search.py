@@ -0,0 +1,128 @@
+import random
+import statistics
+import time
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from rest_framework.test import APIRequestFactory
+
+from books import search_backends
+from books.models import Author, Book, Genre
+from books.views import BookDocumentView
+
+WORDS = (
+    'война мир тайна сад ночь море город дорога дом зима лето память '
+    'звезда река песня время огонь ветер остров север история любовь '
+    'shadow garden river winter empire silence light night stone glass'
+).split()
+
+DEFAULT_QUERIES = ['война', 'тайна сада', 'ночь -море', '"ночной город"', 'winter light', 'история']
+
+
+class Command(BaseCommand):
+    help = (
+        'Сравнивает задержку поиска книг в Elasticsearch и в PostgreSQL на одних '
+        'и тех же запросах. С --seed добивает базу синтетическими книгами, '
+        'запускать только на копии базы.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seed', type=int, default=0, help='Сколько всего книг должно быть в базе')
+        parser.add_argument('--reindex', action='store_true', help='Перестроить индекс ES после --seed')
+        parser.add_argument('--queries', nargs='+', default=DEFAULT_QUERIES)
+        parser.add_argument('--iterations', type=int, default=50)
+        parser.add_argument('--warmup', type=int, default=5)
+        parser.add_argument('--page-size', type=int, default=10)
+        parser.add_argument(
+            '--backend',
+            nargs='+',
+            choices=[search_backends.ELASTICSEARCH, search_backends.POSTGRES],
+            default=[search_backends.ELASTICSEARCH, search_backends.POSTGRES],
+        )
+
+    def handle(self, *args, seed, reindex, queries, iterations, warmup, page_size, backend, **options):
+        if search_backends.POSTGRES in backend and not search_backends.is_postgres():
+            raise CommandError('Поиск в БД работает только в PostgreSQL')
+        if seed:
+            self.seed(seed)
+            call_command('rebuild_search_vectors', stdout=self.stdout)
+            if reindex:
+                call_command('reindex_books', stdout=self.stdout)
+
+        self.stdout.write(f'Книг в базе: {Book.objects.count()}')
+        backends = {
+            search_backends.ELASTICSEARCH: search_backends.elasticsearch,
+            search_backends.POSTGRES: search_backends.postgres,
+        }
+        totals = {name: [] for name in backend}
+        for query in queries:
+            for name in backend:
+                timings, count = self.measure(backends[name], query, iterations, warmup, page_size)
+                totals[name] += timings
+                self.stdout.write(f'{name:<13} {query!r:<20} найдено {count:>8}  {self.summary(timings)}')
+
+        for name, timings in totals.items():
+            self.stdout.write(self.style.SUCCESS(f'{name}: {self.summary(timings)}'))
+
+    def measure(self, backend, query, iterations, warmup, page_size):
+        factory = APIRequestFactory()
+        timings = []
+        count = None
+        for i in range(warmup + iterations):
+            view = BookDocumentView(action_map={'get': 'list'}, format_kwarg=None, args=(), kwargs={})
+            request = view.initialize_request(
+                factory.get('/api/v1/book-search/', {'search': query, 'page_size': page_size})
+            )
+            view.request = request
+            started = time.perf_counter()
+            response = backend.list(view, request)
+            elapsed = time.perf_counter() - started
+            count = response.data['count']
+            if i >= warmup:
+                timings.append(elapsed)
+        return timings, count
+
+    @staticmethod
+    def summary(timings):
+        percentiles = statistics.quantiles(timings, n=100)
+        p50, p95 = percentiles[49], percentiles[94]
+        return (
+            f'p50 {p50 * 1000:.1f} мс, p95 {p95 * 1000:.1f} мс, '
+            f'среднее {statistics.mean(timings) * 1000:.1f} мс'
+        )
+
+    def seed(self, total, batch_size=5000):
+        """
+        Синтетические книги bulk_create без сигналов outbox: названия и описания
+        из словаря, авторы и жанры из небольшого пула
+        """
+        missing = total - Book.objects.count()
+        if missing <= 0:
+            return
+        rng = random.Random(total)
+        genres = [Genre.objects.get_or_create(title=f'bench {i}')[0] for i in range(20)]
+        authors = [
+            Author.objects.get_or_create(name=f'Bench Author {i}')[0] for i in range(2000)
+        ]
+        created = 0
+        while created < missing:
+            size = min(batch_size, missing - created)
+            with transaction.atomic():
+                books = Book.objects.bulk_create([
+                    Book(
+                        title=' '.join(rng.sample(WORDS, rng.randint(1, 4))).capitalize(),
+                        description=' '.join(rng.choices(WORDS, k=30)),
+                        genre=rng.choice(genres),
+                        rating_count=rng.randint(0, 500),
+                    )
+                    for _ in range(size)
+                ])
+                Book.author.through.objects.bulk_create([
+                    Book.author.through(book_id=book.pk, author_id=author.pk)
+                    for book in books
+                    for author in rng.sample(authors, rng.randint(1, 2))
+                ])
+            created += size
+            self.stdout.write(f'Создано {created} из {missing} книг', ending='\r')
+        self.stdout.write('')
@@ -0,0 +1,67 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.renderers import JSONRenderer
+
+from books.fast_serializers import FastBookSerializer
+from books.fieldsets import BookFieldset
+from books.models import Book
+from books.serializers import BookSerializer
+
+
+class Command(BaseCommand):
+    help = (
+        'Сравнивает BookSerializer и FastBookSerializer на одной странице книг: '
+        'проверяет побайтовое совпадение JSON и замеряет время'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--page-size', type=int, default=100)
+        parser.add_argument('--iterations', type=int, default=50)
+        parser.add_argument('--min-speedup', type=float, default=3.0)
+        parser.add_argument(
+            '--fields',
+            help='Поля через запятую, как в ?fields=. Подпись ссылок на обложки '
+                 'стоит одинаково в обоих режимах, ее можно исключить из замера',
+        )
+
+    def handle(self, *args, page_size, iterations, min_speedup, fields, **options):
+        fields = {name.strip() for name in fields.split(',')} if fields else None
+        unknown = (fields or set()).difference(BookFieldset.MODEL_FIELDS)
+        if unknown:
+            raise CommandError(f'Неизвестные поля: {", ".join(sorted(unknown))}')
+        fieldset = BookFieldset(fields=fields)
+        base = Book.objects.order_by('id')
+        if base.count() < page_size:
+            self.stdout.write(self.style.WARNING(f'В базе меньше {page_size} книг'))
+
+        def regular():
+            page = list(fieldset.narrow(base)[:page_size])
+            return BookSerializer(page, many=True, context={'book_fieldset': fieldset}).data
+
+        def fast():
+            serializer = FastBookSerializer(fieldset)
+            page = list(serializer.values_queryset(base)[:page_size])
+            return serializer.serialize(page)
+
+        renderer = JSONRenderer()
+        if renderer.render(regular()) != renderer.render(fast()):
+            raise CommandError('Ответы сериализаторов различаются')
+
+        results = {name: self.measure(handler, iterations) for name, handler in (('drf', regular), ('fast', fast))}
+        for name, elapsed in results.items():
+            self.stdout.write(f'{name}: {elapsed * 1000:.2f} мс на страницу')
+
+        speedup = results['drf'] / results['fast']
+        message = f'Ускорение: {speedup:.1f}x'
+        if speedup < min_speedup:
+            raise CommandError(f'{message}, ожидалось не меньше {min_speedup}x')
+        self.stdout.write(self.style.SUCCESS(message))
+
+    @staticmethod
+    def measure(handler, iterations):
+        handler()
+        started = time.perf_counter()
+        for _ in range(iterations):
+            handler()
+        return (time.perf_counter() - started) / iterations
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+
+from books import search_sync
+
+
+class Command(BaseCommand):
+    help = 'Переносит накопленные в outbox изменения книг в индекс Elasticsearch'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=None)
+        parser.add_argument(
+            '--requeue-parked', action='store_true',
+            help='Вернуть в разбор строки, отложенные после отказов ES',
+        )
+
+    def handle(self, *args, batch_size, requeue_parked, **options):
+        if requeue_parked:
+            self.stdout.write(f'Возвращено в разбор: {search_sync.requeue_parked()}')
+        drained = 0
+        while True:
+            count = search_sync.drain(batch_size)
+            if not count:
+                break
+            drained += count
+
+        self.stdout.write(self.style.SUCCESS(f'Обработано записей outbox: {drained}'))
+        parked = search_sync.parked_count()
+        if parked:
+            self.stdout.write(self.style.WARNING(f'Отложено после отказов ES: {parked}'))
@@ -0,0 +1,59 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from books import covers
+from books.models import Book
+from books.tasks import process_book_cover
+
+
+class Command(BaseCommand):
+    help = 'Строит рендиции обложек для уже загруженных книг'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4)
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--force', action='store_true', help='Перестроить и уже обработанные обложки')
+        parser.add_argument('--enqueue', action='store_true', help='Отправить задачи в Celery вместо обработки здесь')
+
+    def handle(self, *args, workers, batch_size, force, enqueue, **options):
+        processed = failed = 0
+        last_id = 0
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while True:
+                books = list(
+                    Book.objects.filter(pk__gt=last_id).exclude(cover_image='')
+                    .order_by('pk').only('cover_image', 'cover_renditions')[:batch_size]
+                )
+                if not books:
+                    break
+                last_id = books[-1].pk
+
+                book_ids = [book.pk for book in books if force or covers.needs_processing(book)]
+                if enqueue:
+                    for book_id in book_ids:
+                        process_book_cover.delay(book_id, force=force)
+                    processed += len(book_ids)
+                    continue
+
+                for book_id, error in zip(book_ids, executor.map(lambda pk: self.process(pk, force), book_ids)):
+                    if error is None:
+                        processed += 1
+                    else:
+                        failed += 1
+                        self.stderr.write(f'Книга {book_id}: {error}')
+
+        action = 'Поставлено в очередь' if enqueue else 'Обработано'
+        self.stdout.write(self.style.SUCCESS(f'{action} обложек: {processed}, ошибок: {failed}'))
+
+    @staticmethod
+    def process(book_id, force):
+        try:
+            covers.process_cover(book_id, force=force)
+        except Exception as exc:
+            return exc
+        finally:
+            connection.close()
+        return None
@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+
+from books.models import Comment
+from books.services import CommentTreeService
+
+
+class Command(BaseCommand):
+    help = (
+        'Перестраивает хранение дерева комментариев. Перед переключением '
+        'COMMENT_TREE_STORAGE с path на mptt нужен --storage mptt. '
+        'С --counts только пересчитывает replies_count после массовых удалений'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--storage',
+            choices=[Comment.MPTT_STORAGE, Comment.PATH_STORAGE],
+            default=Comment.PATH_STORAGE,
+        )
+        parser.add_argument('--counts', action='store_true', help='Пересчитать только число ответов')
+
+    def handle(self, *args, storage, counts, **options):
+        if counts:
+            total = CommentTreeService.recount_replies()
+            self.stdout.write(self.style.SUCCESS(f'Число ответов пересчитано для комментариев: {total}'))
+            return
+
+        if storage == Comment.MPTT_STORAGE:
+            CommentTreeService.rebuild_mptt()
+            self.stdout.write(self.style.SUCCESS('Поля lft/rght/tree_id перестроены'))
+            return
+
+        total = CommentTreeService.rebuild_paths()
+        self.stdout.write(self.style.SUCCESS(f'Пути перестроены для комментариев: {total}'))
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from books import reindex, search_backends
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает векторы полнотекстового поиска книг в PostgreSQL пачками по pk'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=5000)
+
+    def handle(self, *args, chunk_size, **options):
+        if not search_backends.is_postgres():
+            raise CommandError('Векторы поиска есть только в PostgreSQL')
+
+        updated = 0
+        for lo, hi in reindex.chunk_ranges(chunk_size):
+            with transaction.atomic():
+                updated += search_backends.update_search_vectors_range(lo, hi)
+            self.stdout.write(f'{updated} книг', ending='\r')
+        self.stdout.write(self.style.SUCCESS(f'Векторы пересчитаны: {updated} книг'))
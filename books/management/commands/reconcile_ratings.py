@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+
+from books.models import Book
+from books.services import RatingAggregateService
+
+
+class Command(BaseCommand):
+    help = 'Сверяет сохраненные агрегаты рейтинга книг с таблицей оценок и исправляет расхождения'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--dry-run', action='store_true', help='Только показать расхождения')
+
+    def handle(self, *args, batch_size, dry_run, **options):
+        checked = 0
+        drifted = []
+        last_id = 0
+
+        while True:
+            book_ids = list(
+                Book.objects.filter(pk__gt=last_id).order_by('pk').values_list('pk', flat=True)[:batch_size]
+            )
+            if not book_ids:
+                break
+
+            drifted += RatingAggregateService.reconcile(book_ids, dry_run=dry_run)
+            checked += len(book_ids)
+            last_id = book_ids[-1]
+
+        if drifted:
+            self.stdout.write(f'Расхождения в книгах: {", ".join(map(str, drifted))}')
+
+        action = 'найдено' if dry_run else 'исправлено'
+        self.stdout.write(self.style.SUCCESS(f'Проверено книг: {checked}, {action}: {len(drifted)}'))
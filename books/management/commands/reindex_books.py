@@ -0,0 +1,88 @@
+import multiprocessing
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from books import reindex, search_cache, search_sync
+from books.models import Book
+
+
+class Command(BaseCommand):
+    help = (
+        'Перестраивает поисковый индекс книг без простоя: новый индекс заполняется '
+        'параллельно, затем алиас атомарно переключается на него'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4)
+        parser.add_argument('--chunk-size', type=int, default=5000, help='Книг на одно задание воркера')
+        parser.add_argument('--bulk-size', type=int, default=500, help='Документов в одном bulk-запросе')
+        parser.add_argument('--replicas', type=int, default=None)
+        parser.add_argument('--keep-old', action='store_true', help='Не удалять прежний индекс')
+        parser.add_argument(
+            '--timeout', type=int, default=reindex.REQUEST_TIMEOUT,
+            help='Таймаут refresh и forcemerge нового индекса, в секундах',
+        )
+
+    def handle(self, *args, workers, chunk_size, bulk_size, replicas, keep_old, timeout, **options):
+        if replicas is None:
+            replicas = search_sync.get_document()._index._settings.get('number_of_replicas', 1)
+
+        total = Book.objects.count()
+        name = reindex.new_index_name()
+        reindex.create_index(name)
+        self.stdout.write(f'Индекс {name}: {total} книг')
+
+        # Изменения во время перестроения копятся в outbox и после
+        # переключения алиаса разбираются уже в новый индекс
+        search_sync.pause()
+        try:
+            indexed = self.load(name, workers, chunk_size, bulk_size, total)
+            reindex.finish_index(name, replicas, timeout)
+            old = reindex.swap_alias(name)
+        except BaseException:
+            # Недостроенный индекс без алиаса никому не нужен
+            reindex.delete_index(name)
+            raise
+        finally:
+            search_sync.resume()
+        search_cache.bump_generation()
+
+        # Алиас уже указывает на новый индекс: дальше ничего не откатывается
+        if old and keep_old:
+            self.stdout.write(f'Прежние индексы сохранены: {", ".join(old)}')
+        elif old and reindex.delete_old_indices(old, timeout):
+            self.stdout.write(f'Прежние индексы удалены: {", ".join(old)}')
+        elif old:
+            self.stdout.write(self.style.WARNING(f'Прежние индексы не удалены: {", ".join(old)}'))
+        if not reindex.merge_index(name, timeout):
+            self.stdout.write(self.style.WARNING('Слияние сегментов продолжается в ES в фоне'))
+        caught_up = search_sync.drain_all()
+        self.stdout.write(self.style.SUCCESS(
+            f'Алиас {reindex.alias_name()} -> {name}: {indexed} документов, '
+            f'изменений из outbox: {caught_up}'
+        ))
+
+    def load(self, name, workers, chunk_size, bulk_size, total):
+        started = time.monotonic()
+        indexed = 0
+        jobs = [(name, lo, hi, bulk_size) for lo, hi in reindex.chunk_ranges(chunk_size)]
+
+        # Воркеры наследуют настроенный Django через fork; пока пул работает,
+        # родитель к БД не обращается, а воркеры открывают свои соединения
+        connections.close_all()
+        context = multiprocessing.get_context('fork')
+        with context.Pool(workers, initializer=reindex.init_worker) as pool:
+            for count in pool.imap_unordered(self.index_chunk, jobs):
+                indexed += count
+                elapsed = time.monotonic() - started
+                self.stdout.write(
+                    f'{indexed}/{total} ({indexed * 100 // max(total, 1)}%), '
+                    f'{indexed / elapsed:.0f} док/с'
+                )
+        return indexed
+
+    @staticmethod
+    def index_chunk(job):
+        return reindex.index_chunk(*job)
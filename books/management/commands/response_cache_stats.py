@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from books import search_cache
+from books.cache import get_stats, reset_stats
+
+
+class Command(BaseCommand):
+    help = 'Показывает счетчики попаданий и промахов кэша ответов'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help='Обнулить счетчики после вывода')
+        parser.add_argument('--search', action='store_true', help='Счетчики кэша поиска вместо API книг')
+
+    def handle(self, *args, reset, search, **options):
+        namespace = search_cache.STATS_NAMESPACE if search else 'rc'
+        stats = get_stats(namespace)
+        total = sum(stats.values())
+        served = stats['hit'] + stats['stale'] + stats['not_modified']
+
+        for event, value in stats.items():
+            self.stdout.write(f'{event}: {value}')
+        ratio = served / total if total else 0
+        self.stdout.write(self.style.SUCCESS(f'hit ratio: {ratio:.2%}'))
+
+        if reset:
+            reset_stats(namespace)
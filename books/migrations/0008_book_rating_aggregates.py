@@ -0,0 +1,80 @@
+# Generated by Django 5.0.6 on 2026-10-18 17:04
+
+from django.db import migrations, models
+from django.db.models import Count, Q, Sum
+
+HISTOGRAM_FIELDS = [f'rating_{value}_count' for value in range(1, 6)]
+
+
+def backfill_rating_aggregates(apps, schema_editor):
+    Book = apps.get_model('books', 'Book')
+    Rating = apps.get_model('books', 'Rating')
+
+    histogram = {f'rating_{value}_count': Count('id', filter=Q(rating=value)) for value in range(1, 6)}
+    rows = (
+        Rating.objects.order_by()
+        .values('book_id')
+        .annotate(rating_count=Count('id'), rating_sum=Sum('rating'), **histogram)
+    )
+
+    books = []
+    for row in rows.iterator(chunk_size=1000):
+        row['rating_average'] = row['rating_sum'] / row['rating_count']
+        books.append(Book(pk=row.pop('book_id'), **row))
+
+    Book.objects.bulk_update(
+        books,
+        ['rating_count', 'rating_sum', 'rating_average'] + HISTOGRAM_FIELDS,
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0007_alter_comment_user'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='book',
+            name='rating_1_count',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='rating_2_count',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='rating_3_count',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='rating_4_count',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='rating_5_count',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='rating_average',
+            field=models.FloatField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='rating_count',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='rating_sum',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(backfill_rating_aggregates, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.0.6 on 2026-10-18 17:06
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0008_book_rating_aggregates'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='readlist',
+            index=models.Index(fields=['user', '-date_added', '-id'], name='read_list_user_date_added_idx'),
+        ),
+    ]
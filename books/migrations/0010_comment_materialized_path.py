@@ -0,0 +1,43 @@
+# Generated by Django 5.0.6 on 2026-10-18 17:12
+
+from django.db import migrations, models
+from django.db.models import CharField, F, OuterRef, Subquery, Value
+from django.db.models.functions import Cast, Concat, LPad
+
+PATH_STEP = 10
+
+
+def fill_paths(apps, schema_editor):
+    Comment = apps.get_model('books', 'Comment')
+    segment = LPad(Cast('id', CharField()), PATH_STEP, Value('0'))
+    parents = Comment.objects.filter(pk=OuterRef('parent_id'))
+
+    updated = Comment.objects.filter(parent=None).update(path=segment)
+    while updated:
+        updated = Comment.objects.filter(path='', parent__path__gt='').update(
+            path=Concat(Subquery(parents.values('path')[:1]), segment),
+        )
+
+    # До миграции дерево хранилось только в mptt: потомков (rght - lft - 1) / 2
+    Comment.objects.update(replies_count=(F('rght') - F('lft') - 1) / 2)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0009_readlist_keyset_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='comment',
+            name='path',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=1000),
+        ),
+        migrations.AddField(
+            model_name='comment',
+            name='replies_count',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(fill_paths, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.6 on 2026-10-18 17:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0012_search_outbox'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='searchoutbox',
+            name='partial',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,54 @@
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations
+
+INDEXES = [
+    django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='book_search_vector_idx'),
+    django.contrib.postgres.indexes.GinIndex(
+        django.contrib.postgres.indexes.OpClass('title', name='gin_trgm_ops'), name='book_title_trgm_idx',
+    ),
+]
+
+
+def add_indexes(apps, schema_editor):
+    # GIN-индексы есть только в PostgreSQL; в других БД поиск по ним не используется
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    Book = apps.get_model('books', 'Book')
+    for index in INDEXES:
+        schema_editor.add_index(Book, index)
+
+
+def remove_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    Book = apps.get_model('books', 'Book')
+    for index in INDEXES:
+        schema_editor.remove_index(Book, index)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0013_searchoutbox_partial'),
+    ]
+
+    operations = [
+        # Вне PostgreSQL ничего не делает
+        TrigramExtension(),
+        migrations.AddField(
+            model_name='book',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        # Индексы всегда попадают в состояние миграций, а в схему - только в PostgreSQL
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.AddIndex(model_name='book', index=index) for index in INDEXES
+            ],
+            database_operations=[
+                migrations.RunPython(add_indexes, remove_indexes),
+            ],
+        ),
+    ]
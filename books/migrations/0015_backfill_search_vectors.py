@@ -0,0 +1,60 @@
+from django.conf import settings
+from django.contrib.postgres.aggregates import StringAgg
+from django.contrib.postgres.search import SearchVector
+from django.db import migrations, transaction
+from django.db.models import OuterRef, Subquery
+
+CHUNK_SIZE = 5000
+
+
+def book_vector(apps, config):
+    """
+    Вектор книги в том виде, какой он на этой схеме: название (A),
+    имена авторов (B), жанр (C), описание (D)
+    """
+    Book = apps.get_model('books', 'Book')
+    Genre = apps.get_model('books', 'Genre')
+    authors = (
+        Book.author.through.objects.filter(book_id=OuterRef('pk')).order_by().values('book_id')
+        .annotate(names=StringAgg('author__name', ' ')).values('names')
+    )
+    genre = Genre.objects.filter(pk=OuterRef('genre_id')).values('title')
+    vector = SearchVector('title', weight='A', config=config)
+    vector += SearchVector(Subquery(authors), weight='B', config=config)
+    vector += SearchVector(Subquery(genre), weight='C', config=config)
+    vector += SearchVector('description', weight='D', config=config)
+    return vector
+
+
+def backfill(apps, schema_editor):
+    """
+    Векторы уже существующих книг: без них запасной поиск в Postgres
+    ничего не находит. Пачками по pk, каждая в своей транзакции.
+    """
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    Book = apps.get_model('books', 'Book')
+    config = getattr(settings, 'SEARCH_BACKEND', {}).get('TEXT_CONFIG', 'russian')
+    vector = book_vector(apps, config)
+
+    last_id = 0
+    while True:
+        ids = Book.objects.filter(pk__gt=last_id).order_by('pk').values_list('pk', flat=True)
+        upper = next(iter(ids[CHUNK_SIZE - 1:CHUNK_SIZE]), None) or ids.last()
+        if upper is None:
+            return
+        with transaction.atomic():
+            Book.objects.filter(pk__gt=last_id, pk__lte=upper).update(search_vector=vector)
+        last_id = upper
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('books', '0014_book_search_vector'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.6 on 2026-10-18 18:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0015_backfill_search_vectors'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='searchoutbox',
+            name='vectorized',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.6 on 2026-10-18 18:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0016_searchoutbox_vectorized'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='searchoutbox',
+            name='attempts',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+    ]
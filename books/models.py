@@ -1,6 +1,8 @@
 from django.conf import settings
-from django.db import models
-from django.db.models import Avg
+from django.contrib.postgres.indexes import GinIndex, OpClass
+from django.contrib.postgres.search import SearchVectorField
+from django.db import models, transaction
+from django.db.models import F, Q
 from mptt.models import MPTTModel, TreeForeignKey
 
 
@@ -31,6 +33,17 @@ class Comment(MPTTModel):
         related_name='children'
     )
     level = models.IntegerField(default=0)
+    # Материализованный путь: id предков и самого узла по PATH_STEP цифр
+    path = models.CharField(max_length=1000, blank=True, db_index=True, editable=False)
+    # Число всех потомков. Каждый ответ увеличивает счетчики всех предков
+    # одним UPDATE, поэтому ответы в одну ветку сериализуются на строке корня.
+    # Массовые удаления (QuerySet.delete, действие админки) идут мимо delete()
+    # и счетчики не правят: после них нужен rebuild_comment_tree --counts
+    replies_count = models.IntegerField(default=0, editable=False)
+
+    MPTT_STORAGE = 'mptt'
+    PATH_STORAGE = 'path'
+    PATH_STEP = 10
 
     class MPTTMeta:
         order_insertion_by = ['content']
@@ -38,11 +51,86 @@ class Comment(MPTTModel):
     def __str__(self):
         return f'{self.user.username} - {self.book.title}'
 
+    @classmethod
+    def tree_storage(cls):
+        """
+        mptt - вложенные множества, вставка сдвигает lft/rght по всему дереву;
+        path - только материализованный путь, вставка трогает O(глубины) строк
+        """
+        return getattr(settings, 'COMMENT_TREE_STORAGE', cls.MPTT_STORAGE)
+
+    @classmethod
+    def tree_ordering(cls):
+        if cls.tree_storage() == cls.PATH_STORAGE:
+            return ['path']
+        return ['tree_id', 'lft']
+
+    @classmethod
+    def max_level(cls):
+        """
+        Наибольший уровень, чей путь помещается в поле path
+        """
+        return cls._meta.get_field('path').max_length // cls.PATH_STEP - 1
+
+    @classmethod
+    def path_segment(cls, pk):
+        return str(pk).zfill(cls.PATH_STEP)
+
+    def subtree_filter(self):
+        """
+        Условие на всех потомков узла (без самого узла)
+        """
+        if self.tree_storage() == self.PATH_STORAGE:
+            upper = str(int(self.path) + 1).zfill(len(self.path))
+            return Q(path__gt=self.path, path__lt=upper)
+        return Q(tree_id=self.tree_id, lft__gt=self.lft, rght__lt=self.rght)
+
+    def ancestor_ids(self):
+        step = self.PATH_STEP
+        return [int(self.path[i:i + step]) for i in range(0, len(self.path) - step, step)]
+
+    def save(self, *args, **kwargs):
+        adding = self._state.adding
+
+        # Обращение к parent кэширует родителя: по нему mptt выставляет level
+        # и при отключенных обновлениях дерева
+        parent_path = self.parent.path if adding and self.parent_id else ''
+
+        with transaction.atomic():
+            if self.tree_storage() == self.PATH_STORAGE:
+                with Comment.objects.disable_mptt_updates():
+                    super().save(*args, **kwargs)
+            else:
+                super().save(*args, **kwargs)
+
+            if adding:
+                self.path = parent_path + self.path_segment(self.pk)
+                Comment.objects.filter(pk=self.pk).update(path=self.path)
+                ancestors = self.ancestor_ids()
+                if ancestors:
+                    Comment.objects.filter(pk__in=ancestors).update(replies_count=F('replies_count') + 1)
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            self.refresh_from_db(fields=['path', 'replies_count'])
+            ancestors = self.ancestor_ids()
+            if ancestors:
+                Comment.objects.filter(pk__in=ancestors).update(
+                    replies_count=F('replies_count') - self.replies_count - 1
+                )
+            if self.tree_storage() == self.PATH_STORAGE:
+                # Потомков удалит CASCADE по parent, сдвигать lft/rght не нужно
+                return models.Model.delete(self, *args, **kwargs)
+            return super().delete(*args, **kwargs)
+
+
+RATING_VALUES = range(1, 6)
+
 
 class Rating(models.Model):
     book = models.ForeignKey('Book', on_delete=models.CASCADE)
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
-    rating = models.IntegerField(choices=[(i, i) for i in range(1, 6)], default=1)
+    rating = models.IntegerField(choices=[(i, i) for i in RATING_VALUES], default=1)
     created_at = models.DateTimeField(auto_now_add=True)
 
     class Meta:
@@ -60,15 +148,37 @@ class Book(models.Model):
     genre = models.ForeignKey(Genre, on_delete=models.CASCADE)
     description = models.TextField(blank=True)
     cover_image = models.ImageField(upload_to='book_covers/', blank=True)
+    # Карта рендиций обложки, см. books.covers.process_cover
+    cover_renditions = models.JSONField(default=dict, blank=True, editable=False)
+
+    # Денормализованные агрегаты рейтинга, см. RatingAggregateService
+    rating_count = models.IntegerField(default=0, editable=False)
+    rating_sum = models.IntegerField(default=0, editable=False)
+    rating_average = models.FloatField(null=True, blank=True, editable=False)
+    rating_1_count = models.IntegerField(default=0, editable=False)
+    rating_2_count = models.IntegerField(default=0, editable=False)
+    rating_3_count = models.IntegerField(default=0, editable=False)
+    rating_4_count = models.IntegerField(default=0, editable=False)
+    rating_5_count = models.IntegerField(default=0, editable=False)
+
+    # Взвешенный вектор полнотекстового поиска в PostgreSQL, см. books.search_backends
+    search_vector = SearchVectorField(null=True, editable=False)
+
+    class Meta:
+        indexes = [
+            GinIndex(fields=['search_vector'], name='book_search_vector_idx'),
+            GinIndex(OpClass('title', name='gin_trgm_ops'), name='book_title_trgm_idx'),
+        ]
 
     def __str__(self):
         return f'{self.id} - {self.title}'
 
     def average_rating(self):
-        ratings = self.rating_set.all()
-        if ratings.exists():
-            return ratings.aggregate(Avg('rating'))['rating__avg']
-        return None
+        return self.rating_average
+
+    @property
+    def rating_histogram(self):
+        return {str(value): getattr(self, f'rating_{value}_count') for value in RATING_VALUES}
 
 
 class ReadList(models.Model):
@@ -80,6 +190,28 @@ class ReadList(models.Model):
         constraints = [
             models.UniqueConstraint(fields=['user', 'book'], name='unique_read_list_entry')
         ]
+        indexes = [
+            models.Index(fields=['user', '-date_added', '-id'], name='read_list_user_date_added_idx')
+        ]
 
     def __str__(self):
         return f'{self.date_added} - {self.book}'
+
+
+class SearchOutbox(models.Model):
+    """
+    Книги, которые нужно переиндексировать в Elasticsearch.
+    Строки пишутся в той же транзакции, что и изменения, см. books.search_sync
+    """
+    book_id = models.IntegerField()
+    # Достаточно обновить только поля популярности, см. documents.SIGNAL_FIELDS
+    partial = models.BooleanField(default=False)
+    # Вектор поиска в PostgreSQL уже пересчитан, осталось отправить в ES
+    vectorized = models.BooleanField(default=False)
+    # Сколько раз ES отклонил документ книги; после MAX_ATTEMPTS строка
+    # откладывается и разбор ее больше не берет, см. search_sync.drain
+    attempts = models.PositiveSmallIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f'{self.created_at} - {self.book_id}'
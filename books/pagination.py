@@ -0,0 +1,247 @@
+import datetime
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+
+from django.core.exceptions import ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+from django_elasticsearch_dsl_drf.pagination import \
+    QueryFriendlyPageNumberPagination
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import (BasePagination, LimitOffsetPagination,
+                                       PageNumberPagination)
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
+
+from .search_facets import format_facets
+
+
+def positive_int(value, strict=False, cutoff=None):
+    """
+    Неотрицательное целое из строки параметра (strict - строго положительное),
+    не больше cutoff; иначе ValueError
+    """
+    value = int(value)
+    if value < 0 or (strict and value == 0):
+        raise ValueError(value)
+    if cutoff is not None:
+        return min(value, cutoff)
+    return value
+
+
+class KeysetPagination(BasePagination):
+    """
+    Keyset-пагинация: курсор хранит значения ключа сортировки крайней строки
+    страницы, поэтому нет ни OFFSET, ни COUNT(*)
+    """
+    cursor_query_param = 'cursor'
+    limit_query_param = 'limit'
+    default_limit = api_settings.PAGE_SIZE
+    max_limit = 100
+    invalid_cursor_message = 'Неверный курсор'
+
+    def __init__(self, ordering=('id',)):
+        self.ordering = tuple(ordering)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.base_url = request.build_absolute_uri()
+        self.limit = self.get_limit(request)
+        position, reverse = self.decode_cursor(request, queryset.model)
+
+        ordering = self._reversed(self.ordering) if reverse else self.ordering
+        queryset = queryset.order_by(*ordering)
+        if position is not None:
+            queryset = queryset.filter(self._after(ordering, position))
+
+        results = list(queryset[:self.limit + 1])
+        has_more = len(results) > self.limit
+        results = results[:self.limit]
+        if reverse:
+            results.reverse()
+
+        if reverse:
+            self.has_next, self.has_previous = position is not None, has_more
+        else:
+            self.has_next, self.has_previous = has_more, position is not None
+
+        self.page = results
+        return results
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'results': data,
+        })
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'previous': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
+
+    def get_limit(self, request):
+        try:
+            return positive_int(
+                request.query_params[self.limit_query_param],
+                strict=True,
+                cutoff=self.max_limit,
+            )
+        except (KeyError, ValueError):
+            return self.default_limit
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        return self.encode_cursor(self._position(self.page[-1]), reverse=False)
+
+    def get_previous_link(self):
+        if not self.has_previous or not self.page:
+            return None
+        return self.encode_cursor(self._position(self.page[0]), reverse=True)
+
+    def encode_cursor(self, position, reverse):
+        return replace_query_param(self.base_url, self.cursor_query_param, self.cursor_token(position, reverse))
+
+    @staticmethod
+    def cursor_token(position, reverse=False):
+        """
+        Значение параметра cursor для страницы после (или до, если reverse) position
+        """
+        # DjangoJSONEncoder обрезает datetime до миллисекунд, а ключу нужна точность БД
+        position = [
+            value.isoformat() if isinstance(value, datetime.datetime) else value
+            for value in position
+        ]
+        payload = {'p': position}
+        if reverse:
+            payload['r'] = 1
+        raw = json.dumps(payload, cls=DjangoJSONEncoder, separators=(',', ':'))
+        return urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+    def decode_cursor(self, request, model):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None, False
+
+        try:
+            payload = json.loads(urlsafe_b64decode(encoded + '=' * (-len(encoded) % 4)))
+            values = payload['p']
+            if len(values) != len(self.ordering):
+                raise ValueError
+            position = [
+                model._meta.get_field(field.lstrip('-')).to_python(value)
+                for field, value in zip(self.ordering, values)
+            ]
+        except (TypeError, ValueError, KeyError, ValidationError):
+            raise NotFound(self.invalid_cursor_message)
+
+        return position, bool(payload.get('r'))
+
+    def _position(self, item):
+        values = []
+        for field in self.ordering:
+            name = field.lstrip('-')
+            values.append(item[name] if isinstance(item, dict) else getattr(item, name))
+        return values
+
+    @staticmethod
+    def _reversed(ordering):
+        return tuple(field[1:] if field.startswith('-') else f'-{field}' for field in ordering)
+
+    @staticmethod
+    def _after(ordering, position):
+        """
+        Строки строго после position в порядке ordering:
+        a > va OR (a = va AND b > vb) ... Неравенство по первому полю
+        вынесено отдельно, чтобы планировщик мог взять диапазон по индексу.
+        """
+        lookups = [
+            (field.lstrip('-'), 'lt' if field.startswith('-') else 'gt')
+            for field in ordering
+        ]
+
+        condition = Q()
+        for i, (name, lookup) in enumerate(lookups):
+            equal = {prev_name: position[j] for j, (prev_name, _) in enumerate(lookups[:i])}
+            condition |= Q(**equal, **{f'{name}__{lookup}': position[i]})
+
+        first_name, first_lookup = lookups[0]
+        return Q(**{f'{first_name}__{first_lookup}e': position[0]}) & condition
+
+
+class OptionalKeysetPagination(LimitOffsetPagination):
+    """
+    По умолчанию limit/offset; keyset-режим включается параметром cursor
+    (для первой страницы достаточно пустого ?cursor=).
+    Порядок ключа задается атрибутом keyset_ordering у view.
+    """
+    default_keyset_ordering = ('id',)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.keyset = None
+        if KeysetPagination.cursor_query_param not in request.query_params:
+            return super().paginate_queryset(queryset, request, view)
+
+        ordering = getattr(view, 'keyset_ordering', self.default_keyset_ordering)
+        self.keyset = KeysetPagination(ordering)
+        return self.keyset.paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        if self.keyset is not None:
+            return self.keyset.get_paginated_response(data)
+        return super().get_paginated_response(data)
+
+    def get_next_link(self):
+        if self.keyset is not None:
+            return self.keyset.get_next_link()
+        return super().get_next_link()
+
+    def get_previous_link(self):
+        if self.keyset is not None:
+            return self.keyset.get_previous_link()
+        return super().get_previous_link()
+
+
+class SearchPagination(QueryFriendlyPageNumberPagination):
+    """
+    Страницы поиска: число найденных и фасеты берутся из того же ответа ES,
+    что и выдача, без отдельного запроса _count
+    """
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.view = view
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_facets(self, page=None):
+        page = page or self.page
+        return format_facets(getattr(page, 'facets', None), self.request, self.view)
+
+
+class DatabaseSearchPagination(PageNumberPagination):
+    """
+    Страницы поиска по БД (books.search_backends.PostgresBackend) в том же
+    формате, что SearchPagination: count, next, previous, facets, results
+    """
+    page_size_query_param = 'page_size'
+
+    def __init__(self, facets=None):
+        self.facets = facets
+
+    def get_paginated_response(self, data):
+        response = {
+            'count': self.page.paginator.count,
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+        }
+        if self.facets is not None:
+            response['facets'] = self.facets
+        response['results'] = data
+        return Response(response)
@@ -0,0 +1,147 @@
+import logging
+
+from django.conf import settings
+from django.db import connections as db_connections
+from django.utils import timezone
+from elasticsearch.exceptions import ConnectionTimeout, TransportError
+from elasticsearch.helpers import bulk
+from elasticsearch_dsl.connections import connections
+
+from .models import Book
+from .search_sync import get_document
+
+logger = logging.getLogger(__name__)
+
+# На время загрузки новый индекс не обновляется и не реплицируется
+BULK_LOAD_SETTINGS = {'refresh_interval': '-1', 'number_of_replicas': 0}
+# Таймаут служебных запросов к индексу целиком, в секундах
+REQUEST_TIMEOUT = 600
+
+
+def alias_name():
+    return get_document()._index._name
+
+
+def new_index_name():
+    return f'{alias_name()}-{timezone.now():%Y%m%d%H%M%S%f}'
+
+
+def create_index(name):
+    """
+    Новый индекс с маппингом BookDocument и настройками для массовой загрузки
+    """
+    index = get_document()._index.clone(name=name)
+    index.settings(**BULK_LOAD_SETTINGS)
+    index.create()
+    return index
+
+
+def finish_index(name, replicas, timeout=REQUEST_TIMEOUT):
+    """
+    Возвращает индексу обычные настройки после загрузки. На большом индексе
+    refresh идет дольше таймаута клиента по умолчанию, поэтому свой таймаут.
+    """
+    client = get_document()._get_connection()
+    client.indices.put_settings(
+        index=name,
+        body={'index': {'refresh_interval': None, 'number_of_replicas': replicas}},
+        request_timeout=timeout,
+    )
+    client.indices.refresh(index=name, request_timeout=timeout)
+
+
+def merge_index(name, timeout=REQUEST_TIMEOUT):
+    """
+    Сливает сегменты индекса, который уже обслуживает поиск. Если ответ
+    не пришел за timeout, слияние продолжается в ES, а ошибка только в логе.
+    """
+    try:
+        get_document()._get_connection().indices.forcemerge(
+            index=name, max_num_segments=5, request_timeout=timeout,
+        )
+    except (ConnectionTimeout, TransportError) as exc:
+        logger.warning('reindex: forcemerge %s не дождался ответа ES: %s', name, exc)
+        return False
+    return True
+
+
+def delete_index(name):
+    get_document()._get_connection().indices.delete(index=name, ignore=(404,))
+
+
+def chunk_ranges(chunk_size):
+    """
+    Диапазоны (lo, hi] первичных ключей книг по chunk_size штук.
+    Граница каждого диапазона находится одним запросом по индексу pk
+    со смещением не больше chunk_size, в память читаются только границы.
+    """
+    last_id = 0
+    while True:
+        ids = Book.objects.filter(pk__gt=last_id).order_by('pk').values_list('pk', flat=True)
+        upper = next(iter(ids[chunk_size - 1:chunk_size]), None)
+        if upper is None:
+            upper = ids.last()
+            if upper is not None:
+                yield last_id, upper
+            return
+        yield last_id, upper
+        last_id = upper
+
+
+def init_worker():
+    """
+    Воркер пула получает копию процесса после fork: соединения с БД
+    и Elasticsearch родителя использовать нельзя
+    """
+    db_connections.close_all()
+    connections.remove_connection('default')
+    connections.configure(**settings.ELASTICSEARCH_DSL)
+
+
+def index_chunk(index_name, lo, hi, bulk_size=500):
+    """
+    Индексирует книги с pk в (lo, hi] в index_name. Возвращает число документов.
+    """
+    document = get_document()
+    books = document.get_queryset().filter(pk__gt=lo, pk__lte=hi).order_by('pk')
+    actions = (
+        {'_index': index_name, '_id': book.pk, '_source': document.prepare(book)}
+        for book in books.iterator(chunk_size=bulk_size)
+        if document.should_index_object(book)
+    )
+    indexed, _ = bulk(document._get_connection(), actions, chunk_size=bulk_size, refresh=False)
+    return indexed
+
+
+def swap_alias(name):
+    """
+    Атомарно переключает алиас на индекс name. Индекс со старой схемы,
+    названный как алиас, удаляется в том же запросе. Возвращает прежние индексы.
+    """
+    client = get_document()._get_connection()
+    alias = alias_name()
+    actions = []
+    old = []
+    if client.indices.exists_alias(name=alias):
+        old = [index for index in client.indices.get_alias(name=alias) if index != name]
+        actions += [{'remove': {'index': index, 'alias': alias}} for index in old]
+    elif client.indices.exists(index=alias):
+        actions.append({'remove_index': {'index': alias}})
+    actions.append({'add': {'index': name, 'alias': alias}})
+    client.indices.update_aliases(body={'actions': actions})
+    return old
+
+
+def delete_old_indices(old, timeout=REQUEST_TIMEOUT):
+    """
+    Удаляет прежние индексы после переключения алиаса. Поиск уже идет
+    по новому индексу, поэтому ошибка только пишется в лог.
+    """
+    try:
+        get_document()._get_connection().indices.delete(
+            index=','.join(old), ignore=(404,), request_timeout=timeout,
+        )
+    except (ConnectionTimeout, TransportError) as exc:
+        logger.warning('reindex: прежние индексы %s не удалены: %s', ', '.join(old), exc)
+        return False
+    return True
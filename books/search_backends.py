@@ -0,0 +1,308 @@
+import logging
+import time
+
+from django.conf import settings
+from django.contrib.postgres.aggregates import StringAgg
+from django.contrib.postgres.search import (SearchQuery, SearchRank,
+                                            SearchVector, TrigramSimilarity)
+from django.core.cache import cache
+from django.db import connection
+from django.db.models import Count, OuterRef, Q, Subquery
+from elasticsearch.exceptions import ConnectionError as ESConnectionError
+from elasticsearch.exceptions import TransportError
+from rest_framework.response import Response
+
+from . import autocomplete
+from .fast_serializers import FastBookSerializer
+from .fieldsets import BookFieldset
+from .models import Book, Genre
+from .pagination import DatabaseSearchPagination
+from .search_facets import facet_items, selected_values
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    # elasticsearch - основной поиск, postgres - только полнотекстовый поиск БД
+    'BACKEND': 'elasticsearch',
+    # Уходить ли в Postgres, когда ES недоступен
+    'FAILOVER': True,
+    # Сколько ошибок ES за FAILURE_WINDOW секунд размыкают цепь
+    'FAILURE_THRESHOLD': 5,
+    'FAILURE_WINDOW': 30,
+    # Сколько секунд цепь разомкнута до пробного запроса в ES
+    'RESET_TIMEOUT': 30,
+    # Сколько секунд пробный запрос закрывает дорогу другим пробам
+    'PROBE_TIMEOUT': 10,
+    'TEXT_CONFIG': 'russian',
+    'SUGGEST_SIZE': 5,
+    'SIMILARITY_THRESHOLD': 0.3,
+    # Ответы запасного поиска кэшируются ненадолго, чтобы после
+    # восстановления ES выдача быстро вернулась к его ранжированию
+    'FALLBACK_CACHE_TIMEOUT': 15,
+}
+
+ELASTICSEARCH = 'elasticsearch'
+POSTGRES = 'postgres'
+
+# Поля фасетов в БД для тех же параметров, что у BookDocumentView.facet_fields
+FACET_LOOKUPS = {
+    'genre': 'genre__title',
+    'author': 'author__name',
+}
+
+
+def get_config():
+    return {**DEFAULTS, **getattr(settings, 'SEARCH_BACKEND', {})}
+
+
+def is_postgres():
+    return connection.vendor == 'postgresql'
+
+
+def search_vector(config=None):
+    """
+    Взвешенный вектор книги: название (A), имена авторов (B), жанр (C), описание (D)
+    """
+    config = config or get_config()['TEXT_CONFIG']
+    authors = (
+        Book.author.through.objects.filter(book_id=OuterRef('pk')).order_by().values('book_id')
+        .annotate(names=StringAgg('author__name', ' ')).values('names')
+    )
+    genre = Genre.objects.filter(pk=OuterRef('genre_id')).values('title')
+    vector = SearchVector('title', weight='A', config=config)
+    vector += SearchVector(Subquery(authors), weight='B', config=config)
+    vector += SearchVector(Subquery(genre), weight='C', config=config)
+    vector += SearchVector('description', weight='D', config=config)
+    return vector
+
+
+def update_search_vectors(book_ids=None):
+    """
+    Пересчитывает хранимые векторы книг (всех, если book_ids не передан).
+    Вне PostgreSQL ничего не делает. Возвращает число обновленных книг.
+    """
+    if not is_postgres():
+        return 0
+    queryset = Book.objects.all()
+    if book_ids is not None:
+        queryset = queryset.filter(pk__in=book_ids)
+    return queryset.update(search_vector=search_vector())
+
+
+def update_search_vectors_range(lo, hi):
+    """
+    То же для книг с pk в (lo, hi], см. books.reindex.chunk_ranges
+    """
+    if not is_postgres():
+        return 0
+    return Book.objects.filter(pk__gt=lo, pk__lte=hi).update(search_vector=search_vector())
+
+
+class ElasticsearchBackend:
+    """
+    Поиск через BookDocumentView: фильтры, ранжирование и фасеты ES
+    """
+    name = ELASTICSEARCH
+
+    def list(self, view, request):
+        mode = request.query_params.get(view.mode_query_param, view.SOURCE_MODE)
+        serializer = FastBookSerializer(BookFieldset.from_request(request), request)
+
+        queryset = view.filter_queryset(view.get_queryset())
+        if mode == view.HYDRATED_MODE:
+            # Из ES нужны только id, карточки строятся из БД
+            queryset = queryset.source(False)
+        page = view.paginate_queryset(queryset)
+        hits = page if page is not None else queryset.execute()
+
+        if mode == view.HYDRATED_MODE:
+            data = serializer.hydrate([int(hit.meta.id) for hit in hits])
+        else:
+            data = serializer.from_source({**hit.to_dict(), 'id': int(hit.meta.id)} for hit in hits)
+
+        if page is not None:
+            return view.get_paginated_response(data)
+        return Response(data)
+
+    def suggest(self, view, request):
+        queryset = view.filter_queryset(view.get_queryset())
+        if not getattr(queryset, '_suggest', None):
+            return Response(status=400)
+        return Response(view.paginate_queryset(queryset))
+
+
+class PostgresBackend:
+    """
+    Полнотекстовый поиск по хранимому tsvector книги (GIN-индекс),
+    ранжирование ts_rank с досортировкой по числу оценок. Фасеты
+    считаются так же, как в ES: выбор в фасете не сужает его собственные
+    счетчики. Подсказки - по триграммам названия. Формат ответов тот же,
+    что у ES, поэтому клиенты не замечают переключения.
+    """
+    name = POSTGRES
+
+    def list(self, view, request):
+        config = get_config()
+        serializer = FastBookSerializer(BookFieldset.from_request(request), request)
+
+        queryset = Book.objects.all()
+        text = request.query_params.get('search', '').strip()
+        if text:
+            query = SearchQuery(text, search_type='websearch', config=config['TEXT_CONFIG'])
+            queryset = (
+                queryset.filter(search_vector=query)
+                .annotate(rank=SearchRank('search_vector', query))
+                .order_by('-rank', '-rating_count', 'id')
+            )
+        else:
+            queryset = queryset.order_by('-rating_count', 'id')
+
+        selected = selected_values(request, view)
+        filters = {name: self.facet_filter(name, values) for name, values in selected.items()}
+        facets = {}
+        for name in view.facet_fields:
+            others = [condition for other, condition in filters.items() if other != name]
+            counts = self.facet_counts(name, queryset.filter(*others), view.facet_size)
+            facets[name] = facet_items(counts, selected.get(name, ()))
+
+        paginator = DatabaseSearchPagination(facets)
+        rows = paginator.paginate_queryset(
+            serializer.values_queryset(queryset.filter(*filters.values())), request, view
+        )
+        return paginator.get_paginated_response(serializer.serialize(rows))
+
+    @staticmethod
+    def facet_filter(name, values):
+        if name == 'author':
+            # Через подзапрос, чтобы соединение с авторами не размножало книги
+            return Q(pk__in=Book.author.through.objects.filter(author__name__in=values).values('book_id'))
+        return Q(**{f'{FACET_LOOKUPS[name]}__in': values})
+
+    @staticmethod
+    def facet_counts(name, queryset, size):
+        book_ids = queryset.order_by().values('pk')
+        if name == 'author':
+            rows = Book.author.through.objects.filter(book_id__in=book_ids)
+            lookup = 'author__name'
+        else:
+            rows = Book.objects.filter(pk__in=book_ids)
+            lookup = FACET_LOOKUPS[name]
+        counts = rows.values(lookup).annotate(count=Count('*')).order_by('-count', lookup)[:size]
+        return [(row[lookup], row['count']) for row in counts]
+
+    def suggest(self, view, request):
+        params = [param for param in request.query_params if param in autocomplete.QUERY_PARAMS]
+        text = request.query_params.get(params[0], '').strip() if params else ''
+        if not text:
+            return Response(status=400)
+
+        config = get_config()
+        found = (
+            Book.objects.annotate(similarity=TrigramSimilarity('title', text))
+            .filter(Q(title__istartswith=text) | Q(similarity__gte=config['SIMILARITY_THRESHOLD']))
+            .order_by('-similarity', '-rating_count', 'id')
+            .values_list('id', 'title', 'rating_count')[:config['SUGGEST_SIZE']]
+        )
+        return Response(autocomplete.completion_response(params[0], text, found))
+
+
+class CircuitBreaker:
+    """
+    Предохранитель перед ES. Состояние в общем кэше, поэтому его видят
+    все воркеры: FAILURE_THRESHOLD ошибок подключения или 5xx за
+    FAILURE_WINDOW секунд размыкают цепь, и запросы на RESET_TIMEOUT секунд
+    уходят в запасной поиск. Затем один запрос пропускается в ES пробным:
+    успех замыкает цепь, ошибка размыкает ее снова. Ошибки запроса (4xx)
+    цепь не размыкают.
+    """
+
+    def __init__(self, name):
+        self.failures_key = f'search-breaker:{name}:failures'
+        self.open_key = f'search-breaker:{name}:open-until'
+        self.probe_key = f'search-breaker:{name}:probe'
+
+    def state(self):
+        """
+        closed, open или half-open; в half-open один вызывающий получает пробу
+        """
+        values = cache.get_many([self.open_key, self.failures_key])
+        until = values.get(self.open_key)
+        if until is None:
+            return 'closed', values
+        if time.time() < until:
+            return 'open', values
+        return 'half-open', values
+
+    def call(self, primary, fallback):
+        state, values = self.state()
+        if state == 'open' or (state == 'half-open' and not cache.add(self.probe_key, True, timeout=get_config()['PROBE_TIMEOUT'])):
+            return fallback()
+
+        try:
+            result = primary()
+        except (ESConnectionError, TransportError) as exc:
+            if not self.is_failure(exc):
+                raise
+            logger.warning('search breaker: ошибка ES, запрос отдан запасному поиску: %s', exc)
+            self.record_failure(trip=state == 'half-open')
+            return fallback()
+
+        if values:
+            self.reset()
+        return result
+
+    @staticmethod
+    def is_failure(exc):
+        status = exc.status_code if isinstance(exc.status_code, int) else None
+        return isinstance(exc, ESConnectionError) or status is None or status >= 500
+
+    def record_failure(self, trip=False):
+        config = get_config()
+        if not cache.add(self.failures_key, 1, timeout=config['FAILURE_WINDOW']):
+            try:
+                failures = cache.incr(self.failures_key)
+            except ValueError:
+                failures = 1
+        else:
+            failures = 1
+        if trip or failures >= config['FAILURE_THRESHOLD']:
+            logger.error('search breaker: цепь разомкнута на %s с', config['RESET_TIMEOUT'])
+            cache.set(self.open_key, time.time() + config['RESET_TIMEOUT'], timeout=None)
+            cache.delete_many([self.failures_key, self.probe_key])
+
+    def reset(self):
+        cache.delete_many([self.failures_key, self.open_key, self.probe_key])
+
+
+elasticsearch = ElasticsearchBackend()
+postgres = PostgresBackend()
+breaker = CircuitBreaker(ELASTICSEARCH)
+
+
+def dispatch(action, view, request):
+    """
+    Выполняет действие поиска (list или suggest) в настроенном бэкенде;
+    при FAILOVER ошибки ES уводят запрос в Postgres через предохранитель.
+    Бэкенд, ответивший на запрос, указан в заголовке X-Search-Backend
+    и в view.search_backend.
+    """
+    config = get_config()
+    used = []
+
+    def run(backend):
+        used.append(backend.name)
+        return getattr(backend, action)(view, request)
+
+    if config['BACKEND'] == POSTGRES:
+        response = run(postgres)
+    elif config['FAILOVER']:
+        response = breaker.call(lambda: run(elasticsearch), lambda: run(postgres))
+    else:
+        response = run(elasticsearch)
+    view.search_backend = used[-1]
+    response['X-Search-Backend'] = used[-1]
+    return response
+
+
+def is_fallback(view):
+    return getattr(view, 'search_backend', None) == POSTGRES and get_config()['BACKEND'] != POSTGRES
@@ -0,0 +1,70 @@
+import hashlib
+import re
+from urllib.parse import urlencode
+
+from django.conf import settings
+
+from .cache import invalidate_tags
+
+DEFAULTS = {
+    'TIMEOUT': 120,
+    # Время жизни по действию; подсказки меняются реже выдачи
+    'TIMEOUTS': {'suggest': 600},
+    # Дальние страницы запрашивают редко, держать их долго незачем
+    'DEEP_PAGE': 5,
+    'DEEP_PAGE_TIMEOUT': 30,
+    # Сбрасывать ли кэш на частичных обновлениях популярности
+    'BUMP_ON_SIGNALS': False,
+}
+
+STATS_NAMESPACE = 'sc'
+# Поколение индекса книг: сдвигается при каждой записи в индекс
+INDEX_TAG = 'search-index'
+
+# Параметры, значения которых - списки через запятую без порядка
+LIST_PARAMS = ('fields', 'expand')
+TEXT_PARAMS = ('search',)
+DEFAULT_PARAMS = {'page': '1', 'mode': 'source'}
+
+
+def get_config():
+    return {**DEFAULTS, **getattr(settings, 'SEARCH_CACHE', {})}
+
+
+def bump_generation():
+    invalidate_tags(INDEX_TAG)
+
+
+def normalize_params(query_params):
+    """
+    Параметры поиска без различий, которые не меняют ответ ES:
+    регистр и пробелы в тексте запроса, порядок параметров и полей,
+    пустые значения и значения по умолчанию
+    """
+    params = set()
+    for key in query_params:
+        for value in query_params.getlist(key):
+            value = value.strip()
+            if key in TEXT_PARAMS:
+                value = re.sub(r'\s+', ' ', value.casefold())
+            elif key in LIST_PARAMS:
+                value = ','.join(sorted({name.strip() for name in value.split(',') if name.strip()}))
+            if value and DEFAULT_PARAMS.get(key) != value:
+                params.add((key, value))
+    return sorted(params)
+
+
+def cache_key(request):
+    normalized = f'{request.path}?{urlencode(normalize_params(request.query_params))}'
+    return 'sc:resp:' + hashlib.sha1(normalized.encode()).hexdigest()
+
+
+def timeout(request, action):
+    config = get_config()
+    try:
+        page = int(request.query_params.get('page', 1))
+    except ValueError:
+        page = 1
+    if page >= config['DEEP_PAGE']:
+        return config['DEEP_PAGE_TIMEOUT']
+    return config['TIMEOUTS'].get(action, config['TIMEOUT'])
@@ -0,0 +1,74 @@
+from elasticsearch_dsl import A, Q
+from rest_framework.filters import BaseFilterBackend
+
+
+def selected_values(request, view):
+    """
+    Выбранные значения фасетов: ?genre=A&genre=B&author=C
+    """
+    selected = {}
+    for name in view.facet_fields:
+        values = sorted({value.strip() for value in request.query_params.getlist(name) if value.strip()})
+        if values:
+            selected[name] = values
+    return selected
+
+
+class FacetFilterBackend(BaseFilterBackend):
+    """
+    Фасеты view.facet_fields {параметр: keyword-поле} в том же запросе, что и выдача.
+    Выбранные значения применяются как post_filter: внутри фасета через ИЛИ,
+    между фасетами через И. Агрегация каждого фасета учитывает выбор во всех
+    остальных, но не в нем самом, поэтому его счетчики показывают, сколько
+    книг добавит или оставит каждое значение.
+    """
+
+    def filter_queryset(self, request, queryset, view):
+        if view.action != 'list':
+            return queryset
+
+        selected = selected_values(request, view)
+        filters = {
+            name: Q('terms', **{view.facet_fields[name]: values})
+            for name, values in selected.items()
+        }
+        if filters:
+            queryset = queryset.post_filter('bool', filter=list(filters.values()))
+
+        for name, field in view.facet_fields.items():
+            others = [query for other, query in filters.items() if other != name]
+            scope = A('filter', Q('bool', filter=others) if others else Q('match_all'))
+            scope.bucket(name, 'terms', field=field, size=view.facet_size)
+            queryset.aggs.bucket(name, scope)
+        return queryset
+
+
+def format_facets(aggregations, request, view):
+    """
+    {'genre': [{'value': ..., 'count': ..., 'selected': ...}], ...};
+    выбранные значения без книг тоже попадают в список, чтобы выбор
+    можно было снять
+    """
+    if aggregations is None:
+        return None
+
+    aggregations = aggregations.to_dict()
+    selected = selected_values(request, view)
+    return {
+        name: facet_items(
+            [(bucket['key'], bucket['doc_count']) for bucket in aggregations[name][name]['buckets']],
+            selected.get(name, ()),
+        )
+        for name in view.facet_fields if name in aggregations
+    }
+
+
+def facet_items(counts, chosen):
+    """
+    counts - пары (значение, число книг) по убыванию числа
+    """
+    chosen = set(chosen)
+    items = [{'value': value, 'count': count, 'selected': value in chosen} for value, count in counts]
+    seen = {value for value, _ in counts}
+    items += [{'value': value, 'count': 0, 'selected': True} for value in sorted(chosen - seen)]
+    return items
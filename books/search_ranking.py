@@ -0,0 +1,64 @@
+from django.conf import settings
+from elasticsearch_dsl import Q
+
+DEFAULTS = {
+    # Итоговая оценка: релевантность * (1 + сумма взвешенных сигналов)
+    'RATING_WEIGHT': 1.0,
+    'VOTES_WEIGHT': 0.5,
+    'READERS_WEIGHT': 0.5,
+    'RECENCY_WEIGHT': 1.0,
+    # Через RECENCY_SCALE после последней активности сигнал свежести падает до RECENCY_DECAY
+    'RECENCY_SCALE': '30d',
+    'RECENCY_DECAY': 0.5,
+}
+
+
+def get_config():
+    return {**DEFAULTS, **getattr(settings, 'SEARCH_RANKING', {})}
+
+
+def functions(config=None):
+    config = config or get_config()
+    return [
+        {'weight': 1},
+        {
+            # Средняя оценка, приведенная к 0..1
+            'field_value_factor': {'field': 'rating_average', 'factor': 0.2, 'missing': 0},
+            'weight': config['RATING_WEIGHT'],
+        },
+        {
+            'field_value_factor': {'field': 'rating_count', 'modifier': 'log1p', 'missing': 0},
+            'weight': config['VOTES_WEIGHT'],
+        },
+        {
+            'field_value_factor': {'field': 'readers_count', 'modifier': 'log1p', 'missing': 0},
+            'weight': config['READERS_WEIGHT'],
+        },
+        {
+            # Без фильтра функции затухания дают книгам без активности максимум
+            'filter': {'exists': {'field': 'last_activity'}},
+            'gauss': {
+                'last_activity': {
+                    'origin': 'now',
+                    'scale': config['RECENCY_SCALE'],
+                    'decay': config['RECENCY_DECAY'],
+                },
+            },
+            'weight': config['RECENCY_WEIGHT'],
+        },
+    ]
+
+
+def rank(search):
+    """
+    Оборачивает запрос поиска в function_score с сигналами популярности
+    """
+    query = search.query._proxied or Q('match_all')
+    search.query = Q(
+        'function_score',
+        query=query,
+        functions=functions(),
+        score_mode='sum',
+        boost_mode='multiply',
+    )
+    return search
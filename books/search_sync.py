@@ -0,0 +1,206 @@
+import logging
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F
+from elasticsearch.helpers import bulk
+
+from . import autocomplete, search_backends, search_cache
+from .models import Book, SearchOutbox
+
+DEFAULTS = {
+    'BATCH_SIZE': 500,
+    'DRAIN_INTERVAL': 2,
+    # Сколько пачек задача разбирает за один запуск
+    'MAX_BATCHES': 20,
+    # Пауза разбора на время перестроения индекса снимается сама по таймауту
+    'PAUSE_TIMEOUT': 3600,
+    # После стольких отказов ES по документу строка outbox откладывается
+    'MAX_ATTEMPTS': 5,
+}
+
+logger = logging.getLogger(__name__)
+
+PAUSE_KEY = 'search-outbox:paused'
+
+
+def get_config():
+    return {**DEFAULTS, **getattr(settings, 'SEARCH_OUTBOX', {})}
+
+
+def get_document():
+    from .documents import BookDocument
+
+    return BookDocument()
+
+
+def record(book_ids, partial=False):
+    """
+    Отмечает книги для переиндексации. Вызывается внутри транзакции
+    изменения, поэтому отметка фиксируется или откатывается вместе с ним.
+    partial - изменились только оценки, читатели или активность.
+    """
+    book_ids = {pk for pk in book_ids if pk is not None}
+    if book_ids:
+        SearchOutbox.objects.bulk_create(
+            [SearchOutbox(book_id=pk, partial=partial) for pk in book_ids],
+            batch_size=get_config()['BATCH_SIZE'],
+        )
+
+
+def record_signals(book_ids):
+    record(book_ids, partial=True)
+
+
+def pause(timeout=None):
+    """
+    Останавливает разбор outbox, например на время перестроения индекса:
+    изменения копятся и попадают уже в новый индекс
+    """
+    cache.set(PAUSE_KEY, True, timeout=timeout or get_config()['PAUSE_TIMEOUT'])
+
+
+def resume():
+    cache.delete(PAUSE_KEY)
+
+
+def is_paused():
+    return bool(cache.get(PAUSE_KEY))
+
+
+def drain(batch_size=None):
+    """
+    Разбирает одну пачку outbox: каждая книга индексируется один раз
+    за пачку, удаленные книги удаляются из индекса, а у книг с одними
+    partial-отметками обновляются только поля популярности. Все одним
+    bulk-запросом.
+    Строки удаляются только после успешного ответа Elasticsearch, иначе
+    транзакция откатывается и пачка будет разобрана повторно. Книги,
+    документы которых ES отклонил, остаются в outbox со счетчиком попыток,
+    после MAX_ATTEMPTS откладываются и не задерживают остальные. Когда поиск
+    работает только в Postgres, строки снимаются без записи в ES.
+    Параллельные воркеры пропускают строки, заблокированные друг другом.
+    Перед этим пересчитываются векторы поиска в PostgreSQL, см. update_vectors.
+    Возвращает число разобранных строк; на паузе ничего не разбирает.
+    """
+    batch_size = batch_size or get_config()['BATCH_SIZE']
+    update_vectors(batch_size)
+    if is_paused():
+        return 0
+
+    max_attempts = get_config()['MAX_ATTEMPTS']
+
+    with transaction.atomic():
+        rows = list(
+            SearchOutbox.objects.select_for_update(skip_locked=True)
+            .filter(attempts__lt=max_attempts)
+            .order_by('id').values_list('id', 'book_id', 'partial')[:batch_size]
+        )
+        if not rows:
+            return 0
+
+        book_ids = {book_id for _, book_id, partial in rows if not partial}
+        signal_ids = {book_id for _, book_id, partial in rows if partial} - book_ids
+        failed = set()
+        if search_backends.get_config()['BACKEND'] != search_backends.POSTGRES:
+            failed = index_changes(book_ids, signal_ids)
+        changed = book_ids | signal_ids
+        transaction.on_commit(lambda: autocomplete.publish(changed))
+        if book_ids or search_cache.get_config()['BUMP_ON_SIGNALS']:
+            search_cache.bump_generation()
+
+        SearchOutbox.objects.filter(
+            id__in=[pk for pk, book_id, _ in rows if book_id not in failed]
+        ).delete()
+        if failed:
+            failed_rows = SearchOutbox.objects.filter(id__in=[pk for pk, book_id, _ in rows if book_id in failed])
+            failed_rows.update(attempts=F('attempts') + 1)
+            parked = sorted(failed_rows.filter(attempts__gte=max_attempts).values_list('book_id', flat=True))
+            if parked:
+                logger.error('search outbox: книги %s отложены после %s отказов ES', parked, max_attempts)
+    return len(rows)
+
+
+def update_vectors(batch_size):
+    """
+    Пересчитывает векторы поиска в PostgreSQL для книг из полных отметок
+    outbox и помечает строки. Своя транзакция: векторы обновляются, даже
+    если ES недоступен или разбор на паузе, и запасной поиск не отстает.
+    Вне PostgreSQL ничего не делает. Возвращает число помеченных строк.
+    """
+    if not search_backends.is_postgres():
+        return 0
+    with transaction.atomic():
+        rows = list(
+            SearchOutbox.objects.select_for_update(skip_locked=True)
+            .filter(partial=False, vectorized=False)
+            .order_by('id').values_list('id', 'book_id')[:batch_size]
+        )
+        if rows:
+            search_backends.update_search_vectors({book_id for _, book_id in rows})
+            SearchOutbox.objects.filter(id__in=[pk for pk, _ in rows]).update(vectorized=True)
+    return len(rows)
+
+
+def index_changes(book_ids, signal_ids):
+    """
+    Один bulk-запрос: полная переиндексация book_ids (удаление тех, что
+    уже нет в БД) и частичное обновление популярности signal_ids.
+    Ошибки отдельных документов не прерывают пачку: возвращаются id книг,
+    которые ES отклонил. Недоступность ES по-прежнему исключение.
+    """
+    document = get_document()
+    index_name = document._index._name
+
+    books = list(document.get_queryset().filter(pk__in=book_ids)) if book_ids else []
+    actions = list(document._get_actions(books, 'index'))
+    actions += [
+        {'_op_type': 'delete', '_index': index_name, '_id': pk}
+        for pk in book_ids - {book.pk for book in books}
+    ]
+    if signal_ids:
+        actions += [
+            {'_op_type': 'update', '_index': index_name, '_id': book.pk, 'doc': document.prepare_signals(book)}
+            for book in document.get_signals_queryset().filter(pk__in=signal_ids)
+        ]
+    # 404 отвечают удаление книги, которой уже нет в индексе,
+    # и частичное обновление книги, которой в нем еще нет
+    _, errors = bulk(document._get_connection(), actions, ignore_status=(404,), raise_on_error=False)
+    failed = set()
+    for error in errors:
+        item = next(iter(error.values()))
+        failed.add(int(item['_id']))
+        logger.warning('search outbox: ES отклонил книгу %s: %s', item['_id'], item.get('error'))
+    return failed
+
+
+def drain_all(batch_size=None, max_batches=None):
+    config = get_config()
+    batch_size = batch_size or config['BATCH_SIZE']
+    drained = 0
+    for _ in range(max_batches or config['MAX_BATCHES']):
+        count = drain(batch_size)
+        drained += count
+        if count < batch_size:
+            break
+    return drained
+
+
+def author_book_ids(author_id):
+    return Book.author.through.objects.filter(author_id=author_id).values_list('book_id', flat=True)
+
+
+def genre_book_ids(genre_id):
+    return Book.objects.filter(genre_id=genre_id).values_list('pk', flat=True)
+
+
+def parked_count():
+    return SearchOutbox.objects.filter(attempts__gte=get_config()['MAX_ATTEMPTS']).count()
+
+
+def requeue_parked():
+    """
+    Возвращает отложенные строки в разбор, например после исправления маппинга
+    """
+    return SearchOutbox.objects.filter(attempts__gte=get_config()['MAX_ATTEMPTS']).update(attempts=0)
@@ -1,11 +1,18 @@
+from urllib.parse import urlencode
+
 from django.core.validators import MaxValueValidator, MinValueValidator
 from django_elasticsearch_dsl_drf.serializers import DocumentSerializer
 
 from rest_framework import serializers
 from rest_framework.fields import CurrentUserDefault
 
+from .covers import prefetch_cover_urls, srcset
 from .documents import BookDocument
+from .fieldsets import BookFieldset
 from .models import Author, Book, Comment, Genre, Rating, ReadList
+from .pagination import KeysetPagination
+from .services import CommentThreadService
+from .uploads import CONTENT_TYPES
 
 
 class GenreSerializer(serializers.ModelSerializer):
@@ -20,6 +27,17 @@ class AuthorSerializer(serializers.ModelSerializer):
         fields = ['id', 'name']
 
 
+class AuthorSummarySerializer(AuthorSerializer):
+    """
+    Автор с числом книг и средним рейтингом, посчитанными в SQL
+    """
+    books_count = serializers.IntegerField(read_only=True)
+    rating_average = serializers.FloatField(read_only=True)
+
+    class Meta(AuthorSerializer.Meta):
+        fields = AuthorSerializer.Meta.fields + ['books_count', 'rating_average']
+
+
 class CommentSerializer(serializers.ModelSerializer):
     user = serializers.ReadOnlyField(source='user.email')
     created_at = serializers.DateTimeField(read_only=True)
@@ -28,6 +46,41 @@ class CommentSerializer(serializers.ModelSerializer):
         model = Comment
         fields = ['id', 'parent', 'user', 'content', 'created_at']
 
+    def validate_parent(self, parent):
+        if parent is not None and parent.level >= Comment.max_level():
+            raise serializers.ValidationError(
+                f'Превышена максимальная глубина ветки: {Comment.max_level()}'
+            )
+        return parent
+
+
+class CommentThreadSerializer(CommentSerializer):
+    """
+    Комментарий с вложенными ответами, загруженными CommentThreadService
+    """
+    replies_count = serializers.IntegerField(read_only=True)
+    replies = serializers.SerializerMethodField()
+    more_replies = serializers.SerializerMethodField()
+
+    class Meta(CommentSerializer.Meta):
+        fields = CommentSerializer.Meta.fields + ['replies_count', 'replies', 'more_replies']
+
+    def get_replies(self, obj):
+        return CommentThreadSerializer(obj.loaded_replies, many=True, context=self.context).data
+
+    def get_more_replies(self, obj):
+        if not obj.has_more_replies:
+            return None
+        request = self.context['request']
+        params = {'parent': obj.pk, 'max_depth': self.context['max_depth']}
+        if obj.loaded_replies:
+            # Догрузка продолжает после последнего показанного ответа
+            last = obj.loaded_replies[-1]
+            params[KeysetPagination.cursor_query_param] = KeysetPagination.cursor_token(
+                [getattr(last, field) for field in CommentThreadService.sibling_ordering]
+            )
+        return f'{request.build_absolute_uri(request.path)}?{urlencode(params)}'
+
 
 class RatingSerializer(serializers.ModelSerializer):
     rating = serializers.IntegerField(
@@ -42,16 +95,75 @@ class RatingSerializer(serializers.ModelSerializer):
         fields = ['rating']
 
 
+class RatingBulkItemSerializer(serializers.Serializer):
+    """
+    Элемент пакетной загрузки оценок
+    """
+    book = serializers.IntegerField()
+    rating = serializers.IntegerField(
+        validators=[
+            MinValueValidator(1),
+            MaxValueValidator(5),
+        ]
+    )
+
+
+class BookListSerializer(serializers.ListSerializer):
+    """
+    Перед сериализацией страницы прогревает ссылки на обложки одним обращением к кэшу
+    """
+
+    def to_representation(self, data):
+        books = list(data.all() if hasattr(data, 'all') else data)
+        fields = self.child.fields
+        prefetch_cover_urls(
+            [book.cover_image.name for book in books] if 'cover_image' in fields else [],
+            [book.cover_renditions for book in books] if 'cover_srcset' in fields else [],
+        )
+        return super().to_representation(books)
+
+
 class BookSerializer(serializers.ModelSerializer):
     """
     Основной Serializers для книг
     """
     genre = GenreSerializer(read_only=True)
     author = AuthorSerializer(many=True, read_only=True)
+    rating_histogram = serializers.DictField(child=serializers.IntegerField(), read_only=True)
+    cover_srcset = serializers.SerializerMethodField()
 
     class Meta:
         model = Book
-        fields = ['id', 'title', 'author', 'genre', 'description', 'cover_image']
+        fields = [
+            'id', 'title', 'author', 'genre', 'description', 'cover_image', 'cover_srcset',
+            'rating_average', 'rating_count', 'rating_histogram',
+        ]
+        list_serializer_class = BookListSerializer
+
+    def get_fields(self):
+        """
+        Поля и вложенность по ?fields= и ?expand= или по book_fieldset
+        из контекста, см. BookFieldset
+        """
+        fields = super().get_fields()
+        fieldset = self.context.get('book_fieldset')
+        if fieldset is None:
+            request = self.context.get('request')
+            if request is None:
+                return fields
+            fieldset = BookFieldset.from_request(request)
+
+        for name in list(fields):
+            if not fieldset.includes(name):
+                del fields[name]
+        if 'author' in fields and not fieldset.expands('author'):
+            fields['author'] = serializers.PrimaryKeyRelatedField(many=True, read_only=True)
+        if 'genre' in fields and not fieldset.expands('genre'):
+            fields['genre'] = serializers.PrimaryKeyRelatedField(read_only=True)
+        return fields
+
+    def get_cover_srcset(self, obj):
+        return srcset(obj.cover_renditions)
 
 
 class BookWithCommentSerializer(BookSerializer):
@@ -59,12 +171,21 @@ class BookWithCommentSerializer(BookSerializer):
     Serializers для отображения комментариев при просмотре конкретной книги
     """
     comments = serializers.SerializerMethodField()
+    comments_preview_size = 5
 
     class Meta(BookSerializer.Meta):
         fields = BookSerializer.Meta.fields + ['comments']
 
     def get_comments(self, obj):
-        queryset = Comment.objects.filter(book=obj.id).select_related('user').only('content', 'user__email', 'parent', 'created_at')
+        """
+        Превью: первые корневые комментарии, ветки целиком отдает /book/<pk>/comments/
+        """
+        queryset = (
+            Comment.objects.filter(book=obj.id, parent=None)
+            .select_related('user')
+            .only('content', 'user__email', 'parent', 'created_at')
+            .order_by('created_at', 'id')[:self.comments_preview_size]
+        )
         serializer = CommentSerializer(queryset, many=True)
         return serializer.data
 
@@ -82,6 +203,28 @@ class ReadListSerializer(serializers.ModelSerializer):
         fields = ['user', 'book', 'book_details']
 
 
+class ReadListBulkSerializer(serializers.Serializer):
+    """
+    Набор книг для пакетных операций со списком прочитанных
+    """
+    books = serializers.ListField(
+        child=serializers.IntegerField(min_value=1),
+        allow_empty=False,
+        max_length=1000,
+    )
+
+    def validate_books(self, value):
+        return list(dict.fromkeys(value))
+
+
+class CoverUploadSerializer(serializers.Serializer):
+    content_type = serializers.ChoiceField(choices=list(CONTENT_TYPES))
+
+
+class CoverUploadCompleteSerializer(serializers.Serializer):
+    token = serializers.CharField()
+
+
 class BookDocumentSerializer(DocumentSerializer):
     class Meta:
         document = BookDocument
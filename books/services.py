@@ -0,0 +1,379 @@
+from collections import defaultdict
+
+from django.contrib.auth import get_user_model
+from django.db import IntegrityError, transaction
+from django.db.models import (Case, CharField, Count, F, FloatField,
+                              OuterRef, Q, Subquery, Sum, Value, When, Window)
+from django.db.models.functions import (Cast, Coalesce, Concat, LPad, NullIf,
+                                        RowNumber)
+
+from . import search_sync
+from .cache import book_tag, invalidate_tags
+from .models import RATING_VALUES, Book, Comment, Rating
+
+HISTOGRAM_FIELDS = [f'rating_{value}_count' for value in RATING_VALUES]
+AGGREGATE_FIELDS = ['rating_count', 'rating_sum', 'rating_average'] + HISTOGRAM_FIELDS
+
+
+class RatingAggregateService:
+    """
+    Инкрементальное обновление и сверка агрегатов рейтинга в Book
+    """
+
+    @staticmethod
+    def apply(book_id, rating, previous=None):
+        RatingAggregateService.apply_many([(book_id, rating, previous)])
+
+    @staticmethod
+    def apply_many(changes):
+        """
+        changes - итерируемое из (book_id, новая оценка, прежняя оценка или None).
+        Все изменения применяются одним UPDATE, поэтому вызывать нужно
+        внутри той же транзакции, что и запись самих оценок.
+        """
+        deltas = defaultdict(lambda: defaultdict(int))
+        for book_id, rating, previous in changes:
+            if rating == previous:
+                continue
+            delta = deltas[book_id]
+            if previous is None:
+                delta['rating_count'] += 1
+            else:
+                delta['rating_sum'] -= previous
+                delta[f'rating_{previous}_count'] -= 1
+            delta['rating_sum'] += rating
+            delta[f'rating_{rating}_count'] += 1
+
+        if not deltas:
+            return 0
+
+        updates = {
+            field: RatingAggregateService._shifted(field, deltas)
+            for field in ['rating_count', 'rating_sum'] + HISTOGRAM_FIELDS
+        }
+        # В SET правые части видят значения строки до обновления,
+        # поэтому среднее считается от уже сдвинутых сумм
+        updates['rating_average'] = (
+            Cast(updates['rating_sum'], FloatField()) / NullIf(updates['rating_count'], Value(0))
+        )
+        search_sync.record_signals(deltas.keys())
+        return Book.objects.filter(pk__in=deltas.keys()).update(**updates)
+
+    @staticmethod
+    def _shifted(field, deltas):
+        whens = [
+            When(pk=book_id, then=Value(delta[field]))
+            for book_id, delta in deltas.items() if delta[field]
+        ]
+        if not whens:
+            return F(field)
+        return F(field) + Case(*whens, default=Value(0))
+
+    @staticmethod
+    def calculate(book_ids):
+        """
+        Агрегаты, посчитанные заново по таблице Rating
+        """
+        histogram = {
+            f'rating_{value}_count': Count('id', filter=Q(rating=value))
+            for value in RATING_VALUES
+        }
+        rows = (
+            Rating.objects.filter(book_id__in=book_ids)
+            .order_by()
+            .values('book_id')
+            .annotate(rating_count=Count('id'), rating_sum=Sum('rating'), **histogram)
+        )
+        result = {book_id: RatingAggregateService._empty() for book_id in book_ids}
+        for row in rows:
+            book_id = row.pop('book_id')
+            row['rating_average'] = row['rating_sum'] / row['rating_count']
+            result[book_id] = row
+        return result
+
+    @staticmethod
+    def reconcile(book_ids, dry_run=False):
+        """
+        Сравнивает сохраненные агрегаты с фактическими и исправляет
+        расхождения. Возвращает список id книг с расхождениями.
+        """
+        expected = RatingAggregateService.calculate(book_ids)
+        books = Book.objects.filter(pk__in=book_ids).only('pk', *AGGREGATE_FIELDS)
+
+        drifted = []
+        for book in books:
+            values = expected[book.pk]
+            if all(getattr(book, field) == values[field] for field in AGGREGATE_FIELDS):
+                continue
+            for field in AGGREGATE_FIELDS:
+                setattr(book, field, values[field])
+            drifted.append(book)
+
+        if drifted and not dry_run:
+            Book.objects.bulk_update(drifted, AGGREGATE_FIELDS)
+        return [book.pk for book in drifted]
+
+    @staticmethod
+    def _empty():
+        values = dict.fromkeys(['rating_count', 'rating_sum'] + HISTOGRAM_FIELDS, 0)
+        values['rating_average'] = None
+        return values
+
+
+class RatingBulkService:
+    """
+    Пакетная запись оценок: новые одним INSERT, измененные одним INSERT ... ON CONFLICT
+    """
+    CREATED = 'created'
+    UPDATED = 'updated'
+    UNCHANGED = 'unchanged'
+    SUPERSEDED = 'superseded'
+    NOT_FOUND = 'not_found'
+    # Сколько раз перечитывать прежние оценки, если новую пару (user, book)
+    # между чтением и вставкой успел записать параллельный запрос
+    ATTEMPTS = 3
+
+    @staticmethod
+    @transaction.atomic
+    def upsert(user, items):
+        """
+        items - список словарей {book, rating}. Возвращает исход для каждого
+        элемента в исходном порядке. При повторе книги в пакете действует
+        последняя оценка, предыдущие получают исход superseded.
+        """
+        latest = {item['book']: index for index, item in enumerate(items)}
+        existing_books = set(
+            Book.objects.filter(pk__in=latest.keys()).values_list('pk', flat=True)
+        )
+
+        def attempt():
+            previous = dict(
+                Rating.objects.select_for_update()
+                .filter(user=user, book_id__in=existing_books)
+                .values_list('book_id', 'rating')
+            )
+
+            outcomes = []
+            changes = []
+            for index, item in enumerate(items):
+                book_id, value = item['book'], item['rating']
+                if book_id not in existing_books:
+                    outcome = RatingBulkService.NOT_FOUND
+                elif latest[book_id] != index:
+                    outcome = RatingBulkService.SUPERSEDED
+                else:
+                    before = previous.get(book_id)
+                    if before is None:
+                        outcome = RatingBulkService.CREATED
+                    elif before != value:
+                        outcome = RatingBulkService.UPDATED
+                    else:
+                        outcome = RatingBulkService.UNCHANGED
+                    if outcome != RatingBulkService.UNCHANGED:
+                        changes.append((book_id, value, before))
+                outcomes.append({'book': book_id, 'rating': value, 'status': outcome})
+
+            RatingBulkService.write([(user.pk, *change) for change in changes])
+            return outcomes
+
+        return RatingBulkService.retry(attempt)
+
+    @staticmethod
+    @transaction.atomic
+    def write_pending(pending):
+        """
+        Запись отложенных оценок разных пользователей: pending - словарь
+        {(user_id, book_id): оценка}. Оценки удаленных книг и пользователей
+        отбрасываются. Возвращает число записанных изменений.
+        """
+        book_ids = set(
+            Book.objects.filter(pk__in={book_id for _, book_id in pending})
+            .values_list('pk', flat=True)
+        )
+        user_ids = set(
+            get_user_model().objects.filter(pk__in={user_id for user_id, _ in pending})
+            .values_list('pk', flat=True)
+        )
+
+        def attempt():
+            # Блокируется надмножество нужных строк, зато одним простым запросом
+            previous = {
+                (user_id, book_id): value
+                for user_id, book_id, value in Rating.objects.select_for_update()
+                .filter(user_id__in=user_ids, book_id__in=book_ids)
+                .values_list('user_id', 'book_id', 'rating')
+            }
+
+            changes = []
+            for (user_id, book_id), value in pending.items():
+                before = previous.get((user_id, book_id))
+                if user_id in user_ids and book_id in book_ids and before != value:
+                    changes.append((user_id, book_id, value, before))
+            RatingBulkService.write(changes)
+            return len(changes)
+
+        return RatingBulkService.retry(attempt)
+
+    @staticmethod
+    def retry(attempt):
+        """
+        Повторяет attempt, пока write не перестанет натыкаться на оценки,
+        вставленные параллельно. Последняя ошибка пробрасывается.
+        """
+        for remaining in reversed(range(RatingBulkService.ATTEMPTS)):
+            try:
+                return attempt()
+            except IntegrityError:
+                if not remaining:
+                    raise
+
+    @staticmethod
+    def write(changes):
+        """
+        changes - список (user_id, book_id, новая оценка, прежняя оценка или None).
+        Вызывать в транзакции, в которой прочитаны и заблокированы прежние оценки.
+        Отсутствующие строки заблокировать нельзя, поэтому новые оценки
+        вставляются без ON CONFLICT в точке сохранения: если пару уже
+        записал параллельный запрос, вставка откатывается с IntegrityError
+        и прежние оценки нужно перечитать (см. retry). Так исход и дельта
+        агрегатов не расходятся с тем, что на самом деле записано.
+        """
+        if not changes:
+            return
+
+        created = [change for change in changes if change[3] is None]
+        updated = [change for change in changes if change[3] is not None]
+        if created:
+            with transaction.atomic():
+                Rating.objects.bulk_create(
+                    [Rating(user_id=user_id, book_id=book_id, rating=value) for user_id, book_id, value, _ in created]
+                )
+        if updated:
+            # Строки заблокированы, ON CONFLICT здесь только обновляет их одним запросом
+            Rating.objects.bulk_create(
+                [Rating(user_id=user_id, book_id=book_id, rating=value) for user_id, book_id, value, _ in updated],
+                update_conflicts=True,
+                unique_fields=['user', 'book'],
+                update_fields=['rating'],
+            )
+        RatingAggregateService.apply_many(change[1:] for change in changes)
+        # bulk_create не отправляет сигналы, кэш книг сбрасываем сами
+        invalidate_tags(*{book_tag(change[1]) for change in changes})
+
+
+class CommentThreadService:
+    """
+    Загрузка веток комментариев страницы одним запросом по диапазонам
+    lft/rght или материализованного пути, в зависимости от хранения дерева.
+    Братья упорядочены по времени создания и в превью, и в догрузке
+    (?parent= с курсором после последнего показанного ответа).
+    """
+    sibling_ordering = ('created_at', 'id')
+
+    @staticmethod
+    def attach_replies(roots, max_depth, replies_limit):
+        """
+        Раскладывает по roots ответы до глубины max_depth, не более
+        replies_limit ответов на узел. У каждого узла выставляются
+        loaded_replies и has_more_replies.
+        """
+        nodes = {}
+        for root in roots:
+            root.loaded_replies = []
+            root.children_count = 0
+            nodes[root.pk] = root
+
+        if not roots:
+            return
+
+        level_limit = roots[0].level + max_depth
+        if max_depth > 0:
+            subtrees = Q()
+            for root in roots:
+                subtrees |= root.subtree_filter()
+
+            ordering = Comment.tree_ordering()
+            replies = (
+                Comment.objects.filter(subtrees, level__lte=level_limit)
+                .annotate(
+                    sibling_rank=Window(
+                        RowNumber(),
+                        partition_by=[F('parent_id')],
+                        order_by=[F(field).asc() for field in CommentThreadService.sibling_ordering],
+                    ),
+                    sibling_count=Window(Count('id'), partition_by=[F('parent_id')]),
+                )
+                .filter(sibling_rank__lte=replies_limit)
+                .select_related('user')
+                .order_by(*ordering)
+            )
+
+            # Обход в порядке дерева: родитель всегда раньше потомков
+            for reply in replies:
+                parent = nodes.get(reply.parent_id)
+                if parent is None:
+                    continue
+                reply.loaded_replies = []
+                reply.children_count = 0
+                parent.loaded_replies.append(reply)
+                parent.children_count = reply.sibling_count
+                nodes[reply.pk] = reply
+
+        for node in nodes.values():
+            # Обход шел в порядке дерева, а братья показываются по времени создания
+            node.loaded_replies.sort(key=lambda reply: (reply.created_at, reply.pk))
+            if node.level >= level_limit:
+                node.has_more_replies = node.replies_count > 0
+            else:
+                node.has_more_replies = len(node.loaded_replies) < node.children_count
+
+
+class CommentTreeService:
+    """
+    Перестроение хранения дерева комментариев при смене режима
+    """
+
+    @staticmethod
+    @transaction.atomic
+    def rebuild_paths():
+        """
+        Пути, уровни и число ответов по одним только ссылкам parent.
+        Возвращает число обработанных комментариев.
+        """
+        segment = LPad(Cast('id', CharField()), Comment.PATH_STEP, Value('0'))
+        parents = Comment.objects.filter(pk=OuterRef('parent_id'))
+
+        Comment.objects.update(path='')
+        updated = total = Comment.objects.filter(parent=None).update(path=segment, level=0)
+        while updated:
+            updated = Comment.objects.filter(path='', parent__path__gt='').update(
+                path=Concat(Subquery(parents.values('path')[:1]), segment),
+                level=Subquery(parents.values('level')[:1]) + 1,
+            )
+            total += updated
+
+        CommentTreeService.recount_replies()
+        return total
+
+    @staticmethod
+    @transaction.atomic
+    def recount_replies():
+        """
+        Пересчет replies_count по путям: исправляет счетчики, разошедшиеся
+        после массовых удалений в обход Comment.delete
+        """
+        descendants = (
+            Comment.objects.filter(path__startswith=OuterRef('path'))
+            .exclude(pk=OuterRef('pk'))
+            .order_by()
+            .values('book')
+            .annotate(count=Count('id'))
+            .values('count')
+        )
+        return Comment.objects.update(replies_count=Coalesce(Subquery(descendants), 0))
+
+    @staticmethod
+    @transaction.atomic
+    def rebuild_mptt():
+        Comment.objects.rebuild()
+        CommentTreeService.recount_replies()
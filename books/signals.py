@@ -1,29 +1,114 @@
-from django.db.models.signals import post_delete, post_save
+from django.db import transaction
+from django.db.models.signals import (m2m_changed, post_delete, post_save,
+                                      pre_delete)
 from django.dispatch import receiver
-from django_elasticsearch_dsl.registries import registry
 
+from .cache import (AUTHORS_TAG, BOOKS_TAG, author_tag, book_tag, genre_tag,
+                    invalidate_tags)
+from . import search_sync
+from .covers import needs_processing
+from .models import Author, Book, Comment, Genre, Rating, ReadList
+from .tasks import process_book_cover
 
-@receiver(post_save)
-def update_document(sender, **kwargs):
-    app_label = sender._meta.app_label
-    model_name = sender._meta.model_name
-    instance = kwargs['instance']
 
-    if app_label == 'books':
-        if model_name == 'book':
-            instances = instance.article.all()
-            for _instance in instances:
-                registry.update(_instance)
+@receiver(post_save, sender=Book)
+def invalidate_saved_book(sender, instance, created, **kwargs):
+    tags = [book_tag(instance.pk)]
+    if created:
+        tags.append(BOOKS_TAG)
+    invalidate_tags(*tags)
 
 
-@receiver(post_delete)
-def delete_document(sender, **kwargs):
-    app_label = sender._meta.app_label
-    model_name = sender._meta.model_name
-    instance = kwargs['instance']
+@receiver(post_save, sender=Book)
+def schedule_cover_processing(sender, instance, **kwargs):
+    if needs_processing(instance):
+        transaction.on_commit(lambda: process_book_cover.delay(instance.pk))
 
-    if app_label == 'books':
-        if model_name == 'book':
-            instances = instance.article.all()
-            for _instance in instances:
-                registry.update(_instance)
+
+@receiver(post_delete, sender=Book)
+def invalidate_deleted_book(sender, instance, **kwargs):
+    invalidate_tags(book_tag(instance.pk), BOOKS_TAG)
+
+
+@receiver(m2m_changed, sender=Book.author.through)
+def invalidate_book_authors(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+
+    if reverse:
+        tags = [author_tag(instance.pk)] + [book_tag(pk) for pk in pk_set or ()]
+    else:
+        tags = [book_tag(instance.pk)] + [author_tag(pk) for pk in pk_set or ()]
+    invalidate_tags(*tags)
+
+
+@receiver(post_save, sender=Author)
+def invalidate_saved_author(sender, instance, created, **kwargs):
+    tags = [author_tag(instance.pk)]
+    if created:
+        tags.append(AUTHORS_TAG)
+    invalidate_tags(*tags)
+
+
+@receiver(post_delete, sender=Author)
+def invalidate_deleted_author(sender, instance, **kwargs):
+    invalidate_tags(author_tag(instance.pk), AUTHORS_TAG)
+
+
+@receiver([post_save, post_delete], sender=Genre)
+def invalidate_genre(sender, instance, **kwargs):
+    invalidate_tags(genre_tag(instance.pk))
+
+
+@receiver([post_save, post_delete], sender=Comment)
+@receiver([post_save, post_delete], sender=Rating)
+def invalidate_book_feedback(sender, instance, **kwargs):
+    invalidate_tags(book_tag(instance.book_id))
+
+
+@receiver([post_save, post_delete], sender=Book)
+def record_book_for_search(sender, instance, **kwargs):
+    search_sync.record([instance.pk])
+
+
+@receiver(m2m_changed, sender=Book.author.through)
+def record_book_authors_for_search(sender, instance, action, reverse, pk_set, **kwargs):
+    if not reverse:
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            search_sync.record([instance.pk])
+    elif action in ('post_add', 'post_remove'):
+        search_sync.record(pk_set)
+    elif action == 'pre_clear':
+        # После очистки связей книги автора уже не найти
+        search_sync.record(search_sync.author_book_ids(instance.pk))
+
+
+@receiver(post_save, sender=Author)
+def record_author_books_for_search(sender, instance, created, **kwargs):
+    if not created:
+        search_sync.record(search_sync.author_book_ids(instance.pk))
+
+
+@receiver(pre_delete, sender=Author)
+def record_deleted_author_books_for_search(sender, instance, **kwargs):
+    # Связи с книгами удаляются каскадом без m2m_changed
+    search_sync.record(search_sync.author_book_ids(instance.pk))
+
+
+@receiver(post_save, sender=Genre)
+def record_genre_books_for_search(sender, instance, created, **kwargs):
+    # Удаление жанра удаляет книги каскадом, их отметит post_delete книги
+    if not created:
+        search_sync.record(search_sync.genre_book_ids(instance.pk))
+
+
+@receiver(post_save, sender=Comment)
+@receiver(post_save, sender=ReadList)
+def record_book_activity_for_search(sender, instance, created, **kwargs):
+    if created:
+        search_sync.record_signals([instance.book_id])
+
+
+@receiver(post_delete, sender=ReadList)
+def record_book_readers_for_search(sender, instance, **kwargs):
+    search_sync.record_signals([instance.book_id])
@@ -0,0 +1,34 @@
+from celery import shared_task
+from PIL import UnidentifiedImageError
+
+from . import covers, search_sync, write_behind
+from .models import Book
+
+
+@shared_task(ignore_result=True)
+def flush_rating_buffer():
+    """
+    Периодический сброс отложенных оценок в БД
+    """
+    return write_behind.flush()
+
+
+@shared_task(bind=True, ignore_result=True, acks_late=True, max_retries=3, default_retry_delay=30)
+def process_book_cover(self, book_id, force=False):
+    """
+    Построение рендиций обложки вне запроса
+    """
+    try:
+        covers.process_cover(book_id, force=force)
+    except (Book.DoesNotExist, UnidentifiedImageError):
+        return
+    except Exception as exc:
+        raise self.retry(exc=exc)
+
+
+@shared_task(ignore_result=True)
+def drain_search_outbox():
+    """
+    Периодическая синхронизация индекса книг с БД через outbox
+    """
+    return search_sync.drain_all()
@@ -1,12 +1,53 @@
+import datetime
+import json
+import shutil
+import tempfile
+import time
+from decimal import Decimal
+from io import BytesIO, StringIO
+from unittest import mock
+
+import redis
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+from django.db import DatabaseError, connection, transaction
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils.translation import gettext_lazy
+from elasticsearch.exceptions import ConnectionError as ESConnectionError
+from elasticsearch.exceptions import ConnectionTimeout, TransportError
+from elasticsearch_dsl import Search
+from elasticsearch_dsl.response import Response as ESResponse
+from PIL import Image
 from rest_framework import status
-from rest_framework.test import APIClient, APITestCase
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from rest_framework.response import Response
+from rest_framework.test import APIClient, APIRequestFactory, APITestCase
+from storages.backends.s3boto3 import S3Boto3Storage
 
 from accounts.domain.models import User
-from books.models import Author, Book, Comment, Genre, Rating, ReadList
+from books import (autocomplete, covers, reindex, search_backends,
+                   search_cache, search_ranking, search_sync, write_behind)
+from books.cache import book_tag, cache_key, get_stats, invalidate_tags
+from books.covers import process_cover
+from books.documents import SIGNAL_FIELDS, BookDocument
+from books.fast_serializers import FastBookSerializer
+from books.fieldsets import BookFieldset
+from books.models import (Author, Book, Comment, Genre, Rating, ReadList,
+                          SearchOutbox)
 from books.serializers import (AuthorSerializer, BookSerializer,
                                BookWithCommentSerializer)
-from books.views import BookViewSet, ReadListModelViewSet
+from books.services import RatingAggregateService, RatingBulkService
+from books.search_facets import FacetFilterBackend
+from books.views import (BookDocumentView, BookViewSet, CommentBookAPIView,
+                         ReadListModelViewSet)
+from drf_project.renderers import FastJSONRenderer
+from drf_project.storages import CoverStorage
 
 
 class BookSetupMixin:
@@ -209,6 +250,56 @@ class RatingViewSetTest(UserSetupMixin, BookSetupMixin, APITestCase):
 
         self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
 
+    def test_rating_aggregates_updated(self):
+        """
+        Тест для проверки пересчета агрегатов рейтинга при создании и обновлении оценки
+        """
+        other_user = User.objects.create_user(email='other@testuser.ru', username='other', password='testpassword')
+        Rating.objects.create(book=self.book, user=other_user, rating=2)
+        self.book.rating_count, self.book.rating_sum, self.book.rating_2_count = 1, 2, 1
+        self.book.save()
+
+        url = f'/api/v1/book/{self.book.pk}/ratings/'
+        self.client_authenticated.post(url, data={'rating': 5}, format='json')
+        self.book.refresh_from_db()
+        self.assertEqual(self.book.rating_count, 2)
+        self.assertEqual(self.book.rating_average, 3.5)
+        self.assertEqual(self.book.rating_histogram, {'1': 0, '2': 1, '3': 0, '4': 0, '5': 1})
+
+        self.client_authenticated.post(url, data={'rating': 4}, format='json')
+        self.book.refresh_from_db()
+        self.assertEqual(self.book.rating_count, 2)
+        self.assertEqual(self.book.rating_sum, 6)
+        self.assertEqual(self.book.rating_average, 3.0)
+        self.assertEqual(self.book.rating_histogram, {'1': 0, '2': 1, '3': 0, '4': 1, '5': 0})
+
+    def test_reconcile_ratings_command(self):
+        """
+        Тест для проверки исправления расхождений командой reconcile_ratings
+        """
+        Rating.objects.create(book=self.book, user=self.user, rating=4)
+
+        call_command('reconcile_ratings', stdout=StringIO())
+
+        self.book.refresh_from_db()
+        self.assertEqual(self.book.rating_count, 1)
+        self.assertEqual(self.book.rating_average, 4.0)
+        self.assertEqual(self.book.rating_4_count, 1)
+
+    def test_book_serializer_exposes_rating_aggregates(self):
+        """
+        Тест для проверки, что агрегаты рейтинга отдаются без дополнительных запросов
+        """
+        url = f'/api/v1/book/{self.book.pk}/ratings/'
+        self.client_authenticated.post(url, data={'rating': 4}, format='json')
+        book = Book.objects.prefetch_related('author').select_related('genre').get(pk=self.book.pk)
+
+        with self.assertNumQueries(0):
+            data = BookSerializer(book).data
+        self.assertEqual(data['rating_average'], 4.0)
+        self.assertEqual(data['rating_count'], 1)
+        self.assertEqual(data['rating_histogram']['4'], 1)
+
 
 class ReadListModelViewSetTests(UserSetupMixin, BookSetupMixin, APITestCase):
     def test_get_queryset(self):
@@ -272,17 +363,83 @@ class ReadListModelViewSetTests(UserSetupMixin, BookSetupMixin, APITestCase):
         self.assertEqual(len(response.data['results']), 1)
         self.assertEqual(response.data['results'][0]['book_details']['id'], self.book.id)
 
+    def test_bulk_add_and_remove(self):
+        """
+        Тест пакетного добавления и удаления книг из прочитанных
+        """
+        other_book = Book.objects.create(title='Other Book', genre=self.genre)
+        ReadList.objects.create(user=self.user, book=self.book)
+
+        data = {'books': [self.book.id, other_book.id, other_book.id, 999]}
+        response = self.client_authenticated.post('/api/v1/read-book/bulk-add/', data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, {'books': [self.book.id, other_book.id], 'not_found': [999]})
+        self.assertEqual(ReadList.objects.filter(user=self.user).count(), 2)
+
+        data = {'books': [self.book.id, 999]}
+        response = self.client_authenticated.post('/api/v1/read-book/bulk-remove/', data, format='json')
+        self.assertEqual(response.data, {'removed': 1})
+
+    def test_contains(self):
+        """
+        Тест проверки наличия книг в списке одним запросом
+        """
+        other_book = Book.objects.create(title='Other Book', genre=self.genre)
+        ReadList.objects.create(user=self.user, book=other_book)
+
+        url = f'/api/v1/read-book/contains/?books={self.book.id},{other_book.id}'
+        with self.assertNumQueries(1):
+            response = self.client_authenticated.get(url)
+        self.assertEqual(response.data, {'books': [other_book.id]})
+
+        response = self.client_authenticated.get('/api/v1/read-book/contains/?books=a')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
 
 class AuthorDetailViewTests(BookSetupMixin, UserSetupMixin, APITestCase):
     def test_get_author_details(self):
         """
-        Проверяет, что API возвращает детали автора и список его книг.
+        Проверяет, что API возвращает детали автора с числом книг и средним рейтингом.
         """
+        other_book = Book.objects.create(title='Other Book', genre=self.genre, rating_count=3, rating_sum=6)
+        other_book.author.add(self.author)
+        self.book.rating_count, self.book.rating_sum = 1, 5
+        self.book.save()
+
         url = reverse('author-detail', args=[self.author.pk])
         response = self.client_authenticated.get(url)
 
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(response.data[0]['author'][0]['name'], self.author.name)
+        self.assertEqual(response.data['name'], self.author.name)
+        self.assertEqual(response.data['books_count'], 2)
+        self.assertEqual(response.data['rating_average'], 2.75)
+
+    def test_author_list_is_annotated(self):
+        """
+        Проверяет, что список авторов собирается одним запросом с агрегатами.
+        """
+        Author.objects.create(name='No Books')
+
+        with self.assertNumQueries(2):
+            response = self.client_authenticated.get(reverse('author-list'))
+        counts = {row['name']: row['books_count'] for row in response.data['results']}
+        self.assertEqual(counts, {self.author.name: 1, 'No Books': 0})
+
+    def test_author_books_paginated(self):
+        """
+        Проверяет постраничную выдачу книг автора.
+        """
+        for i in range(3):
+            Book.objects.create(title=f'Book {i}', genre=self.genre).author.add(self.author)
+        Book.objects.create(title='Foreign Book', genre=self.genre)
+
+        url = reverse('author-books', args=[self.author.pk])
+        response = self.client_authenticated.get(url + '?limit=2')
+        self.assertEqual(response.data['count'], 4)
+        self.assertEqual(response.data['results'][0]['author'][0]['name'], self.author.name)
+
+        response = self.client_authenticated.get(reverse('author-books', args=[999]))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
 
     def test_author_serializer(self):
         """
@@ -298,3 +455,1511 @@ class AuthorDetailViewTests(BookSetupMixin, UserSetupMixin, APITestCase):
         serializer = BookSerializer(self.book)
         self.assertEqual(serializer.data['title'], self.book.title)
         self.assertEqual(serializer.data['author'][0]['name'], self.author.name)
+
+
+class KeysetPaginationTests(UserSetupMixin, BookSetupMixin, APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.books = [self.book] + [
+            Book.objects.create(title=f'Book {i}', genre=self.genre) for i in range(4)
+        ]
+
+    def _collect(self, client, url):
+        ids = []
+        while url:
+            response = client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertNotIn('count', response.data)
+            ids += [row['id'] for row in response.data['results']]
+            url = response.data['next']
+        return ids
+
+    def test_book_cursor_pages(self):
+        """
+        Тест обхода всех книг по курсору без пропусков и повторов
+        """
+        ids = self._collect(self.client, reverse('book-list') + '?cursor=&limit=2')
+        self.assertEqual(ids, [book.id for book in self.books])
+
+    def test_book_previous_cursor(self):
+        """
+        Тест перехода на предыдущую страницу
+        """
+        first = self.client.get(reverse('book-list') + '?cursor=&limit=2')
+        second = self.client.get(first.data['next'])
+        back = self.client.get(second.data['previous'])
+        self.assertEqual(back.data['results'], first.data['results'])
+
+    def test_book_cursor_skips_count_query(self):
+        """
+        Тест, что keyset-режим не выполняет COUNT(*)
+        """
+        with self.assertNumQueries(2):
+            self.client.get(reverse('book-list') + '?cursor=')
+
+    def test_invalid_cursor(self):
+        """
+        Тест неверного курсора
+        """
+        response = self.client.get(reverse('book-list') + '?cursor=broken')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_read_list_cursor_with_filters(self):
+        """
+        Тест keyset-пагинации списка прочитанных вместе с фильтром по жанру
+        """
+        other_genre = Genre.objects.create(title='Other Genre')
+        other_book = Book.objects.create(title='Other Book', genre=other_genre)
+        ReadList.objects.create(user=self.user, book=other_book)
+        for book in self.books:
+            ReadList.objects.create(user=self.user, book=book)
+
+        url = f'/api/v1/read-book/?cursor=&limit=2&genre={self.genre.title}'
+        response = self.client_authenticated.get(url)
+        ids = []
+        while True:
+            ids += [row['book'] for row in response.data['results']]
+            if not response.data['next']:
+                break
+            response = self.client_authenticated.get(response.data['next'])
+
+        self.assertEqual(ids, [book.id for book in reversed(self.books)])
+
+
+class ResponseCacheTests(UserSetupMixin, BookSetupMixin, APITestCase):
+    def setUp(self):
+        cache.clear()
+        super().setUp()
+        self.url = reverse('book-detail', kwargs={'pk': self.book.pk})
+
+    def test_repeated_request_is_served_from_cache(self):
+        """
+        Тест повторного запроса книги из кэша
+        """
+        first = self.client.get(self.url)
+        with self.assertNumQueries(0):
+            second = self.client.get(self.url)
+
+        self.assertEqual(first['X-Cache'], 'MISS')
+        self.assertEqual(second['X-Cache'], 'HIT')
+        self.assertEqual(first.data, second.data)
+        self.assertEqual(get_stats()['hit'], 1)
+
+    def test_query_params_are_normalized(self):
+        """
+        Тест, что порядок параметров запроса не влияет на ключ кэша
+        """
+        self.client.get(reverse('book-list') + '?limit=5&offset=0')
+        response = self.client.get(reverse('book-list') + '?offset=0&limit=5')
+        self.assertEqual(response['X-Cache'], 'HIT')
+
+    def test_comment_invalidates_book(self):
+        """
+        Тест инвалидации карточки книги при добавлении комментария
+        """
+        self.client.get(self.url)
+        Comment.objects.create(book=self.book, user=self.user, content='Новый комментарий')
+
+        response = self.client.get(self.url)
+        self.assertEqual(response['X-Cache'], 'REVALIDATED')
+        self.assertEqual(len(response.data['comments']), 1)
+
+    def test_author_rename_invalidates_book_list(self):
+        """
+        Тест инвалидации списка книг при переименовании автора
+        """
+        self.client.get(reverse('book-list'))
+        self.author.name = 'Renamed Author'
+        self.author.save()
+
+        response = self.client.get(reverse('book-list'))
+        self.assertEqual(response['X-Cache'], 'REVALIDATED')
+        self.assertEqual(response.data['results'][0]['author'][0]['name'], 'Renamed Author')
+
+    def test_stale_response_while_revalidating(self):
+        """
+        Тест отдачи устаревшего ответа, пока другой воркер пересобирает кэш
+        """
+        first = self.client.get(self.url)
+        invalidate_tags(book_tag(self.book.pk))
+        request = Request(APIRequestFactory().get(self.url))
+        cache.add(f'{cache_key(request)}:lock', 1)
+
+        response = self.client.get(self.url)
+        self.assertEqual(response['X-Cache'], 'STALE')
+        self.assertEqual(response.data, first.data)
+
+
+class ConditionalGetTests(UserSetupMixin, BookSetupMixin, APITestCase):
+    def setUp(self):
+        cache.clear()
+        super().setUp()
+        self.url = reverse('book-detail', kwargs={'pk': self.book.pk})
+
+    def test_matching_etag_returns_304_without_queries(self):
+        """
+        Тест ответа 304 на If-None-Match без обращения к базе
+        """
+        response = self.client.get(self.url)
+        self.assertIn('ETag', response)
+        self.assertIn('Last-Modified', response)
+
+        cache.delete(cache_key(Request(APIRequestFactory().get(self.url))))
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_comment_changes_etag(self):
+        """
+        Тест смены ETag после нового комментария к книге
+        """
+        etag = self.client.get(self.url)['ETag']
+        url = reverse('comment-list', kwargs={'book_pk': self.book.pk})
+        self.client_authenticated.post(url, {'content': 'Новый комментарий'}, format='json')
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_rating_changes_etag(self):
+        """
+        Тест смены ETag после новой оценки книги
+        """
+        etag = self.client.get(self.url)['ETag']
+        url = f'/api/v1/book/{self.book.pk}/ratings/'
+        self.client_authenticated.post(url, {'rating': 5}, format='json')
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['rating_count'], 1)
+
+    def test_if_modified_since(self):
+        """
+        Тест ответа 304 на If-Modified-Since
+        """
+        last_modified = self.client.get(self.url)['Last-Modified']
+        response = self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_author_etag(self):
+        """
+        Тест условного запроса к книгам автора
+        """
+        url = reverse('author-books', args=[self.author.pk])
+        etag = self.client_authenticated.get(url)['ETag']
+        response = self.client_authenticated.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        self.book.title = 'Renamed Book'
+        self.book.save()
+        response = self.client_authenticated.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+
+class CommentThreadTests(UserSetupMixin, BookSetupMixin, APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.url = reverse('comment-list', kwargs={'book_pk': self.book.pk})
+
+    def _comment(self, content, parent=None):
+        return Comment.objects.create(book=self.book, user=self.user, content=content, parent=parent)
+
+    def test_threads_are_paginated_by_root(self):
+        """
+        Тест постраничного обхода корневых веток
+        """
+        roots = [self._comment(f'root {i}') for i in range(3)]
+        self._comment('reply', parent=roots[0])
+
+        response = self.client.get(self.url + '?limit=2')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([row['id'] for row in response.data['results']], [roots[0].pk, roots[1].pk])
+        self.assertEqual(response.data['results'][0]['replies'][0]['content'], 'reply')
+        self.assertEqual(response.data['results'][0]['replies_count'], 1)
+
+        response = self.client.get(response.data['next'])
+        self.assertEqual([row['id'] for row in response.data['results']], [roots[2].pk])
+
+    def test_subtrees_loaded_in_one_query(self):
+        """
+        Тест загрузки веток страницы одним запросом
+        """
+        for i in range(3):
+            root = self._comment(f'root {i}')
+            self._comment(f'reply {i}', parent=self._comment(f'child {i}', parent=root))
+
+        with self.assertNumQueries(3):
+            response = self.client.get(self.url)
+        self.assertEqual(response.data['results'][2]['replies'][0]['replies'][0]['content'], 'reply 2')
+
+    def test_max_depth_and_load_more(self):
+        """
+        Тест ограничения глубины и ссылки на догрузку ответов
+        """
+        root = self._comment('root')
+        child = self._comment('child', parent=root)
+        self._comment('grandchild', parent=child)
+
+        response = self.client.get(self.url + '?max_depth=1')
+        node = response.data['results'][0]['replies'][0]
+        self.assertEqual(node['replies'], [])
+        self.assertIsNotNone(node['more_replies'])
+
+        response = self.client.get(node['more_replies'])
+        self.assertEqual(response.data['results'][0]['content'], 'grandchild')
+
+    def test_replies_limit(self):
+        """
+        Тест ограничения числа ответов на один узел
+        """
+        root = self._comment('root')
+        for i in range(CommentBookAPIView.replies_limit + 1):
+            self._comment(f'reply {i}', parent=root)
+
+        response = self.client.get(self.url)
+        thread = response.data['results'][0]
+        self.assertEqual(len(thread['replies']), CommentBookAPIView.replies_limit)
+        self.assertIsNotNone(thread['more_replies'])
+
+    def test_preview_and_load_more_share_sibling_order(self):
+        """
+        Тест порядка ответов по времени создания в превью и продолжения
+        догрузки после последнего показанного ответа
+        """
+        root = self._comment('root')
+        limit = CommentBookAPIView.replies_limit
+        # Содержимое по убыванию: в mptt-порядке (order_insertion_by) они шли бы наоборот
+        replies = [self._comment(f'reply {chr(ord("z") - i)}', parent=root) for i in range(limit + 2)]
+
+        thread = self.client.get(self.url).data['results'][0]
+        self.assertEqual([reply['id'] for reply in thread['replies']], [reply.pk for reply in replies[:limit]])
+
+        response = self.client.get(thread['more_replies'])
+        self.assertEqual([row['id'] for row in response.data['results']], [reply.pk for reply in replies[limit:]])
+
+    def test_book_detail_embeds_bounded_preview(self):
+        """
+        Тест ограниченного превью комментариев в карточке книги
+        """
+        for i in range(BookWithCommentSerializer.comments_preview_size + 2):
+            self._comment(f'root {i}')
+
+        response = self.client.get(reverse('book-detail', kwargs={'pk': self.book.pk}))
+        self.assertEqual(len(response.data['comments']), BookWithCommentSerializer.comments_preview_size)
+
+
+@override_settings(COMMENT_TREE_STORAGE='path')
+class CommentPathStorageTests(UserSetupMixin, BookSetupMixin, APITestCase):
+    def _comment(self, content, parent=None):
+        return Comment.objects.create(book=self.book, user=self.user, content=content, parent=parent)
+
+    def test_insert_sets_path_and_counts(self):
+        """
+        Тест пути и счетчиков ответов при вставке без перестройки mptt
+        """
+        root = self._comment('root')
+        child = self._comment('child', parent=root)
+        grandchild = self._comment('grandchild', parent=child)
+
+        self.assertEqual(grandchild.path, root.path + Comment.path_segment(child.pk) + Comment.path_segment(grandchild.pk))
+        self.assertEqual(grandchild.level, 2)
+        root.refresh_from_db()
+        self.assertEqual(root.replies_count, 2)
+
+        child.delete()
+        root.refresh_from_db()
+        self.assertEqual(root.replies_count, 0)
+        self.assertFalse(Comment.objects.filter(pk=grandchild.pk).exists())
+
+    def test_thread_endpoint(self):
+        """
+        Тест выдачи веток в порядке создания при хранении пути
+        """
+        root = self._comment('root')
+        self._comment('b', parent=root)
+        self._comment('a', parent=root)
+
+        response = self.client.get(reverse('comment-list', kwargs={'book_pk': self.book.pk}))
+        replies = response.data['results'][0]['replies']
+        self.assertEqual([reply['content'] for reply in replies], ['b', 'a'])
+        self.assertEqual(response.data['results'][0]['replies_count'], 2)
+
+    def test_rebuild_from_mptt(self):
+        """
+        Тест перевода дерева, созданного в режиме mptt, на пути
+        """
+        with override_settings(COMMENT_TREE_STORAGE='mptt'):
+            root = self._comment('root')
+            leaf = self._comment('leaf', parent=self._comment('child', parent=root))
+        Comment.objects.update(path='', replies_count=0)
+
+        call_command('rebuild_comment_tree', storage='path', stdout=StringIO())
+
+        root.refresh_from_db()
+        leaf.refresh_from_db()
+        self.assertTrue(leaf.path.startswith(root.path))
+        self.assertEqual(len(leaf.path), Comment.PATH_STEP * 3)
+        self.assertEqual(root.replies_count, 2)
+
+    def test_reply_too_deep(self):
+        """
+        Тест отказа в ответе глубже, чем вмещает путь
+        """
+        parent = self._comment('deep')
+        Comment.objects.filter(pk=parent.pk).update(level=Comment.max_level())
+        url = reverse('comment-list', kwargs={'book_pk': self.book.pk})
+
+        response = self.client_authenticated.post(url, {'content': 'reply', 'parent': parent.pk}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('parent', response.data)
+        self.assertEqual(Comment.objects.count(), 1)
+
+    def test_recount_after_bulk_delete(self):
+        """
+        Тест пересчета числа ответов после удаления в обход Comment.delete
+        """
+        root = self._comment('root')
+        child = self._comment('child', parent=root)
+        self._comment('grandchild', parent=child)
+        Comment.objects.filter(pk=child.pk).delete()
+        root.refresh_from_db()
+        self.assertEqual(root.replies_count, 2)
+
+        call_command('rebuild_comment_tree', counts=True, stdout=StringIO())
+        root.refresh_from_db()
+        self.assertEqual(root.replies_count, 0)
+
+
+class RatingConcurrencyTests(UserSetupMixin, BookSetupMixin, APITestCase):
+    def test_concurrent_first_rating_becomes_update(self):
+        """
+        Тест первой оценки, которую параллельный запрос успел записать раньше
+        """
+        Rating.objects.create(book=self.book, user=self.user, rating=3)
+        RatingAggregateService.reconcile([self.book.pk])
+        url = reverse('rating', kwargs={'book_pk': self.book.pk})
+
+        # Блокировка не нашла строку: так выглядит гонка двух первых оценок
+        with mock.patch('django.db.models.query.QuerySet.first', return_value=None):
+            response = self.client_authenticated.post(url, {'rating': 5})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(Rating.objects.get(book=self.book, user=self.user).rating, 5)
+        self.book.refresh_from_db()
+        self.assertEqual((self.book.rating_count, self.book.rating_sum), (1, 5))
+
+
+class RatingBulkTests(UserSetupMixin, BookSetupMixin, APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.url = reverse('rating-bulk')
+        self.other_book = Book.objects.create(title='Other Book', genre=self.genre)
+
+    def test_bulk_upsert_outcomes(self):
+        """
+        Тест исходов пакетной записи оценок
+        """
+        Rating.objects.create(book=self.book, user=self.user, rating=2)
+        self.book.rating_count, self.book.rating_sum, self.book.rating_2_count = 1, 2, 1
+        self.book.save()
+
+        data = [
+            {'book': self.book.pk, 'rating': 5},
+            {'book': self.other_book.pk, 'rating': 1},
+            {'book': self.other_book.pk, 'rating': 3},
+            {'book': 9999, 'rating': 4},
+        ]
+        response = self.client_authenticated.post(self.url, data=data, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [item['status'] for item in response.data['results']],
+            ['updated', 'superseded', 'created', 'not_found'],
+        )
+        self.assertEqual(Rating.objects.get(book=self.other_book).rating, 3)
+        self.book.refresh_from_db()
+        self.other_book.refresh_from_db()
+        self.assertEqual((self.book.rating_count, self.book.rating_average), (1, 5.0))
+        self.assertEqual(self.other_book.rating_histogram, {'1': 0, '2': 0, '3': 1, '4': 0, '5': 0})
+
+    def test_unchanged_rating_is_not_written(self):
+        """
+        Тест повторной отправки той же оценки
+        """
+        data = [{'book': self.book.pk, 'rating': 4}]
+        self.client_authenticated.post(self.url, data=data, format='json')
+        response = self.client_authenticated.post(self.url, data=data, format='json')
+
+        self.assertEqual(response.data['results'][0]['status'], 'unchanged')
+        self.book.refresh_from_db()
+        self.assertEqual(self.book.rating_count, 1)
+
+    def test_invalid_items_reject_batch(self):
+        """
+        Тест отклонения пакета с невалидной оценкой
+        """
+        data = [{'book': self.book.pk, 'rating': 4}, {'book': self.other_book.pk, 'rating': 9}]
+        response = self.client_authenticated.post(self.url, data=data, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('rating', response.data[1])
+        self.assertFalse(Rating.objects.exists())
+
+    def test_concurrent_first_rating_counts_as_update(self):
+        """
+        Тест первой оценки, которую параллельный запрос вставил между
+        чтением прежних оценок и записью пакета
+        """
+        write = RatingBulkService.write
+
+        def concurrent_write(changes):
+            if not Rating.objects.exists():
+                Rating.objects.create(book=self.book, user=self.user, rating=3)
+                RatingAggregateService.apply(self.book.pk, 3)
+            write(changes)
+
+        data = [{'book': self.book.pk, 'rating': 5}]
+        with mock.patch.object(RatingBulkService, 'write', side_effect=concurrent_write):
+            response = self.client_authenticated.post(self.url, data=data, format='json')
+
+        self.assertEqual(response.data['results'][0]['status'], 'updated')
+        self.book.refresh_from_db()
+        self.assertEqual((self.book.rating_count, self.book.rating_sum), (1, 5))
+        self.assertEqual(Rating.objects.get(book=self.book).rating, 5)
+
+
+@override_settings(RATING_WRITE_BEHIND={**settings.RATING_WRITE_BEHIND, 'ENABLED': True})
+class RatingWriteBehindTests(UserSetupMixin, BookSetupMixin, APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.url = reverse('rating', kwargs={'book_pk': self.book.pk})
+        self.other_book = Book.objects.create(title='Other Book', genre=self.genre)
+        write_behind.get_client().delete(write_behind.PENDING_KEY, write_behind.FLUSHING_KEY)
+
+    def test_pending_rating_visible_before_flush(self):
+        """
+        Тест чтения собственной оценки до сброса буфера
+        """
+        response = self.client_authenticated.post(self.url, data={'rating': 2}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.client_authenticated.post(self.url, data={'rating': 4}, format='json')
+
+        self.assertFalse(Rating.objects.exists())
+        response = self.client_authenticated.get(self.url)
+        self.assertEqual(response.data['rating'], 4)
+
+    def test_flush_writes_batch(self):
+        """
+        Тест сброса буфера в БД с пересчетом агрегатов
+        """
+        self.client_authenticated.post(self.url, data={'rating': 4}, format='json')
+
+        self.assertEqual(write_behind.flush(), 1)
+        self.assertEqual(Rating.objects.get(book=self.book, user=self.user).rating, 4)
+        self.book.refresh_from_db()
+        self.assertEqual(self.book.rating_average, 4.0)
+        self.assertEqual(self.client_authenticated.get(self.url).data['rating'], 4)
+        self.assertEqual(write_behind.flush(), 0)
+
+    def test_failed_flush_keeps_newer_ratings(self):
+        """
+        Тест возврата пачки в буфер при ошибке записи
+        """
+        client = write_behind.get_client()
+        client.hset(write_behind.FLUSHING_KEY, f'{self.user.pk}:{self.book.pk}', 2)
+        client.hset(write_behind.FLUSHING_KEY, f'{self.user.pk}:{self.other_book.pk}', 3)
+        write_behind.push(self.user.pk, self.book.pk, 5)
+
+        with mock.patch.object(RatingBulkService, 'write_pending', side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError):
+                write_behind.flush()
+        self.assertEqual(write_behind.pending_rating(self.user.pk, self.other_book.pk), 3)
+        self.assertEqual(write_behind.pending_rating(self.user.pk, self.book.pk), 5)
+        self.assertFalse(client.exists(write_behind.FLUSHING_KEY))
+
+    def test_flush_with_expired_lock_is_rolled_back(self):
+        """
+        Тест сброса, пережившего свою блокировку: запись откатывается,
+        а пачка и чужая блокировка остаются следующему сбросу
+        """
+        client = write_behind.get_client()
+        self.client_authenticated.post(self.url, data={'rating': 4}, format='json')
+        write_pending = RatingBulkService.write_pending
+
+        def slow_write_pending(pending):
+            written = write_pending(pending)
+            # Блокировка истекла, и ее взял следующий воркер
+            client.set(write_behind.LOCK_KEY, 'other')
+            return written
+
+        with mock.patch.object(RatingBulkService, 'write_pending', side_effect=slow_write_pending):
+            self.assertEqual(write_behind.flush(), 0)
+        self.assertFalse(Rating.objects.exists())
+        self.assertEqual(client.get(write_behind.LOCK_KEY), b'other')
+        self.assertEqual(write_behind.pending_rating(self.user.pk, self.book.pk), 4)
+
+        client.delete(write_behind.LOCK_KEY)
+        self.assertEqual(write_behind.flush(), 1)
+        self.assertEqual(Rating.objects.get(book=self.book, user=self.user).rating, 4)
+        self.assertFalse(client.exists(write_behind.LOCK_KEY))
+
+
+class ExportTests(UserSetupMixin, BookSetupMixin, APITestCase):
+    def setUp(self):
+        super().setUp()
+        for i in range(3):
+            book = Book.objects.create(title=f'Book {i}', genre=self.genre)
+            book.author.add(self.author)
+            ReadList.objects.create(user=self.user, book=book)
+        Rating.objects.create(user=self.user, book=self.book, rating=4)
+
+    def _content(self, response):
+        return b''.join(response.streaming_content).decode()
+
+    def test_read_list_ndjson(self):
+        """
+        Тест потоковой выгрузки списка прочитанного в NDJSON
+        """
+        url = reverse('export', kwargs={'dataset': 'read-list'})
+        response = self.client_authenticated.get(url)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        rows = [json.loads(line) for line in self._content(response).splitlines()]
+        self.assertEqual([row['title'] for row in rows], ['Book 2', 'Book 1', 'Book 0'])
+        self.assertEqual(rows[0]['authors'], ['Test Author'])
+
+    def test_ratings_csv(self):
+        """
+        Тест выгрузки оценок в CSV
+        """
+        url = reverse('export', kwargs={'dataset': 'ratings'}) + '?output=csv'
+        response = self.client_authenticated.get(url)
+
+        lines = self._content(response).splitlines()
+        self.assertEqual(lines[0], 'book,title,rating,created_at')
+        self.assertTrue(lines[1].startswith(f'{self.book.pk},Test Book,4,'))
+
+    def test_unknown_dataset_and_output(self):
+        """
+        Тест ошибок выгрузки
+        """
+        response = self.client_authenticated.get(reverse('export', kwargs={'dataset': 'users'}))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+        url = reverse('export', kwargs={'dataset': 'ratings'}) + '?output=xml'
+        response = self.client_authenticated.get(url)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class SparseFieldsetTests(UserSetupMixin, BookSetupMixin, APITestCase):
+    def setUp(self):
+        cache.clear()
+        super().setUp()
+
+    def test_fields_trim_response_and_queries(self):
+        """
+        Тест урезания полей книги и запросов к БД
+        """
+        url = reverse('book-list') + '?fields=title'
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+
+        self.assertEqual(response.data['results'][0], {'id': self.book.pk, 'title': 'Test Book'})
+        self.assertEqual(len(queries), 2)
+        self.assertNotIn('description', queries[-1]['sql'])
+
+    def test_expand_controls_nesting(self):
+        """
+        Тест отдачи связей id без expand и объектами с expand
+        """
+        url = reverse('book-list') + '?fields=author,genre&expand=genre'
+        response = self.client.get(url)
+        book = response.data['results'][0]
+        self.assertEqual(book['author'], [self.author.pk])
+        self.assertEqual(book['genre'], {'id': self.genre.pk, 'title': self.genre.title})
+
+    def test_read_list_book_fields(self):
+        """
+        Тест урезания полей книги в списке прочитанного
+        """
+        ReadList.objects.create(user=self.user, book=self.book)
+        response = self.client_authenticated.get('/api/v1/read-book/?fields=title&cursor=')
+        self.assertEqual(response.data['results'][0]['book_details'], {'id': self.book.pk, 'title': 'Test Book'})
+
+    def test_unknown_field(self):
+        """
+        Тест ошибки на неизвестное поле
+        """
+        response = self.client.get(reverse('book-list') + '?fields=title,secret')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('fields', response.data)
+
+
+class FastBookSerializerTests(BookSetupMixin, APITestCase):
+    def setUp(self):
+        super().setUp()
+        second = Author.objects.create(name='Second Author')
+        book = Book.objects.create(title='Second Book', genre=self.genre, rating_count=2, rating_sum=7, rating_average=3.5)
+        book.author.add(second, self.author)
+        Book.objects.create(title='No Authors', genre=self.genre)
+
+    def _render(self, fieldset):
+        queryset = Book.objects.order_by('id')
+        regular = BookSerializer(fieldset.narrow(queryset), many=True, context={'book_fieldset': fieldset}).data
+        serializer = FastBookSerializer(fieldset)
+        fast = serializer.serialize(list(serializer.values_queryset(queryset)))
+        return JSONRenderer().render(regular), JSONRenderer().render(fast)
+
+    def test_output_matches_book_serializer(self):
+        """
+        Тест побайтового совпадения с BookSerializer
+        """
+        for fieldset in [
+            BookFieldset(),
+            BookFieldset(fields={'title', 'author', 'genre'}, expand={'author'}),
+            BookFieldset(fields={'rating_histogram', 'rating_average'}),
+        ]:
+            regular, fast = self._render(fieldset)
+            self.assertEqual(regular, fast)
+
+    def test_bench_command(self):
+        """
+        Тест команды замера сериализаторов
+        """
+        out = StringIO()
+        call_command('bench_serializers', iterations=1, min_speedup=0, fields='title,author', stdout=out)
+        self.assertIn('Ускорение', out.getvalue())
+
+
+class FastJSONTests(UserSetupMixin, BookSetupMixin, APITestCase):
+    def test_renderer_matches_json_renderer(self):
+        """
+        Тест совпадения вывода с JSONRenderer на типах вне JSON
+        """
+        data = {
+            'created_at': datetime.datetime(2024, 5, 1, 12, 30, 15, 123456, tzinfo=datetime.timezone.utc),
+            'day': datetime.date(2024, 5, 1),
+            'price': Decimal('10.50'),
+            'label': gettext_lazy('Книга'),
+            'text': 'строка\u2028с разделителем',
+            'counts': {1: 2},
+            'ids': {3},
+        }
+        self.assertEqual(FastJSONRenderer().render(data), JSONRenderer().render(data))
+        self.assertEqual(
+            FastJSONRenderer().render(data, 'application/json; indent=4'),
+            JSONRenderer().render(data, 'application/json; indent=4'),
+        )
+
+    def test_parser(self):
+        """
+        Тест разбора тела запроса и ошибки на невалидном JSON
+        """
+        url = f'/api/v1/book/{self.book.pk}/ratings/'
+        response = self.client_authenticated.post(url, data='{"rating": 4}', content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        response = self.client_authenticated.post(url, data='{"rating": NaN}', content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('JSON parse error', response.data['detail'])
+
+    def test_render_benchmark_command(self):
+        """
+        Тест команды замера рендеринга
+        """
+        out = StringIO()
+        call_command('bench_renderers', iterations=1, stdout=out)
+        self.assertIn('ускорение', out.getvalue())
+
+
+@override_settings(
+    STORAGES={
+        'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+        'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'},
+    },
+    COVER_RENDITIONS={'STORAGE': 'django.core.files.storage.FileSystemStorage', 'WIDTHS': [160, 320]},
+)
+class CoverRenditionTests(BookSetupMixin, APITestCase):
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        settings_override = override_settings(MEDIA_ROOT=media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        super().setUp()
+
+    def _upload(self, width=400):
+        buffer = BytesIO()
+        Image.new('RGB', (width, 300), 'red').save(buffer, format='PNG')
+        with mock.patch('books.signals.process_book_cover.delay') as delay:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.book.cover_image.save('cover.png', ContentFile(buffer.getvalue()))
+        return delay
+
+    def test_upload_schedules_processing(self):
+        """
+        Тест постановки обработки обложки в очередь после загрузки
+        """
+        delay = self._upload()
+        delay.assert_called_once_with(self.book.pk)
+
+    def test_renditions_and_srcset(self):
+        """
+        Тест построения рендиций и srcset в ответе
+        """
+        self._upload()
+        self.assertTrue(process_cover(self.book.pk))
+        self.assertFalse(process_cover(self.book.pk))
+
+        self.book.refresh_from_db()
+        renditions = self.book.cover_renditions
+        self.assertEqual(renditions['source'], self.book.cover_image.name)
+        self.assertEqual(sorted(renditions['webp']), ['160', '320'])
+        with default_storage.open(renditions['webp']['320']) as rendition:
+            self.assertEqual(Image.open(rendition).size, (320, 240))
+
+        response = self.client.get(reverse('book-list'))
+        srcset = response.data['results'][0]['cover_srcset']
+        self.assertTrue(srcset['jpeg'].endswith('320w.jpg 320w'))
+        detail = self.client.get(reverse('book-detail', kwargs={'pk': self.book.pk}))
+        self.assertEqual(detail.data['cover_srcset'], srcset)
+
+    def test_small_original_is_not_upscaled(self):
+        """
+        Тест: оригинал уже самой малой ширины не увеличивается
+        """
+        self._upload(width=100)
+        process_cover(self.book.pk)
+        self.book.refresh_from_db()
+        self.assertEqual(list(self.book.cover_renditions['webp']), ['100'])
+
+
+class CachedURLStorageTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.names = [f'book_covers/{i}.jpg' for i in range(100)]
+
+    def _storage(self):
+        # Подпись ссылок не ходит в сеть, endpoint - локальная замена S3 (MinIO)
+        return CoverStorage(
+            access_key='test', secret_key='test', bucket_name='covers',
+            endpoint_url='http://localhost:9000', region_name='us-east-1',
+        )
+
+    def test_presigned_urls_are_signed_once(self):
+        """
+        Тест кэширования подписанных ссылок по ключу объекта
+        """
+        with mock.patch.object(S3Boto3Storage, 'url', autospec=True, side_effect=S3Boto3Storage.url) as sign:
+            storage = self._storage()
+            storage.prefetch_urls(self.names)
+            first = [storage.url(name) for name in self.names]
+            self.assertEqual(sign.call_count, 100)
+            self.assertIn('Signature', first[0])
+
+            other_worker = self._storage()
+            other_worker.prefetch_urls(self.names)
+            self.assertEqual([other_worker.url(name) for name in self.names], first)
+            self.assertEqual(sign.call_count, 100)
+
+    @override_settings(MEDIA_URLS={'MODE': 'public', 'BASE_URL': 'https://cdn.example.com/'})
+    def test_public_urls_are_stable(self):
+        """
+        Тест постоянных ссылок от адреса CDN без подписи
+        """
+        with mock.patch.object(S3Boto3Storage, 'url') as sign:
+            url = self._storage().url('book_covers/обложка 1.jpg')
+        sign.assert_not_called()
+        self.assertEqual(url, 'https://cdn.example.com/book_covers/%D0%BE%D0%B1%D0%BB%D0%BE%D0%B6%D0%BA%D0%B0%201.jpg')
+
+    @override_settings(MEDIA_URLS={'MODE': 'public', 'BASE_URL': 'https://cdn.example.com/'})
+    def test_renditions_share_cover_prefix(self):
+        """
+        Тест: рендиции лежат в хранилище оригиналов, рядом с ними
+        """
+        storage = covers.get_storage()
+        self.assertIsInstance(storage, CoverStorage)
+        path = covers.rendition_name('book_covers/x.png', 320, 'webp')
+        self.assertEqual(storage.url(path), 'https://cdn.example.com/book_covers/x/320w.webp')
+
+
+class CoverUploadTests(UserSetupMixin, BookSetupMixin, APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.admin = APIClient()
+        self.admin.force_authenticate(User.objects.create_superuser('admin', 'admin@testuser.ru', 'testpassword'))
+        self.upload_url = reverse('book-cover-upload', kwargs={'pk': self.book.pk})
+        self.complete_url = reverse('book-cover-complete', kwargs={'pk': self.book.pk})
+
+    def test_issue_presigned_post(self):
+        """
+        Тест выдачи подписанной формы загрузки с ключом в book_covers/
+        """
+        response = self.admin.post(self.upload_url, {'content_type': 'image/webp'}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        fields = response.data['fields']
+        self.assertTrue(fields['key'].startswith(f'book_covers/uploads/{self.book.pk}/'))
+        self.assertTrue(fields['key'].endswith('.webp'))
+        self.assertEqual(fields['Content-Type'], 'image/webp')
+        self.assertIn('policy', fields)
+        self.assertIn('token', response.data)
+
+    def test_upload_requires_admin(self):
+        """
+        Тест запрета загрузки обложки не администратору
+        """
+        response = self.client_authenticated.post(self.upload_url, {'content_type': 'image/png'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+        response = self.admin.post(self.upload_url, {'content_type': 'image/gif'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_complete_rejects_foreign_token(self):
+        """
+        Тест отказа в привязке по чужому или поддельному токену
+        """
+        other_book = Book.objects.create(title='Other Book', genre=self.genre)
+        other_url = reverse('book-cover-upload', kwargs={'pk': other_book.pk})
+        token = self.admin.post(other_url, {'content_type': 'image/png'}, format='json').data['token']
+
+        for value in (token, 'forged'):
+            response = self.admin.post(self.complete_url, {'token': value}, format='json')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+            self.assertIn('token', response.data)
+        self.book.refresh_from_db()
+        self.assertFalse(self.book.cover_image)
+
+
+class SearchOutboxTests(BookSetupMixin, APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.other_book = Book.objects.create(title='Other Book', genre=self.genre)
+        self.other_book.author.add(self.author)
+        SearchOutbox.objects.all().delete()
+
+    def outbox_book_ids(self):
+        return set(SearchOutbox.objects.values_list('book_id', flat=True))
+
+    def test_author_and_genre_renames_fan_out(self):
+        """
+        Тест отметки всех книг автора и жанра при их переименовании
+        """
+        self.author.name = 'Renamed Author'
+        self.author.save()
+        self.assertEqual(self.outbox_book_ids(), {self.book.pk, self.other_book.pk})
+
+        SearchOutbox.objects.all().delete()
+        self.genre.title = 'Renamed Genre'
+        self.genre.save()
+        self.assertEqual(self.outbox_book_ids(), {self.book.pk, self.other_book.pk})
+
+    def test_author_links_and_delete_fan_out(self):
+        """
+        Тест отметки книг при изменении связей с автором и его удалении
+        """
+        new_author = Author.objects.create(name='New Author')
+        self.assertEqual(self.outbox_book_ids(), set())
+
+        new_author.book_set.add(self.book)
+        self.assertEqual(self.outbox_book_ids(), {self.book.pk})
+
+        SearchOutbox.objects.all().delete()
+        self.author.delete()
+        self.assertEqual(self.outbox_book_ids(), {self.book.pk, self.other_book.pk})
+
+    def test_outbox_rolls_back_with_transaction(self):
+        """
+        Тест отката отметки вместе с изменением книги
+        """
+        try:
+            with transaction.atomic():
+                self.book.title = 'Changed'
+                self.book.save()
+                raise DatabaseError
+        except DatabaseError:
+            pass
+        self.assertFalse(SearchOutbox.objects.exists())
+
+    def test_drain_deduplicates_into_one_bulk_request(self):
+        """
+        Тест разбора outbox: одна bulk-операция на книгу, удаление пропавших
+        """
+        self.book.save()
+        self.book.save()
+        deleted_pk = self.other_book.pk
+        self.other_book.delete()
+
+        with mock.patch('books.search_sync.bulk', return_value=(0, [])) as bulk:
+            call_command('drain_search_outbox', stdout=StringIO())
+
+        bulk.assert_called_once()
+        actions = {(action['_op_type'], action['_id']) for action in bulk.call_args.args[1]}
+        self.assertEqual(actions, {('index', self.book.pk), ('delete', deleted_pk)})
+        self.assertEqual(len(bulk.call_args.args[1]), 2)
+        self.assertFalse(SearchOutbox.objects.exists())
+
+    def test_drain_keeps_rows_on_failure(self):
+        """
+        Тест сохранения outbox при ошибке Elasticsearch
+        """
+        self.book.save()
+        with mock.patch('books.search_sync.bulk', side_effect=ConnectionError):
+            with self.assertRaises(ConnectionError):
+                search_sync.drain()
+        self.assertEqual(self.outbox_book_ids(), {self.book.pk})
+
+    def test_rejected_document_does_not_block_outbox(self):
+        """
+        Тест отказа ES по одной книге: остальные строки снимаются, а строка
+        этой книги копит попытки и после MAX_ATTEMPTS откладывается
+        """
+        self.book.save()
+        self.other_book.save()
+        rejected = {'index': {'_id': str(self.book.pk), 'status': 400, 'error': {'type': 'mapper_parsing_exception'}}}
+        with override_settings(SEARCH_OUTBOX={'MAX_ATTEMPTS': 2}), \
+                mock.patch('books.search_sync.bulk', return_value=(1, [rejected])) as bulk:
+            self.assertEqual(search_sync.drain(), 2)
+            self.assertEqual(self.outbox_book_ids(), {self.book.pk})
+            self.assertEqual(search_sync.drain(), 1)
+            self.assertEqual(search_sync.drain(), 0)
+            self.assertEqual(search_sync.parked_count(), 1)
+
+            self.assertEqual(search_sync.requeue_parked(), 1)
+            bulk.return_value = (1, [])
+            self.assertEqual(search_sync.drain(), 1)
+        self.assertFalse(SearchOutbox.objects.exists())
+
+
+class ReindexTests(BookSetupMixin, APITestCase):
+    def setUp(self):
+        super().setUp()
+        for number in range(6):
+            Book.objects.create(title=f'Book {number}', genre=self.genre)
+
+    def test_chunk_ranges_cover_all_books(self):
+        """
+        Тест разбиения книг на диапазоны ключей без пропусков и пересечений
+        """
+        ranges = list(reindex.chunk_ranges(3))
+        pks = list(Book.objects.order_by('pk').values_list('pk', flat=True))
+
+        self.assertEqual(len(ranges), 3)
+        self.assertEqual(ranges[0][0], 0)
+        self.assertEqual(ranges[-1][1], pks[-1])
+        for (_, hi), (lo, _) in zip(ranges, ranges[1:]):
+            self.assertEqual(hi, lo)
+        covered = [pk for lo, hi in ranges for pk in pks if lo < pk <= hi]
+        self.assertEqual(covered, pks)
+
+    def test_index_chunk_targets_new_index(self):
+        """
+        Тест загрузки диапазона книг в новый индекс, а не в алиас
+        """
+        pks = list(Book.objects.order_by('pk').values_list('pk', flat=True))
+        with mock.patch('books.reindex.bulk', return_value=(3, [])) as bulk:
+            reindex.index_chunk('books-new', pks[0], pks[2])
+
+        actions = list(bulk.call_args.args[1])
+        self.assertEqual([action['_id'] for action in actions], pks[1:3])
+        self.assertEqual({action['_index'] for action in actions}, {'books-new'})
+        self.assertEqual(actions[0]['_source']['genre']['title'], self.genre.title)
+
+    def test_failed_reindex_deletes_new_index(self):
+        """
+        Тест удаления недостроенного индекса и снятия паузы outbox при ошибке
+        """
+        from books.management.commands.reindex_books import Command as ReindexCommand
+
+        with mock.patch('books.reindex.create_index'), \
+                mock.patch('books.reindex.new_index_name', return_value='books-new'), \
+                mock.patch('books.reindex.delete_index') as delete_index, \
+                mock.patch('books.reindex.swap_alias') as swap_alias, \
+                mock.patch.object(ReindexCommand, 'load', side_effect=ConnectionTimeout('TIMEOUT', 'timed out', None)):
+            with self.assertRaises(ConnectionTimeout):
+                call_command('reindex_books', replicas=1, stdout=StringIO())
+
+        delete_index.assert_called_once_with('books-new')
+        swap_alias.assert_not_called()
+        self.assertFalse(search_sync.is_paused())
+
+    def test_failed_old_index_delete_keeps_new_index(self):
+        """
+        Тест ошибки удаления прежнего индекса: новый индекс и алиас остаются
+        """
+        from books.management.commands.reindex_books import Command as ReindexCommand
+
+        client = mock.Mock()
+        client.indices.exists_alias.return_value = True
+        client.indices.get_alias.return_value = {'books-old': {}}
+        client.indices.delete.side_effect = TransportError(500, 'internal_server_error', None)
+        out = StringIO()
+        with mock.patch('books.documents.BookDocument._get_connection', return_value=client), \
+                mock.patch('books.reindex.create_index'), \
+                mock.patch('books.reindex.finish_index'), \
+                mock.patch('books.reindex.merge_index', return_value=True), \
+                mock.patch('books.reindex.new_index_name', return_value='books-new'), \
+                mock.patch('books.search_sync.drain_all', return_value=0), \
+                mock.patch.object(ReindexCommand, 'load', return_value=6):
+            call_command('reindex_books', replicas=1, stdout=out)
+
+        actions = client.indices.update_aliases.call_args.kwargs['body']['actions']
+        self.assertIn({'add': {'index': 'books-new', 'alias': reindex.alias_name()}}, actions)
+        client.indices.delete.assert_called_once()
+        self.assertEqual(client.indices.delete.call_args.kwargs['index'], 'books-old')
+        self.assertIn('не удалены: books-old', out.getvalue())
+        self.assertFalse(search_sync.is_paused())
+
+    def test_merge_timeout_is_not_fatal(self):
+        """
+        Тест слияния сегментов: таймаут ответа ES не считается ошибкой перестроения
+        """
+        client = mock.Mock()
+        client.indices.forcemerge.side_effect = ConnectionTimeout('TIMEOUT', 'timed out', None)
+        with mock.patch('books.documents.BookDocument._get_connection', return_value=client):
+            self.assertFalse(reindex.merge_index('books-new', timeout=5))
+        self.assertEqual(client.indices.forcemerge.call_args.kwargs['request_timeout'], 5)
+
+    def test_paused_outbox_is_not_drained(self):
+        """
+        Тест паузы разбора outbox на время перестроения индекса
+        """
+        search_sync.pause()
+        self.addCleanup(search_sync.resume)
+        with mock.patch('books.search_sync.bulk', return_value=(0, [])) as bulk:
+            self.assertEqual(search_sync.drain(), 0)
+        bulk.assert_not_called()
+        self.assertTrue(SearchOutbox.objects.exists())
+
+
+class SearchSignalsTests(UserSetupMixin, BookSetupMixin, APITestCase):
+    def setUp(self):
+        super().setUp()
+        SearchOutbox.objects.all().delete()
+
+    def outbox(self):
+        return set(SearchOutbox.objects.values_list('book_id', 'partial'))
+
+    def test_activity_records_partial_updates(self):
+        """
+        Тест отметки книги для частичного обновления при оценке и добавлении в список
+        """
+        url = f'/api/v1/book/{self.book.pk}/ratings/'
+        self.client_authenticated.post(url, {'rating': 4}, format='json')
+        self.assertEqual(self.outbox(), {(self.book.pk, True)})
+
+        SearchOutbox.objects.all().delete()
+        response = self.client_authenticated.post(
+            reverse('read-book-bulk-add'), {'books': [self.book.pk]}, format='json'
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.outbox(), {(self.book.pk, True)})
+
+    def test_bulk_read_list_records_once(self):
+        """
+        Тест пакетных изменений списка: одна вставка в outbox, только по
+        действительно добавленным или удаленным книгам
+        """
+        books = [Book.objects.create(title=f'Book {i}', genre=self.genre) for i in range(5)]
+        ReadList.objects.create(user=self.user, book=self.book)
+        SearchOutbox.objects.all().delete()
+
+        data = {'books': [self.book.pk] + [book.pk for book in books]}
+        self.client_authenticated.post(reverse('read-book-bulk-add'), data, format='json')
+        self.assertEqual(self.outbox(), {(book.pk, True) for book in books})
+
+        SearchOutbox.objects.all().delete()
+        data = {'books': [book.pk for book in books[:3]]}
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client_authenticated.post(reverse('read-book-bulk-remove'), data, format='json')
+        self.assertEqual(response.data, {'removed': 3})
+        self.assertEqual(self.outbox(), {(book.pk, True) for book in books[:3]})
+        inserts = [query for query in queries if query['sql'].startswith('INSERT')]
+        self.assertEqual(len(inserts), 1)
+
+    def test_drain_sends_partial_updates(self):
+        """
+        Тест частичного обновления полей популярности без переиндексации книги
+        """
+        other_book = Book.objects.create(title='Other Book', genre=self.genre)
+        Rating.objects.create(book=self.book, user=self.user, rating=5)
+        ReadList.objects.create(book=self.book, user=self.user)
+        ReadList.objects.create(book=other_book, user=self.user)
+
+        with mock.patch('books.search_sync.bulk', return_value=(0, [])) as bulk:
+            search_sync.drain()
+
+        actions = {action['_id']: action for action in bulk.call_args.args[1]}
+        self.assertEqual(actions[other_book.pk]['_op_type'], 'index')
+        update = actions[self.book.pk]
+        self.assertEqual(update['_op_type'], 'update')
+        self.assertEqual(set(update['doc']), set(SIGNAL_FIELDS))
+        self.assertEqual(update['doc']['rating_histogram'], self.book.rating_histogram)
+        self.assertEqual(update['doc']['readers_count'], 1)
+        self.assertEqual(update['doc']['last_activity'], ReadList.objects.get(book=self.book).date_added)
+
+    def test_rank_wraps_query_in_function_score(self):
+        """
+        Тест ранжирования по релевантности и сигналам популярности
+        """
+        search = search_ranking.rank(BookDocument.search().query('match', title='test'))
+        query = search.to_dict()['query']['function_score']
+
+        self.assertEqual(query['query'], {'match': {'title': 'test'}})
+        self.assertEqual(query['boost_mode'], 'multiply')
+        fields = [
+            function.get('field_value_factor', {}).get('field') or next(iter(function.get('gauss', {})), None)
+            for function in query['functions']
+        ]
+        self.assertEqual(fields, [None, 'rating_average', 'rating_count', 'readers_count', 'last_activity'])
+        self.assertEqual(query['functions'][-1]['filter'], {'exists': {'field': 'last_activity'}})
+
+
+class SearchResultModeTests(UserSetupMixin, BookSetupMixin, APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.second_author = Author.objects.create(name='Second Author')
+        self.book.author.add(self.second_author)
+        self.book.cover_renditions = {'source': 'book_covers/x.png', 'webp': {'160': 'book_covers/x/160w.webp'}}
+        self.book.save()
+        self.other_book = Book.objects.create(title='Other Book', genre=self.genre, rating_count=2)
+
+    def expected(self, *books, **params):
+        request = Request(APIRequestFactory().get('/', params))
+        books = [Book.objects.get(pk=book.pk) for book in books]
+        return BookSerializer(books, many=True, context={'request': request}).data
+
+    def test_source_mode_matches_book_serializer(self):
+        """
+        Тест карточек из _source: совпадают с BookSerializer без запросов к БД
+        """
+        document = BookDocument()
+        books = document.get_queryset().filter(pk__in=[self.book.pk, self.other_book.pk]).order_by('-pk')
+        sources = [{**document.prepare(book), 'id': book.pk} for book in books]
+        request = Request(APIRequestFactory().get('/'))
+
+        with self.assertNumQueries(0):
+            data = FastBookSerializer(request=request).from_source(sources)
+        self.assertEqual(data, self.expected(self.other_book, self.book))
+
+    def test_hydrated_mode_keeps_search_order(self):
+        """
+        Тест загрузки найденных книг из БД в порядке выдачи ES
+        """
+        request = Request(APIRequestFactory().get('/', {'expand': 'author'}))
+        serializer = FastBookSerializer(BookFieldset.from_request(request), request)
+
+        with self.assertNumQueries(2):
+            data = serializer.hydrate([self.other_book.pk, 999999, self.book.pk])
+        self.assertEqual(data, self.expected(self.other_book, self.book, expand='author'))
+
+    def test_unknown_mode_rejected(self):
+        """
+        Тест отказа на неизвестный режим выдачи поиска
+        """
+        response = self.client_unauthenticated.get('/api/v1/book-search/', {'mode': 'raw'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('mode', response.data)
+
+
+@override_settings(AUTOCOMPLETE={**settings.AUTOCOMPLETE, 'ENABLED': True})
+class AutocompleteTests(UserSetupMixin, BookSetupMixin, APITestCase):
+    def setUp(self):
+        super().setUp()
+        config = autocomplete.get_config()
+        autocomplete.get_client().delete(config['STREAM_KEY'], config['WORKERS_KEY'])
+        index_patch = mock.patch.object(autocomplete, 'index', autocomplete.TitleIndex())
+        index_patch.start()
+        self.addCleanup(index_patch.stop)
+
+        self.popular = Book.objects.create(title='Ёжик в тумане', genre=self.genre, rating_count=10)
+        self.obscure = Book.objects.create(title='Ежики и лисы', genre=self.genre)
+        Book.objects.create(title='Война и мир', genre=self.genre)
+
+    def test_prefix_lookup_ranks_by_popularity(self):
+        """
+        Тест подсказок по началу названия без учета регистра и ё, популярные первыми
+        """
+        found = autocomplete.index.suggest('ЕЖИК')
+        self.assertEqual([pk for pk, _, _ in found], [self.popular.pk, self.obscure.pk])
+        self.assertEqual(autocomplete.index.suggest('ежик в'), [(self.popular.pk, 'Ёжик в тумане', 10)])
+        self.assertEqual(autocomplete.index.suggest('???'), [])
+
+    def test_refresh_applies_change_feed(self):
+        """
+        Тест дочитывания ленты изменений после разбора outbox
+        """
+        self.assertEqual(len(autocomplete.index.suggest('еж')), 2)
+        self.obscure.title = 'Лисы'
+        self.obscure.save()
+        self.popular.delete()
+        with mock.patch('books.search_sync.bulk', return_value=(0, [])):
+            with self.captureOnCommitCallbacks(execute=True):
+                search_sync.drain()
+
+        autocomplete.index.checked_at = 0
+        self.assertEqual(autocomplete.index.suggest('еж'), [])
+        self.assertEqual([pk for pk, _, _ in autocomplete.index.suggest('лис')], [self.obscure.pk])
+
+        stats = autocomplete.worker_stats()
+        self.assertEqual(len(stats), 1)
+        self.assertEqual(next(iter(stats.values()))['entries'], 3)
+
+    def test_snapshot_replace_patches_short_prefixes(self):
+        """
+        Тест обновления снимка: заранее посчитанные широкие префиксы и памятка
+        остальных совпадают с полным пересчетом
+        """
+        rows = {pk: (pk, title, weight) for pk, title, weight in [
+            (1, 'Ab', 5), (2, 'Ac', 4), (3, 'Ad', 3), (4, 'Ae', 2), (5, 'Bfg', 1),
+        ]}
+        config = {**settings.AUTOCOMPLETE, 'TOP_SPAN': 2, 'TOP_DEPTH': 2, 'SIZE': 1}
+        with override_settings(AUTOCOMPLETE=config):
+            snapshot = autocomplete.Snapshot.build(rows.values())
+            self.assertEqual(snapshot.top['a'][1], True)
+            snapshot.lookup('bfg', 1)
+
+            rows[1] = (1, 'Ab', 0)
+            rows[6] = (6, 'Az', 9)
+            del rows[2]
+            snapshot = snapshot.replace({1, 2, 6}, [rows[1], rows[6]])
+            self.assertIn(('bfg', 1), snapshot._memo)
+
+            expected = autocomplete.Snapshot.build(rows.values())
+            for prefix in ('a', 'ab', 'az', 'b', 'bfg'):
+                for size in (1, 2, 5):
+                    self.assertEqual(snapshot.lookup(prefix, size), expected.lookup(prefix, size), (prefix, size))
+            self.assertEqual(len(snapshot), 5)
+            self.assertEqual(set(snapshot.top), {'a'})
+
+    def test_redis_outage_keeps_snapshot(self):
+        """
+        Тест недоступного Redis: загруженный снимок продолжает отвечать,
+        а без снимка подсказки уходят в ES
+        """
+        client = autocomplete.get_client()
+        with mock.patch.object(client, 'xrevrange', side_effect=redis.ConnectionError):
+            self.assertEqual(autocomplete.index.suggest('еж'), [])
+        self.assertIsNone(autocomplete.index.snapshot)
+
+        autocomplete.index.checked_at = 0
+        self.assertEqual(len(autocomplete.index.suggest('еж')), 2)
+        autocomplete.index.checked_at = 0
+        with mock.patch.object(client, 'xrange', side_effect=redis.ConnectionError):
+            self.assertEqual(len(autocomplete.index.suggest('еж')), 2)
+
+    def test_suggest_endpoint_answers_locally(self):
+        """
+        Тест ответа suggest в формате ES без обращения к ES
+        """
+        with mock.patch('django_elasticsearch_dsl_drf.viewsets.SuggestMixin.suggest') as es_suggest:
+            response = self.client_unauthenticated.get('/api/v1/book-search/suggest/', {'title__completion': 'еж'})
+        es_suggest.assert_not_called()
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        options = response.data['title__completion'][0]['options']
+        self.assertEqual([option['_id'] for option in options], [str(self.popular.pk), str(self.obscure.pk)])
+        self.assertEqual(options[0]['text'], 'Ёжик в тумане')
+
+
+class SearchCacheTests(BookSetupMixin, APITestCase):
+    url = '/api/v1/book-search/'
+
+    def setUp(self):
+        cache.clear()
+        super().setUp()
+        SearchOutbox.objects.all().delete()
+        search_list = mock.patch.object(
+            BookDocumentView, 'search_list', autospec=True,
+            side_effect=lambda view, request, *args, **kwargs: Response({'results': []}),
+        )
+        self.search_list = search_list.start()
+        self.addCleanup(search_list.stop)
+
+    def test_equivalent_queries_share_entry(self):
+        """
+        Тест одного ключа кэша для запросов, отличающихся регистром, пробелами и умолчаниями
+        """
+        first = self.client.get(self.url, {'search': 'Harry  Potter', 'fields': 'title,id'})
+        second = self.client.get(self.url, {'fields': 'id,title', 'search': ' harry potter', 'page': '1'})
+        other = self.client.get(self.url, {'search': 'harry potter', 'page': '2'})
+
+        self.assertEqual(first['X-Cache'], 'MISS')
+        self.assertEqual(second['X-Cache'], 'HIT')
+        self.assertEqual(other['X-Cache'], 'MISS')
+        self.assertEqual(self.search_list.call_count, 2)
+        self.assertEqual(get_stats(search_cache.STATS_NAMESPACE)['hit'], 1)
+
+    def test_index_write_bumps_generation(self):
+        """
+        Тест сброса кэша поиска записью книги в индекс, но не обновлением популярности
+        """
+        self.client.get(self.url, {'search': 'test'})
+        search_sync.record_signals([self.book.pk])
+        with mock.patch('books.search_sync.bulk', return_value=(0, [])):
+            search_sync.drain()
+        self.assertEqual(self.client.get(self.url, {'search': 'test'})['X-Cache'], 'HIT')
+
+        self.book.save()
+        with mock.patch('books.search_sync.bulk', return_value=(0, [])):
+            search_sync.drain()
+        self.assertEqual(self.client.get(self.url, {'search': 'test'})['X-Cache'], 'REVALIDATED')
+
+    def test_timeouts_per_query(self):
+        """
+        Тест времени жизни по действию и глубине страницы
+        """
+        factory = APIRequestFactory()
+        config = search_cache.get_config()
+        self.assertEqual(search_cache.timeout(Request(factory.get('/')), 'list'), config['TIMEOUT'])
+        self.assertEqual(search_cache.timeout(Request(factory.get('/')), 'suggest'), config['TIMEOUTS']['suggest'])
+        deep = Request(factory.get('/', {'page': config['DEEP_PAGE']}))
+        self.assertEqual(search_cache.timeout(deep, 'list'), config['DEEP_PAGE_TIMEOUT'])
+
+
+class SearchFacetTests(BookSetupMixin, APITestCase):
+    url = '/api/v1/book-search/'
+
+    def setUp(self):
+        cache.clear()
+        super().setUp()
+        self.source = {**BookDocument().prepare(BookDocument().get_queryset().get(pk=self.book.pk))}
+
+    def es_response(self, search):
+        return ESResponse(search, {
+            'hits': {'total': {'value': 1, 'relation': 'eq'}, 'hits': [
+                {'_index': 'books', '_id': str(self.book.pk), '_score': 1.0, '_source': self.source},
+            ]},
+            'aggregations': {
+                'genre': {'doc_count': 3, 'genre': {'buckets': [{'key': 'Test Genre', 'doc_count': 3}]}},
+                'author': {'doc_count': 1, 'author': {'buckets': [{'key': 'Test Author', 'doc_count': 1}]}},
+            },
+        })
+
+    def test_facets_and_hits_in_one_request(self):
+        """
+        Тест выдачи, числа найденных и фасетов из одного запроса к ES
+        """
+        searches = []
+
+        def execute(search, *args, **kwargs):
+            searches.append(search.to_dict())
+            return self.es_response(search)
+
+        with mock.patch.object(Search, 'execute', autospec=True, side_effect=execute), \
+                mock.patch.object(Search, 'count', side_effect=AssertionError):
+            response = self.client.get(self.url, {'genre': ['Test Genre', 'Other'], 'author': 'Test Author'})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(searches), 1)
+        self.assertEqual(response.data['count'], 1)
+        self.assertEqual([book['id'] for book in response.data['results']], [self.book.pk])
+        self.assertEqual(response.data['facets']['genre'], [
+            {'value': 'Test Genre', 'count': 3, 'selected': True},
+            {'value': 'Other', 'count': 0, 'selected': True},
+        ])
+        self.assertEqual(response.data['facets']['author'], [{'value': 'Test Author', 'count': 1, 'selected': True}])
+
+    def test_facet_counts_ignore_own_selection(self):
+        """
+        Тест post_filter по выбору и агрегаций, учитывающих выбор только в других фасетах
+        """
+        view = BookDocumentView()
+        view.action = 'list'
+        request = Request(APIRequestFactory().get(self.url, {'genre': 'Test Genre', 'author': ['B', 'A']}))
+        body = FacetFilterBackend().filter_queryset(request, Search(), view).to_dict()
+
+        genre_filter = {'terms': {'genre.title.raw': ['Test Genre']}}
+        author_filter = {'terms': {'author.name.raw': ['A', 'B']}}
+        self.assertEqual(body['post_filter'], {'bool': {'filter': [genre_filter, author_filter]}})
+        self.assertEqual(body['aggs']['genre']['filter'], {'bool': {'filter': [author_filter]}})
+        self.assertEqual(body['aggs']['author']['filter'], {'bool': {'filter': [genre_filter]}})
+        self.assertEqual(body['aggs']['author']['aggs']['author']['terms']['field'], 'author.name.raw')
+
+
+class SearchBackendTests(BookSetupMixin, APITestCase):
+    url = '/api/v1/book-search/'
+
+    def setUp(self):
+        cache.clear()
+        super().setUp()
+        self.other_genre = Genre.objects.create(title='Other Genre')
+        self.other = Book.objects.create(title='Other Book', genre=self.other_genre)
+        self.other.author.add(self.author)
+
+    def test_failover_to_postgres_when_es_unavailable(self):
+        """
+        Тест ответа запасного поиска в том же формате, когда ES недоступен
+        """
+        fallback = Response({'count': 0, 'next': None, 'previous': None, 'facets': {}, 'results': []})
+        with mock.patch.object(search_backends.elasticsearch, 'list', side_effect=ESConnectionError('N/A', 'refused', OSError('refused'))), \
+                mock.patch.object(search_backends.postgres, 'list', return_value=fallback) as postgres_list:
+            response = self.client.get(self.url, {'search': 'test'})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['X-Search-Backend'], search_backends.POSTGRES)
+        self.assertEqual(postgres_list.call_count, 1)
+
+    @override_settings(SEARCH_BACKEND={'FAILURE_THRESHOLD': 2, 'RESET_TIMEOUT': 30})
+    def test_breaker_opens_and_probes(self):
+        """
+        Тест размыкания цепи после порога ошибок и пробного запроса после паузы
+        """
+        breaker = search_backends.CircuitBreaker('test')
+        primary = mock.Mock(side_effect=ESConnectionError('N/A', 'refused', OSError('refused')))
+        for _ in range(3):
+            self.assertEqual(breaker.call(primary, lambda: 'fallback'), 'fallback')
+        self.assertEqual(primary.call_count, 2)
+        self.assertEqual(breaker.state()[0], 'open')
+
+        primary.side_effect = None
+        primary.return_value = 'primary'
+        with mock.patch('books.search_backends.time.time', return_value=time.time() + 31):
+            self.assertEqual(breaker.state()[0], 'half-open')
+            self.assertEqual(breaker.call(primary, lambda: 'fallback'), 'primary')
+        self.assertEqual(breaker.state()[0], 'closed')
+
+    def test_client_errors_do_not_trip_breaker(self):
+        """
+        Тест ошибки запроса к ES (4xx): она не уводит в запасной поиск
+        """
+        breaker = search_backends.CircuitBreaker('test')
+        primary = mock.Mock(side_effect=TransportError(400, 'parsing_exception'))
+        with self.assertRaises(TransportError):
+            breaker.call(primary, lambda: 'fallback')
+        self.assertEqual(breaker.state(), ('closed', {}))
+
+    def test_postgres_backend_facets_and_page(self):
+        """
+        Тест выдачи и фасетов поиска по БД в формате ответа ES
+        """
+        view = BookDocumentView(action_map={'get': 'list'}, format_kwarg=None, args=(), kwargs={})
+        request = view.initialize_request(APIRequestFactory().get(self.url, {'genre': 'Test Genre'}))
+        view.request = request
+        response = search_backends.postgres.list(view, request)
+
+        self.assertEqual(response.data['count'], 1)
+        self.assertEqual([book['id'] for book in response.data['results']], [self.book.pk])
+        self.assertEqual(response.data['facets']['genre'], [
+            {'value': 'Other Genre', 'count': 1, 'selected': False},
+            {'value': 'Test Genre', 'count': 1, 'selected': True},
+        ])
+        self.assertEqual(response.data['facets']['author'], [{'value': 'Test Author', 'count': 1, 'selected': False}])
+
+    def test_vectors_updated_by_drain_not_on_write(self):
+        """
+        Тест пересчета векторов поиска при разборе outbox, а не в запросе изменения
+        """
+        SearchOutbox.objects.all().delete()
+        with mock.patch.object(search_backends, 'is_postgres', return_value=True), \
+                mock.patch.object(search_backends, 'update_search_vectors') as update:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.book.title = 'Renamed'
+                self.book.save()
+                search_sync.record_signals([self.other.pk])
+            update.assert_not_called()
+
+            self.assertEqual(search_sync.update_vectors(10), 1)
+            update.assert_called_once_with({self.book.pk})
+            self.assertEqual(search_sync.update_vectors(10), 0)
+        self.assertTrue(SearchOutbox.objects.get(book_id=self.book.pk).vectorized)
@@ -0,0 +1,101 @@
+import uuid
+from io import BytesIO
+
+from django.conf import settings
+from django.core import signing
+from PIL import Image, UnidentifiedImageError
+from rest_framework.exceptions import ValidationError
+
+DEFAULTS = {
+    'MAX_SIZE': 10 * 1024 * 1024,
+    'EXPIRES': 600,
+    # Сколько байт начала объекта читается для проверки, что это изображение
+    'PROBE_SIZE': 64 * 1024,
+}
+
+# MIME-тип -> (расширение, формат Pillow)
+CONTENT_TYPES = {
+    'image/jpeg': ('jpg', 'JPEG'),
+    'image/png': ('png', 'PNG'),
+    'image/webp': ('webp', 'WEBP'),
+}
+
+UPLOAD_PREFIX = 'book_covers/uploads'
+TOKEN_SALT = 'books.cover-upload'
+
+
+def get_config():
+    return {**DEFAULTS, **getattr(settings, 'COVER_UPLOADS', {})}
+
+
+def _storage(book):
+    return book.cover_image.storage
+
+
+def issue_cover_upload(book, content_type):
+    """
+    Подписанная форма для загрузки обложки прямо в S3 мимо воркеров.
+    Ключ объекта выдает сервер, а token связывает его с книгой для complete.
+    """
+    config = get_config()
+    storage = _storage(book)
+    extension, _ = CONTENT_TYPES[content_type]
+    name = f'{UPLOAD_PREFIX}/{book.pk}/{uuid.uuid4().hex}.{extension}'
+
+    upload = storage.bucket.meta.client.generate_presigned_post(
+        storage.bucket_name,
+        storage._normalize_name(name),
+        Fields={'Content-Type': content_type},
+        Conditions=[
+            {'Content-Type': content_type},
+            ['content-length-range', 1, config['MAX_SIZE']],
+        ],
+        ExpiresIn=config['EXPIRES'],
+    )
+    token = signing.dumps({'book': book.pk, 'name': name, 'type': content_type}, salt=TOKEN_SALT)
+    return {'url': upload['url'], 'fields': upload['fields'], 'token': token, 'expires_in': config['EXPIRES']}
+
+
+def complete_cover_upload(book, token):
+    """
+    Проверяет загруженный объект и делает его обложкой книги.
+    Объект, не прошедший проверку, удаляется.
+    """
+    config = get_config()
+    try:
+        payload = signing.loads(token, salt=TOKEN_SALT, max_age=config['EXPIRES'] * 2)
+    except signing.BadSignature:
+        raise ValidationError({'token': 'Недействительный или просроченный токен загрузки'})
+    if payload['book'] != book.pk:
+        raise ValidationError({'token': 'Токен выдан для другой книги'})
+
+    storage = _storage(book)
+    name = payload['name']
+    if not storage.exists(name):
+        raise ValidationError({'token': 'Файл еще не загружен'})
+
+    try:
+        _validate_object(storage, name, payload['type'], config)
+    except ValidationError:
+        storage.delete(name)
+        raise
+
+    book.cover_image.name = name
+    book.save(update_fields=['cover_image'])
+    return book
+
+
+def _validate_object(storage, name, content_type, config):
+    obj = storage.bucket.Object(storage._normalize_name(name))
+    if obj.content_length > config['MAX_SIZE']:
+        raise ValidationError({'token': 'Файл слишком большой'})
+
+    head = obj.get(Range=f'bytes=0-{config["PROBE_SIZE"] - 1}')['Body'].read()
+    try:
+        image_format = Image.open(BytesIO(head)).format
+    except UnidentifiedImageError:
+        raise ValidationError({'token': 'Файл не является изображением'})
+
+    _, expected_format = CONTENT_TYPES[content_type]
+    if image_format != expected_format:
+        raise ValidationError({'token': 'Формат файла не совпадает с заявленным'})
@@ -2,7 +2,8 @@ from django.urls import include, path
 from rest_framework.routers import DefaultRouter
 
 from .views import (AuthorDetailView, BookDocumentView, BookViewSet,
-                    CommentBookAPIView, RatingAPIView, ReadListModelViewSet)
+                    CommentBookAPIView, ExportAPIView, RatingAPIView,
+                    RatingBulkAPIView, ReadListModelViewSet)
 
 router = DefaultRouter()
 router.register(r'book', BookViewSet, 'book')
@@ -15,4 +16,6 @@ urlpatterns = [
     path('api/v1/', include(router.urls)),
     path('api/v1/book/<int:book_pk>/comments/', CommentBookAPIView.as_view(), name='comment-list'),
     path('api/v1/book/<int:book_pk>/ratings/', RatingAPIView.as_view(), name='rating'),
+    path('api/v1/ratings/bulk/', RatingBulkAPIView.as_view(), name='rating-bulk'),
+    path('api/v1/export/<slug:dataset>/', ExportAPIView.as_view(), name='export'),
 ]
@@ -1,44 +1,138 @@
-from django.db.models import Prefetch
+from django.db import IntegrityError, transaction
+from django.db.models import Count, FloatField, Sum, Value
+from django.db.models.functions import Cast, NullIf
+from django.http import StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 from django_elasticsearch_dsl_drf.constants import SUGGESTER_COMPLETION
 from django_elasticsearch_dsl_drf.filter_backends import (
     SearchFilterBackend, SuggesterFilterBackend)
 from django_elasticsearch_dsl_drf.viewsets import DocumentViewSet
 from rest_framework import mixins, status, viewsets
+from rest_framework.decorators import action
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.permissions import IsAdminUser, IsAuthenticatedOrReadOnly
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
+from . import (autocomplete, exports, search_backends, search_cache,
+               search_ranking, search_sync, uploads, write_behind)
+from .cache import (AUTHORS_TAG, BOOKS_TAG, CachedResponseMixin,
+                    author_tag, book_tags, page_results)
 from .documents import BookDocument
+from .fast_serializers import FastBookSerializer
+from .fieldsets import BookFieldset
 from .filters import ReadBookListFilter
 from .models import Author, Book, Comment, Rating, ReadList
-from .serializers import (AuthorSerializer, BookDocumentSerializer,
+from .pagination import (KeysetPagination, OptionalKeysetPagination,
+                         SearchPagination, positive_int)
+from .search_facets import FacetFilterBackend
+from .serializers import (AuthorSummarySerializer, BookDocumentSerializer,
                           BookSerializer, BookWithCommentSerializer,
-                          CommentSerializer, RatingSerializer,
-                          ReadListSerializer)
+                          CommentSerializer, CommentThreadSerializer,
+                          CoverUploadCompleteSerializer, CoverUploadSerializer,
+                          RatingBulkItemSerializer, RatingSerializer,
+                          ReadListBulkSerializer, ReadListSerializer)
+from .services import (CommentThreadService, RatingAggregateService,
+                       RatingBulkService)
 
 
-class BookViewSet(viewsets.ReadOnlyModelViewSet):
+class BookViewSet(CachedResponseMixin, viewsets.ReadOnlyModelViewSet):
     """
     Класс для отображения книг
     """
 
-    queryset = Book.objects.all().select_related('genre').prefetch_related(
-        'author',
-    )
+    queryset = Book.objects.all()
 
     permission_classes = []
+    pagination_class = OptionalKeysetPagination
+    keyset_ordering = ('id',)
+
+    def get_queryset(self):
+        return BookFieldset.from_request(self.request).narrow(super().get_queryset())
+
+    def list(self, request, *args, **kwargs):
+        return self.cached_response(self.fast_list, request, *args, **kwargs)
+
+    def fast_list(self, request, *args, **kwargs):
+        """
+        Список через FastBookSerializer: страница строк из values() без моделей
+        """
+        serializer = FastBookSerializer(BookFieldset.from_request(request), request)
+        queryset = serializer.values_queryset(self.filter_queryset(self.queryset.all()))
+
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(serializer.serialize(page))
+        return Response(serializer.serialize(list(queryset)))
 
     def get_serializer_class(self):
         if self.action == 'retrieve':
             return BookWithCommentSerializer
         return BookSerializer
 
+    def get_cache_tags(self, data):
+        if self.action == 'retrieve':
+            return book_tags([data])
+        return book_tags(page_results(data)) | {BOOKS_TAG}
+
+    @action(detail=True, methods=['post'], url_path='cover-upload', permission_classes=[IsAdminUser])
+    def cover_upload(self, request, pk=None):
+        """
+        Подписанная форма для загрузки обложки напрямую в хранилище
+        """
+        serializer = CoverUploadSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        book = get_object_or_404(Book.objects.only('id', 'cover_image'), pk=pk)
+        upload = uploads.issue_cover_upload(book, serializer.validated_data['content_type'])
+        return Response(upload, status=status.HTTP_201_CREATED)
+
+    @action(detail=True, methods=['post'], url_path='cover-complete', permission_classes=[IsAdminUser])
+    def cover_complete(self, request, pk=None):
+        """
+        Проверка загруженного файла и привязка его к книге
+        """
+        serializer = CoverUploadCompleteSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        book = get_object_or_404(Book, pk=pk)
+        uploads.complete_cover_upload(book, serializer.validated_data['token'])
+        return Response({'cover_image': book.cover_image.url})
+
 
 class CommentBookAPIView(APIView):
     """
-    Добавление комментариев к конкретной книге
+    Ветки комментариев и добавление комментариев к конкретной книге
     """
     serializer_class = CommentSerializer
+    permission_classes = [IsAuthenticatedOrReadOnly]
+
+    default_max_depth = 2
+    max_depth_limit = 10
+    replies_limit = 5
+
+    def get(self, request, book_pk=None):
+        book = get_object_or_404(Book.objects.only('id'), pk=book_pk)
+        parent_id = self._int_param(request, 'parent', None)
+        max_depth = min(self._int_param(request, 'max_depth', self.default_max_depth), self.max_depth_limit)
+
+        roots = Comment.objects.filter(book=book, parent_id=parent_id).select_related('user')
+        paginator = KeysetPagination(ordering=CommentThreadService.sibling_ordering)
+        page = paginator.paginate_queryset(roots, request, self)
+        CommentThreadService.attach_replies(page, max_depth, self.replies_limit)
+
+        serializer = CommentThreadSerializer(page, many=True, context={'request': request, 'max_depth': max_depth})
+        return paginator.get_paginated_response(serializer.data)
+
+    @staticmethod
+    def _int_param(request, name, default):
+        value = request.query_params.get(name)
+        if value is None:
+            return default
+        try:
+            return positive_int(value)
+        except ValueError:
+            raise ValidationError({name: 'Ожидается неотрицательное целое число'})
 
     def post(self, request, book_pk=None):
         book = get_object_or_404(Book, pk=book_pk)
@@ -62,18 +156,50 @@ class RatingAPIView(APIView):
     """
     serializer_class = RatingSerializer
 
+    def get(self, request, book_pk=None):
+        """
+        Собственная оценка пользователя с учетом еще не записанной в БД
+        """
+        value = None
+        if write_behind.is_enabled():
+            value = write_behind.pending_rating(request.user.pk, book_pk)
+        if value is None:
+            rating = get_object_or_404(Rating, book_id=book_pk, user=request.user)
+            value = rating.rating
+
+        return Response(self.serializer_class({'rating': value}).data)
+
     def post(self, request, book_pk=None):
         book = get_object_or_404(Book, pk=book_pk)
 
         serializer = self.serializer_class(data=request.data)
 
         if serializer.is_valid():
-            rating, created = Rating.objects.update_or_create(
-                book=book,
-                user=request.user,
-                defaults={'rating': serializer.validated_data['rating']}
-            )
-            if not created:
+            value = serializer.validated_data['rating']
+
+            if write_behind.is_enabled():
+                write_behind.push(request.user.pk, book.pk, value)
+                return Response(serializer.data, status=status.HTTP_202_ACCEPTED)
+
+            with transaction.atomic():
+                rating = Rating.objects.select_for_update().filter(book=book, user=request.user).first()
+                if rating is None:
+                    try:
+                        with transaction.atomic():
+                            Rating.objects.create(book=book, user=request.user, rating=value)
+                    except IntegrityError:
+                        # Отсутствующую строку заблокировать нельзя: первую оценку
+                        # успел записать параллельный запрос, обновляем ее
+                        rating = Rating.objects.select_for_update().get(book=book, user=request.user)
+                previous = rating.rating if rating else None
+
+                if rating is not None and previous != value:
+                    rating.rating = value
+                    rating.save(update_fields=['rating'])
+
+                RatingAggregateService.apply(book.pk, value, previous)
+
+            if previous is not None:
                 return Response({'message': 'Рейтинг обновлен'}, status=status.HTTP_200_OK)
 
             return Response(serializer.data, status=status.HTTP_201_CREATED)
@@ -81,6 +207,23 @@ class RatingAPIView(APIView):
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
+class RatingBulkAPIView(APIView):
+    """
+    Пакетное добавление и обновление оценок текущего пользователя
+    """
+    serializer_class = RatingBulkItemSerializer
+    max_items = 1000
+
+    def post(self, request):
+        serializer = self.serializer_class(
+            data=request.data, many=True, allow_empty=False, max_length=self.max_items
+        )
+        serializer.is_valid(raise_exception=True)
+
+        results = RatingBulkService.upsert(request.user, serializer.validated_data)
+        return Response({'results': results}, status=status.HTTP_200_OK)
+
+
 class ReadListModelViewSet(mixins.CreateModelMixin,
                            mixins.DestroyModelMixin,
                            mixins.ListModelMixin,
@@ -90,10 +233,14 @@ class ReadListModelViewSet(mixins.CreateModelMixin,
     """
     serializer_class = ReadListSerializer
     filterset_class = ReadBookListFilter
+    pagination_class = OptionalKeysetPagination
+    keyset_ordering = ('-date_added', '-id')
 
     def get_queryset(self):
-        return ReadList.objects.filter(user=self.request.user).select_related(
-            'book').select_related('book__genre').prefetch_related('book__author')
+        queryset = ReadList.objects.filter(user=self.request.user).select_related('book')
+        return BookFieldset.from_request(self.request).narrow(
+            queryset, prefix='book__', keep=('user', 'book', 'date_added'),
+        )
 
     def create(self, request):
         serializer = ReadListSerializer(data=request.data, context={'request': request})
@@ -103,45 +250,176 @@ class ReadListModelViewSet(mixins.CreateModelMixin,
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
     def destroy(self, request, pk=None):
-        read_book = ReadList.objects.filter(user=request.user, book_id=pk)
+        deleted, _ = ReadList.objects.filter(user=request.user, book_id=pk).delete()
 
-        if read_book.exists():
-            read_book.delete()
+        if deleted:
             return Response({'message': 'Книга удалена из списка "Прочитанное"'})
 
         return Response({'error': 'Книга не найдена'})
 
+    @action(detail=False, methods=['post'], url_path='bulk-add')
+    def bulk_add(self, request):
+        """
+        Добавление книг одним INSERT, уже добавленные пропускаются
+        """
+        book_ids = self._bulk_books(request.data)
+        existing = set(Book.objects.filter(pk__in=book_ids).values_list('pk', flat=True))
+
+        with transaction.atomic():
+            # Отмечаются только книги, которых в списке еще не было: уже
+            # добавленные ignore_conflicts пропустит, а параллельную вставку
+            # отметит ее собственный сигнал post_save
+            added = existing - set(
+                ReadList.objects.filter(user=request.user, book_id__in=existing)
+                .values_list('book_id', flat=True)
+            )
+            ReadList.objects.bulk_create(
+                [ReadList(user=request.user, book_id=book_id) for book_id in book_ids if book_id in added],
+                ignore_conflicts=True,
+            )
+            # bulk_create не отправляет сигналы
+            search_sync.record_signals(added)
+        return Response({
+            'books': [book_id for book_id in book_ids if book_id in existing],
+            'not_found': [book_id for book_id in book_ids if book_id not in existing],
+        })
+
+    @action(detail=False, methods=['post'], url_path='bulk-remove')
+    def bulk_remove(self, request):
+        """
+        Удаление книг из списка одним DELETE
+        """
+        book_ids = self._bulk_books(request.data)
+        with transaction.atomic():
+            removed = list(
+                ReadList.objects.select_for_update()
+                .filter(user=request.user, book_id__in=book_ids)
+                .values_list('book_id', flat=True)
+            )
+            # Без post_delete на каждую строку: книги отмечаются для поиска
+            # одной вставкой в outbox, как в bulk_add
+            queryset = ReadList.objects.filter(user=request.user, book_id__in=removed)
+            deleted = queryset._raw_delete(queryset.db) if removed else 0
+            search_sync.record_signals(removed)
+        return Response({'removed': deleted})
+
+    @action(detail=False, methods=['get'])
+    def contains(self, request):
+        """
+        Какие из книг ?books=1,2,3 есть в списке: один запрос
+        по индексу уникальности (user, book)
+        """
+        raw = request.query_params.get('books', '')
+        book_ids = self._bulk_books({'books': [value for value in raw.split(',') if value]})
+        found = set(
+            ReadList.objects.filter(user=request.user, book_id__in=book_ids)
+            .values_list('book_id', flat=True)
+        )
+        return Response({'books': [book_id for book_id in book_ids if book_id in found]})
+
+    @staticmethod
+    def _bulk_books(data):
+        serializer = ReadListBulkSerializer(data=data)
+        serializer.is_valid(raise_exception=True)
+        return serializer.validated_data['books']
+
 
-class AuthorDetailView(viewsets.ReadOnlyModelViewSet):
+class ExportAPIView(APIView):
     """
-    Класс для отображения Авторов книг и книг, которые они написали
+    Потоковая выгрузка данных пользователя в NDJSON (по умолчанию) или CSV
     """
-    queryset = Author.objects.all().prefetch_related(
-        Prefetch('book_set', queryset=Book.objects.select_related('genre'))
-    )
-    serializer_class = AuthorSerializer
+    output_query_param = 'output'
+    content_types = {
+        'ndjson': 'application/x-ndjson; charset=utf-8',
+        'csv': 'text/csv; charset=utf-8',
+    }
 
-    def retrieve(self, request, pk=None):
-        author = self.get_object()
+    def get(self, request, dataset):
+        if dataset not in exports.DATASETS:
+            raise NotFound('Неизвестный набор данных')
 
-        books = author.book_set.all()
-        books_serializer = BookSerializer(books, many=True)
+        output = request.query_params.get(self.output_query_param, 'ndjson')
+        if output not in self.content_types:
+            raise ValidationError({self.output_query_param: f'Допустимые значения: {", ".join(self.content_types)}'})
 
-        return Response(books_serializer.data)
+        rows_for, fields = exports.DATASETS[dataset]
+        rows = rows_for(request.user)
+        stream = exports.csv_stream(rows, fields) if output == 'csv' else exports.ndjson_stream(rows)
 
+        response = StreamingHttpResponse(stream, content_type=self.content_types[output])
+        response['Content-Disposition'] = f'attachment; filename="{dataset}.{output}"'
+        return response
 
-class BookDocumentView(DocumentViewSet):
+
+class AuthorDetailView(CachedResponseMixin, viewsets.ReadOnlyModelViewSet):
+    """
+    Класс для отображения Авторов книг и книг, которые они написали.
+    Средний рейтинг взвешен по числу оценок книг; в закэшированном
+    ответе он может отставать от новых оценок на время жизни кэша.
+    """
+    queryset = Author.objects.annotate(
+        books_count=Count('book'),
+        rating_average=(
+            Cast(Sum('book__rating_sum'), FloatField()) / NullIf(Sum('book__rating_count'), Value(0))
+        ),
+    )
+    serializer_class = AuthorSummarySerializer
+    pagination_class = OptionalKeysetPagination
+    keyset_ordering = ('id',)
+
+    @action(detail=True, methods=['get'])
+    def books(self, request, pk=None):
+        """
+        Книги автора постранично
+        """
+        return self.cached_response(self.author_books, request, pk=pk)
+
+    def author_books(self, request, pk=None):
+        if not Author.objects.filter(pk=pk).exists():
+            raise NotFound('Автор не найден')
+
+        books = BookFieldset.from_request(request).narrow(Book.objects.filter(author=pk).order_by('id'))
+        page = self.paginate_queryset(books)
+        serializer = BookSerializer(page, many=True, context=self.get_serializer_context())
+        return self.get_paginated_response(serializer.data)
+
+    def get_cache_tags(self, data):
+        if self.action == 'books':
+            return book_tags(page_results(data)) | {author_tag(self.kwargs['pk']), BOOKS_TAG}
+        if self.action == 'retrieve':
+            return {author_tag(data['id']), BOOKS_TAG}
+        return {author_tag(author['id']) for author in page_results(data)} | {AUTHORS_TAG, BOOKS_TAG}
+
+
+class BookDocumentView(CachedResponseMixin, DocumentViewSet):
     """
-    Поиск через ElasticSearch
+    Поиск через ElasticSearch. Релевантность по тексту умножается
+    на сигналы популярности, см. books.search_ranking.
+    Список отдает карточки в формате BookSerializer (с ?fields= и ?expand=):
+    ?mode=source - из _source документов, без БД;
+    ?mode=hydrated - из БД одним запросом по id найденных книг.
+    Фасеты по жанрам и авторам приходят в том же ответе ES, выбор
+    (?genre=&author=) применяется как post_filter, см. books.search_facets.
+    Ответы кэшируются по нормализованному запросу до следующей записи
+    в индекс, см. books.search_cache.
+    Когда ES недоступен, выдачу, фасеты и подсказки в том же формате
+    отдает полнотекстовый поиск PostgreSQL, см. books.search_backends.
     """
     permission_classes = []
     document = BookDocument
     serializer_class = BookDocumentSerializer
 
-    filter_backends = [SearchFilterBackend, SuggesterFilterBackend]
+    filter_backends = [SearchFilterBackend, FacetFilterBackend, SuggesterFilterBackend]
+    pagination_class = SearchPagination
 
     search_fields = ('title',)
 
+    facet_fields = {
+        'genre': 'genre.title.raw',
+        'author': 'author.name.raw',
+    }
+    facet_size = 20
+
     suggester_fields = {
         'title': {
             'field': 'title.suggest',
@@ -150,3 +428,51 @@ class BookDocumentView(DocumentViewSet):
             ],
         },
     }
+
+    mode_query_param = 'mode'
+    SOURCE_MODE = 'source'
+    HYDRATED_MODE = 'hydrated'
+    cache_stats_namespace = search_cache.STATS_NAMESPACE
+
+    def get_cache_key(self, request):
+        return search_cache.cache_key(request)
+
+    def get_cache_timeout(self, request):
+        if search_backends.is_fallback(self):
+            return search_backends.get_config()['FALLBACK_CACHE_TIMEOUT']
+        return search_cache.timeout(request, self.action)
+
+    def get_cache_tags(self, data):
+        tags = {search_cache.INDEX_TAG}
+        if self.request.query_params.get(self.mode_query_param) == self.HYDRATED_MODE:
+            tags |= book_tags(page_results(data))
+        return tags
+
+    def filter_queryset(self, queryset):
+        return search_ranking.rank(super().filter_queryset(queryset))
+
+    @action(detail=False)
+    def suggest(self, request):
+        """
+        Подсказки по началу названия отдает индекс в памяти воркера,
+        остальные запросы и промахи уходят в completion-подсказки ES
+        (или в триграммы Postgres, пока ES недоступен)
+        """
+        data = autocomplete.suggest_response(request.query_params)
+        if data is not None:
+            return Response(data)
+        return self.cached_response(self.search_suggest, request)
+
+    def list(self, request, *args, **kwargs):
+        return self.cached_response(self.search_list, request, *args, **kwargs)
+
+    def search_list(self, request, *args, **kwargs):
+        mode = request.query_params.get(self.mode_query_param, self.SOURCE_MODE)
+        if mode not in (self.SOURCE_MODE, self.HYDRATED_MODE):
+            raise ValidationError({
+                self.mode_query_param: f'Допустимые значения: {self.SOURCE_MODE}, {self.HYDRATED_MODE}'
+            })
+        return search_backends.dispatch('list', self, request)
+
+    def search_suggest(self, request):
+        return search_backends.dispatch('suggest', self, request)
@@ -0,0 +1,155 @@
+import logging
+import uuid
+
+import redis
+from django.conf import settings
+from django.db import transaction
+
+from .services import RatingBulkService
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'ENABLED': False,
+    'URL': 'redis://redis:6379/0',
+    'OPTIONS': {},
+    'FLUSH_INTERVAL': 5,
+    'LOCK_TIMEOUT': 60,
+}
+
+PENDING_KEY = 'rwb:pending'
+FLUSHING_KEY = 'rwb:flushing'
+LOCK_KEY = 'rwb:lock'
+
+# Скрипты ниже меняют состояние, только если блокировка все еще наша:
+# сброс, переживший LOCK_TIMEOUT, не должен снять блокировку следующего
+# воркера или тронуть пачку, которую тот уже забрал
+RELEASE_LOCK = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+EXTEND_LOCK = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('expire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+DROP_BATCH = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[2])
+end
+return 0
+"""
+
+# Возвращает пачку в буфер без перезаписи более новых оценок
+RESTORE_BATCH = """
+if redis.call('get', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+local batch = redis.call('hgetall', KEYS[2])
+for i = 1, #batch, 2 do
+    redis.call('hsetnx', KEYS[3], batch[i], batch[i + 1])
+end
+redis.call('del', KEYS[2])
+return 1
+"""
+
+
+class LockLost(Exception):
+    """
+    Блокировка сброса истекла и, возможно, уже взята другим воркером
+    """
+
+
+_clients = {}
+
+
+def get_config():
+    return {**DEFAULTS, **getattr(settings, 'RATING_WRITE_BEHIND', {})}
+
+
+def is_enabled():
+    return get_config()['ENABLED']
+
+
+def get_client():
+    config = get_config()
+    client = _clients.get(config['URL'])
+    if client is None:
+        client = _clients[config['URL']] = redis.Redis.from_url(config['URL'], **config['OPTIONS'])
+    return client
+
+
+def _field(user_id, book_id):
+    return f'{user_id}:{book_id}'
+
+
+def push(user_id, book_id, rating):
+    """
+    Откладывает оценку до следующего сброса; повторная оценка той же книги
+    перезаписывает предыдущую
+    """
+    get_client().hset(PENDING_KEY, _field(user_id, book_id), rating)
+
+
+def pending_rating(user_id, book_id):
+    """
+    Еще не записанная в БД оценка пользователя, в том числе из сбрасываемой
+    в этот момент пачки
+    """
+    client = get_client()
+    field = _field(user_id, book_id)
+    value = client.hget(PENDING_KEY, field) or client.hget(FLUSHING_KEY, field)
+    return int(value) if value is not None else None
+
+
+def flush():
+    """
+    Переносит накопленные оценки в БД одной пачкой. Буфер сначала
+    переименовывается, поэтому новые оценки во время сброса копятся
+    в свежем хеше. При ошибке пачка возвращается в буфер без перезаписи
+    более новых оценок. Запись фиксируется, только если перед коммитом
+    удалось продлить свою блокировку: если она истекла, пачку мог забрать
+    следующий сброс, и эта запись откатывается. Возвращает число
+    записанных изменений.
+    """
+    client = get_client()
+    config = get_config()
+
+    token = uuid.uuid4().hex
+    if not client.set(LOCK_KEY, token, nx=True, ex=config['LOCK_TIMEOUT']):
+        return 0
+
+    try:
+        # Пачка, оставшаяся от упавшего сброса, обрабатывается первой
+        if not client.exists(FLUSHING_KEY):
+            try:
+                client.rename(PENDING_KEY, FLUSHING_KEY)
+            except redis.ResponseError:
+                return 0
+
+        pending = {}
+        for field, value in client.hgetall(FLUSHING_KEY).items():
+            user_id, book_id = field.decode().split(':')
+            pending[(int(user_id), int(book_id))] = int(value)
+
+        try:
+            with transaction.atomic():
+                written = RatingBulkService.write_pending(pending)
+                if not client.eval(EXTEND_LOCK, 1, LOCK_KEY, token, config['LOCK_TIMEOUT']):
+                    raise LockLost
+        except LockLost:
+            logger.warning('rating write-behind: блокировка сброса истекла, пачка оставлена следующему сбросу')
+            return 0
+        except Exception:
+            client.eval(RESTORE_BATCH, 3, LOCK_KEY, FLUSHING_KEY, PENDING_KEY, token)
+            raise
+
+        client.eval(DROP_BATCH, 2, LOCK_KEY, FLUSHING_KEY, token)
+        return written
+    finally:
+        client.eval(RELEASE_LOCK, 1, LOCK_KEY, token)
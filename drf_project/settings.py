@@ -22,6 +22,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
 
     'storages',
 
@@ -136,6 +137,15 @@ REST_FRAMEWORK = {
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.LimitOffsetPagination',
     'PAGE_SIZE': 10,
     'DEFAULT_FILTER_BACKENDS': ['django_filters.rest_framework.DjangoFilterBackend'],
+    'DEFAULT_RENDERER_CLASSES': [
+        'drf_project.renderers.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+    'DEFAULT_PARSER_CLASSES': [
+        'drf_project.parsers.FastJSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ],
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticated',
     ],
@@ -179,7 +189,14 @@ AWS_STORAGE_BUCKET_NAME = env.str("AWS_STORAGE_BUCKET_NAME")
 AWS_S3_REGION_NAME = env.str("AWS_S3_REGION_NAME")
 AWS_S3_ENDPOINT_URL = env.str("AWS_S3_ENDPOINT_URL")
 
-DEFAULT_FILE_STORAGE = 'storages.backends.s3boto3.S3Boto3Storage'
+DEFAULT_FILE_STORAGE = 'drf_project.storages.CoverStorage'
+
+# Ссылки на файлы в S3, см. drf_project.storages.CachedURLMixin:
+# presigned - подписанные ссылки из кэша, public - постоянные ссылки от BASE_URL (CDN)
+MEDIA_URLS = {
+    'MODE': env.str("MEDIA_URL_MODE", default='presigned'),
+    'BASE_URL': env.str("MEDIA_BASE_URL", default=''),
+}
 
 
 AUTH_USER_MODEL = 'domain.User'
@@ -197,6 +214,40 @@ ELASTICSEARCH_INDEX_NAMES = {
     'books.documents': 'books',
 }
 
+# Индекс обновляется воркером из outbox, см. books.search_sync
+ELASTICSEARCH_DSL_AUTOSYNC = False
+
+SEARCH_OUTBOX = {
+    'BATCH_SIZE': 500,
+    'DRAIN_INTERVAL': 2,
+    'MAX_BATCHES': 20,
+}
+
+# Кэш ответов поиска до следующей записи в индекс, см. books.search_cache
+SEARCH_CACHE = {
+    'TIMEOUT': 120,
+    'TIMEOUTS': {'suggest': 600},
+}
+
+# Запасной полнотекстовый поиск в PostgreSQL, см. books.search_backends
+SEARCH_BACKEND = {
+    'BACKEND': env.str("SEARCH_BACKEND", default='elasticsearch'),
+    'FAILOVER': env.bool("SEARCH_FAILOVER", default=True),
+    'FAILURE_THRESHOLD': 5,
+    'FAILURE_WINDOW': 30,
+    'RESET_TIMEOUT': 30,
+    'TEXT_CONFIG': 'russian',
+}
+
+# Веса сигналов популярности в поиске, см. books.search_ranking
+SEARCH_RANKING = {
+    'RATING_WEIGHT': 1.0,
+    'VOTES_WEIGHT': 0.5,
+    'READERS_WEIGHT': 0.5,
+    'RECENCY_WEIGHT': 1.0,
+    'RECENCY_SCALE': '30d',
+}
+
 
 LOGGING = {
     'version': 1,
@@ -216,3 +267,59 @@ LOGGING = {
 
 
 EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
+
+
+REDIS_URL = env.str("REDIS_URL", default='redis://redis:6379')
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': f'{REDIS_URL}/0',
+    }
+}
+
+RESPONSE_CACHE = {
+    'ENABLED': env.bool("RESPONSE_CACHE_ENABLED", default=True),
+    'TIMEOUT': 300,
+    'STALE_TIMEOUT': 600,
+}
+
+
+# mptt | path, см. books.models.Comment.tree_storage
+COMMENT_TREE_STORAGE = env.str("COMMENT_TREE_STORAGE", default='mptt')
+
+
+CELERY_BROKER_URL = env.str("CELERY_BROKER_URL", default=f'{REDIS_URL}/1')
+CELERY_TASK_IGNORE_RESULT = True
+
+# Отложенная запись оценок через буфер в Redis, см. books.write_behind
+RATING_WRITE_BEHIND = {
+    'ENABLED': env.bool("RATING_WRITE_BEHIND_ENABLED", default=False),
+    'URL': f'{REDIS_URL}/2',
+    'FLUSH_INTERVAL': 5,
+}
+
+# Подсказки по названиям из памяти воркера, см. books.autocomplete
+AUTOCOMPLETE = {
+    'ENABLED': env.bool("AUTOCOMPLETE_ENABLED", default=True),
+    'URL': f'{REDIS_URL}/2',
+    'REFRESH_INTERVAL': 5,
+}
+
+CELERY_BEAT_SCHEDULE = {
+    'flush-rating-buffer': {
+        'task': 'books.tasks.flush_rating_buffer',
+        'schedule': RATING_WRITE_BEHIND['FLUSH_INTERVAL'],
+    },
+    'drain-search-outbox': {
+        'task': 'books.tasks.drain_search_outbox',
+        'schedule': SEARCH_OUTBOX['DRAIN_INTERVAL'],
+    },
+}
+
+# Рендиции обложек, см. books.covers
+COVER_RENDITIONS = {
+    'STORAGE': 'drf_project.storages.CoverStorage',
+    'WIDTHS': [160, 320, 640],
+    'QUALITY': 80,
+}
@@ -1,6 +1,123 @@
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.encoding import filepath_to_uri
 from storages.backends.s3boto3 import S3Boto3Storage
+from storages.utils import clean_name
+
+URL_DEFAULTS = {
+    'MODE': 'presigned',
+    'BASE_URL': '',
+    'CACHE_ALIAS': 'default',
+    # Подписанная ссылка отдается из кэша, пока до ее истечения больше запаса
+    'EXPIRY_MARGIN': 300,
+    'LOCAL_CACHE_SIZE': 10000,
+}
+
+PUBLIC_URLS = 'public'
+PRESIGNED_URLS = 'presigned'
+
+
+def get_url_config():
+    return {**URL_DEFAULTS, **getattr(settings, 'MEDIA_URLS', {})}
+
+
+class CachedURLMixin:
+    """
+    Ссылки на файлы без подписи на горячем пути.
+    public - постоянные ссылки от BASE_URL (CDN или публичный бакет);
+    presigned - подписанные ссылки из кэша по ключу объекта, подпись
+    выполняется только при промахе. prefetch_urls прогревает ссылки
+    целой страницы одним обращением к кэшу.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._local_urls = {}
+
+    def url(self, name, parameters=None, expire=None, http_method=None):
+        if parameters or expire or http_method:
+            return super().url(name, parameters=parameters, expire=expire, http_method=http_method)
+
+        config = get_url_config()
+        if config['MODE'] == PUBLIC_URLS:
+            return self._public_url(name, config)
+
+        key = self._url_cache_key(name)
+        url = self._local_url(key)
+        if url is None:
+            entry = caches[config['CACHE_ALIAS']].get(key)
+            if entry is None:
+                entry = self._sign(name, key, config)
+            else:
+                self._remember(key, entry, config)
+            url = entry[0]
+        return url
+
+    def prefetch_urls(self, names):
+        config = get_url_config()
+        if config['MODE'] == PUBLIC_URLS:
+            return
+
+        keys = {self._url_cache_key(name): name for name in names if name}
+        missing = {key: name for key, name in keys.items() if self._local_url(key) is None}
+        if not missing:
+            return
+
+        cache = caches[config['CACHE_ALIAS']]
+        found = cache.get_many(missing)
+        for key, entry in found.items():
+            self._remember(key, entry, config)
+
+        signed = {
+            key: self._sign(name, key, config, store=False)
+            for key, name in missing.items() if key not in found
+        }
+        if signed:
+            cache.set_many(signed, timeout=self._url_ttl(config))
+
+    def _public_url(self, name, config):
+        if not config['BASE_URL']:
+            raise ImproperlyConfigured('MEDIA_URLS["BASE_URL"] обязателен в режиме public')
+        key = self._normalize_name(clean_name(name))
+        return f'{config["BASE_URL"].rstrip("/")}/{filepath_to_uri(key)}'
+
+    def _sign(self, name, key, config, store=True):
+        """
+        Подписывает ссылку; в кэш кладется пара (ссылка, момент, до которого ее можно отдавать)
+        """
+        entry = (super().url(name), time.time() + self._url_ttl(config))
+        if store:
+            caches[config['CACHE_ALIAS']].set(key, entry, timeout=self._url_ttl(config))
+        self._remember(key, entry, config)
+        return entry
+
+    def _url_ttl(self, config):
+        return max(self.querystring_expire - config['EXPIRY_MARGIN'], 1)
+
+    def _url_cache_key(self, name):
+        return f'media-url:{self.bucket_name}:{self._normalize_name(clean_name(name))}'
+
+    def _local_url(self, key):
+        entry = self._local_urls.get(key)
+        if entry is None or entry[1] <= time.time():
+            return None
+        return entry[0]
+
+    def _remember(self, key, entry, config):
+        if len(self._local_urls) >= config['LOCAL_CACHE_SIZE']:
+            self._local_urls.clear()
+        self._local_urls[key] = entry
+
+
+class CoverStorage(CachedURLMixin, S3Boto3Storage):
+    """
+    Хранилище по умолчанию: оригиналы обложек и их рендиции
+    """
 
 
-class MediaStorage(S3Boto3Storage):
+class MediaStorage(CachedURLMixin, S3Boto3Storage):
     location = 'media'
     file_overwrite = False
@@ -14,3 +14,7 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'drf_project.settings')
 
 application = get_wsgi_application()
+
+from books import autocomplete  # noqa: E402
+
+autocomplete.warm()